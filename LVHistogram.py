@@ -3,21 +3,28 @@ from argparse import ArgumentParser
 import os
 import numpy as np
 import random
-import itertools
 import numpy as np
-import Levenshtein
+from rapidfuzz.process import cdist
+from rapidfuzz.distance import Levenshtein
 import matplotlib.pyplot as plt
-import pandas as pd
 import gc
+import gzip
+import contextlib
 from datetime import datetime
 from matplotlib.backends.backend_pdf import PdfPages
+from barcodeEncoding import encode_barcodes, decode_barcodes, unique_barcodes
 
 
-def create_histogram(matrix, title, pdf, x_tick):
+def create_histogram(histogram, title, pdf, x_tick):
+    # The histogram holds the number of pairs at each distance; every distance that occurs is plotted with its count as weight,
+    # which gives the same bins as plotting every distance separately
+    distances = np.nonzero(histogram)[0]
+    weights = histogram[distances]
+
     # Create a figure for the normal scale histogram
     plt.figure(figsize=(6, 4))
-    num_bins = np.max(matrix)  # Using the maximum value as the number of bins
-    plt.hist(matrix, bins=num_bins, density=True, linewidth=10)  # Reduced linewidth for better visibility
+    num_bins = np.max(distances)  # Using the maximum value as the number of bins
+    plt.hist(distances, bins=num_bins, weights=weights, density=True, linewidth=10)  # Reduced linewidth for better visibility
     plt.title(title)
     plt.xlabel('LV Distance')
     plt.ylabel('Fraction')
@@ -28,7 +35,7 @@ def create_histogram(matrix, title, pdf, x_tick):
 
     # Create a figure for the logscale histogram
     plt.figure(figsize=(6, 4))
-    plt.hist(matrix, bins=num_bins, density=True, linewidth=10)  # Same histogram, but we'll change the y-axis scale
+    plt.hist(distances, bins=num_bins, weights=weights, density=True, linewidth=10)  # Same histogram, but we'll change the y-axis scale
     plt.title(title + " (logscale)")
     plt.yscale('log')  # Set y-axis to logarithmic scale
     plt.xlabel('LV Distance')
@@ -39,27 +46,86 @@ def create_histogram(matrix, title, pdf, x_tick):
     plt.close()
 
 
-def analyze_LV(Sample, csvfilepath, sample_number):
-    # Generate all pairs, including self-pairs
-    pairs_1 = itertools.product(Sample, Sample)
-    
-    # Filter out self-pairs
-    pairs_1 = [(pair[0], pair[1]) for pair in pairs_1 if pair[0] != pair[1]]
-    
-    # Calculate Levenshtein distances
-    matrix_1 = [Levenshtein.distance(pair[0], pair[1]) for pair in pairs_1]
-    
-    # Free up memory
-    del(pairs_1)
-    
-    # Convert to numpy array
-    matrix_1 = np.array(matrix_1)
-    
-    # Saving the matrix to reproduce data
-    pd.DataFrame(matrix_1).to_csv(csvfilepath, index=False, header=False)
+def distance_dtype(Sample):
+    """Function to return the smallest unsigned dtype that holds every distance between the barcodes of Sample (at most the longest length)."""
+    return np.uint8 if max(map(len, Sample), default=0) <= np.iinfo(np.uint8).max else np.uint16
+
+
+def distance_blocks(Sample, blockSize=256, workers=-1):
+    """
+    Function to compute the Levenshtein distance of every pair of barcodes in Sample once (i < j) and yield them a block of rows at a
+    time, in the order of a condensed matrix (scipy.spatial.distance.squareform): the distances of barcode 0 to 1..n-1, then of
+    barcode 1 to 2..n-1, and so on. Each block is computed with rapidfuzz cdist (bit-parallel and multi-threaded over workers, -1 for
+    all cores) and starts at the column after its first row, so besides the upper triangle only a small triangle per block is computed (and dropped).
+    rapidfuzz only runs its fast bit-parallel kernel on barcodes of up to 64 bases; longer ones (the full 90-100 nt barcodes) take a
+    slower path, about 27 s per core for 5000 barcodes of 90 bases against 1.4 s for 50 bases (the pair loop this replaced took about 98 s).
+    """
+    Sample = list(Sample)
+    count = len(Sample)
+    dtype = distance_dtype(Sample)
+    for start in range(0, count, blockSize):
+        stop = min(start + blockSize, count)
+        # Distances of the rows start..stop-1 to every barcode after start; row k keeps the columns right of its diagonal
+        block = cdist(Sample[start:stop], Sample[start + 1:], scorer=Levenshtein.distance, dtype=dtype, workers=workers)
+        yield np.concatenate([block[k, k:] for k in range(stop - start)])
+
+
+def open_matrix_file(matrixPath, matrixOutput):
+    """
+    Function to open the file the distances are written to: a text file with one distance per line (csv and condensed), a gzipped
+    file with the condensed matrix as raw bytes of its dtype (binary, read it back with np.frombuffer(gzip.open(path).read(), dtype))
+    or nothing (none).
+    """
+    if matrixOutput in ("csv", "condensed"):
+        return open(matrixPath, "w")
+    if matrixOutput == "binary":
+        return gzip.open(matrixPath, "wb", compresslevel=6)
+    return contextlib.nullcontext()
+
+
+def write_ordered_matrix(matrixFile, upper):
+    """
+    Function to write the distances of every ordered pair of different barcodes (a, b), one per line, row by row: barcode 0 to
+    1..n-1, barcode 1 to 0, 2..n-1 and so on (the full matrix without its diagonal, the csv layout of the pair loop this replaced).
+    upper is the square matrix with the distances of the pairs i < j above the diagonal and zeros below.
+    """
+    full = upper + upper.T
+    for row in range(len(full)):
+        matrixFile.write("".join(str(distance) + "\n" for distance in np.delete(full[row], row).tolist()))
+
+
+def analyze_LV(Sample, matrixPath, sample_number, matrixOutput="csv"):
+    # Count the Levenshtein distance of every pair of different barcodes once into a histogram with one bin per distance,
+    # from 0 to the length of the longest barcode. The distances are computed and counted one block of rows at a time, so the
+    # memory does not grow with the number of pairs (except for csv, which keeps one byte per pair to write the ordered pairs).
+    # The ordered pairs (a, b) and (b, a) have the same distance, so the mean and the histogram are the same as for all ordered pairs
+    Sample = list(Sample)
+    count = len(Sample)
+    histogram = np.zeros(max(map(len, Sample), default=0) + 1, dtype=np.int64)
+    upper = np.zeros((count, count), dtype=distance_dtype(Sample)) if matrixOutput == "csv" else None
+    row = 0
+
+    # Saving the matrix to reproduce data, block by block as it is computed
+    with open_matrix_file(matrixPath, matrixOutput) as matrixFile:
+        for block in distance_blocks(Sample):
+            histogram += np.bincount(block, minlength=len(histogram))
+            if matrixOutput == "csv":
+                # The block holds the rows from row on, each with the distances to the barcodes after it
+                offset = 0
+                while offset < len(block):
+                    upper[row, row + 1:] = block[offset:offset + count - row - 1]
+                    offset += count - row - 1
+                    row += 1
+            elif matrixOutput == "condensed":
+                matrixFile.write("".join(str(distance) + "\n" for distance in block.tolist()))
+            elif matrixOutput == "binary":
+                matrixFile.write(block.tobytes())
+        if matrixOutput == "csv":
+            write_ordered_matrix(matrixFile, upper)
+            del upper
     
     # Calculating mean
-    sample1_mean = sum(matrix_1) / len(matrix_1)
+    sample1_mean = int(histogram @ np.arange(len(histogram))) / int(histogram.sum())
     
     # Clean up to free memory
     del Sample
@@ -67,7 +133,7 @@ def analyze_LV(Sample, csvfilepath, sample_number):
     
     print(f"Done for Sampling {sample_number}")
 
-    return sample1_mean, matrix_1
+    return sample1_mean, histogram
 
 
 if __name__ == "__main__":
@@ -78,8 +144,9 @@ if __name__ == "__main__":
     parser.add_argument("pathtosample", help = "Specify the sample that needs to have its LV distance analyzed.")
     parser.add_argument("pathtosummary", help = "Specify the path to the summary file containing LV mean distance.")
     parser.add_argument("sampleName", help = "Specify the name of sample directory containing the results of step 1 and step 2." ,type=str)
-    parser.add_argument("-inputFraction", help = "Specify if the histogram has to be constructed for the full barcode or for a partial part. Options: full, partial", choices=["full", "partial"], default="full")
+    parser.add_argument("-inputFraction", help = "Specify if the histogram has to be constructed for the full barcode or for a partial part. Options: full, partial. Barcodes longer than 64 bases (e.g. full 90-mers) are about 20 times slower to compare than partial ones of up to 64.", choices=["full", "partial"], default="full")
     parser.add_argument("-inputLength", help= "If you have chosen partial in the inputFraction, enter the length of barcode you want to construct the histogram for.", type=int, default = 50)
+    parser.add_argument("-matrixOutput", help = "How the distances of each sampling are saved in LV_Analysis/<sample>_matrix: csv (sample_<n>.csv, one distance per line for every ordered pair of different barcodes, as before), condensed (sample_<n>.csv with each pair once, i < j, half the lines), binary (sample_<n>.gz, the condensed matrix as gzipped uint8) or none (only the histogram and mean).", choices=["csv", "condensed", "binary", "none"], default="csv")
     args = parser.parse_args()
 
     # Initialize the folders
@@ -96,17 +163,19 @@ if __name__ == "__main__":
         for line in reads:
             Barcode_raw.append(line.split()[0])
 
-    Barcode = np.unique(Barcode_raw)
+    # Keep the unique barcodes 2-bit packed (barcodeEncoding.py); they come in the order np.unique gives the strings
+    Barcode = unique_barcodes(encode_barcodes(Barcode_raw))
 
     del(Barcode_raw)
     gc.collect()
     
-    # Make samples from the data 
+    # Make samples from the data, only the sampled barcodes are decoded back to strings
     seed_value = 42
     random.seed(seed_value)
-    Sample_1 = np.random.choice(Barcode, size=5000, replace=False)
-    Sample_2 = np.random.choice(Barcode, size=5000, replace=False)
-    Sample_3 = np.random.choice(Barcode, size=5000, replace=False)
+    barcodeCount = len(Barcode[1])
+    Sample_1 = decode_barcodes(Barcode, np.random.choice(barcodeCount, size=5000, replace=False))
+    Sample_2 = decode_barcodes(Barcode, np.random.choice(barcodeCount, size=5000, replace=False))
+    Sample_3 = decode_barcodes(Barcode, np.random.choice(barcodeCount, size=5000, replace=False))
     del(Barcode)
     gc.collect()
 
@@ -116,15 +185,15 @@ if __name__ == "__main__":
     # Calculate the string distance matrix using Levenshtein distance (edit distance)
     print("Beginning to find Levenshtein distance for the {} Barcode for sample {}".format(args.inputFraction, args.sampleName))
 
-    # Initialize the matrix 
+    # Initialize the histograms 
     sample_means = []
-    matrices = []
+    histograms = []
 
     for count, samples in enumerate(Samples):
-        csvpath = os.path.join("LV_Analysis", f"{str(args.sampleName)}_matrix", f"sample_{count}.csv")
-        mean, matrix1 = analyze_LV(samples, csvpath, count+1)
+        matrixPath = os.path.join("LV_Analysis", f"{str(args.sampleName)}_matrix", f"sample_{count}" + (".gz" if args.matrixOutput == "binary" else ".csv"))
+        mean, histogram = analyze_LV(samples, matrixPath, count+1, args.matrixOutput)
         sample_means.append(mean)
-        matrices.append(matrix1)
+        histograms.append(histogram)
     
     if args.inputFraction == "partial": 
         pdf_filename = 'LV_Analysis/' + args.sampleName + '_LV_distance_{}.pdf'.format(args.inputLength)
@@ -133,13 +202,14 @@ if __name__ == "__main__":
 
     pdf = PdfPages(pdf_filename)
 
-    x_tick = np.arange(0, max(np.max(matrices[0]), np.max(matrices[1]), np.max(matrices[2])), 4) 
+    # The largest distance of the three samplings is the last bin with any pairs
+    x_tick = np.arange(0, max(np.nonzero(histogram)[0].max() for histogram in histograms), 4) 
 
     # Create and save the plots
     with PdfPages(pdf_filename) as pdf:
-        create_histogram(matrices[0], 'Sample 1', pdf, x_tick)
-        create_histogram(matrices[1], 'Sample 2', pdf, x_tick)
-        create_histogram(matrices[2], 'Sample 3', pdf, x_tick)
+        create_histogram(histograms[0], 'Sample 1', pdf, x_tick)
+        create_histogram(histograms[1], 'Sample 2', pdf, x_tick)
+        create_histogram(histograms[2], 'Sample 3', pdf, x_tick)
 
     print(f"PDF saved as {pdf_filename}")
     
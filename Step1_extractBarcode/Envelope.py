@@ -15,31 +15,68 @@ The output of this script will be:
 	4. A summary text file containing details about length of barcode dictionary, number of UMIs and number of bad Barcodes classified into different issues. 
 
 Command to run this file: python3 <path to Envelope.py> <path to Experiment directory> <path to Script> "--staggerFile" <path to Stagger File> "-r", "--checkVector", args.checkVector,"-l", args.barcodeLength, "-Q",args.minPhred ,"-e", args.excludeReads
+Any other option of parseFastqMain.py (e.g. --anchorReads, --homopolymerLength, --checkpointEvery, --chunkSize, --exportCombined) can be given after the two paths and is passed on to every sample.
+Samples are parsed in worker processes that call parseFastqMain.extract_sample, largest samples first, within the --cores budget.
+A run report with the status and time of each sample is written to analyzed/Step1_runReport.txt
 
 -----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------'''
 
 import os
-import subprocess
+import sys
 import csv
+import time
 from argparse import ArgumentParser
 import glob
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # Define the worker function for processing each sample
-def process_sample(sample_info, path_extraction_script, experiment_path):
+def process_sample(sample_info, experiment_path):
+    """
+    Function to extract the barcodes of one sample in this worker process, calling parseFastqMain as a library
+    so Biopython and regex are imported once per worker instead of once per sample.
+    Returns the sample name, its exit status, the seconds it took and the error message if it failed.
+    """
+    from parseFastqMain import build_parser, extract_sample
 
-    print(f"sample_info: {sample_info}")
-    sample, stagger, *additional_args = sample_info
-    print(f"sample: {sample}, stagger: {stagger}, additional_args: {additional_args}")
     sample, stagger, additional_args = sample_info
-    command = ["python3", path_extraction_script, experiment_path, sample, "-s", stagger] + additional_args
-    print(command)
-    subprocess.call(command)
+    command = [experiment_path, sample, "-s", stagger] + additional_args
+    print(f"sample: {sample}, arguments: {command}")
+    start = time.perf_counter()
+    status = 0
+    error = ""
+    try:
+        extract_sample(build_parser().parse_args(command))
+    except SystemExit as e:
+        # argparse exits on bad arguments
+        status = e.code if isinstance(e.code, int) else 1
+        error = "bad arguments" if status else ""
+    except Exception as e:
+        status = 1
+        error = f"{type(e).__name__}: {e}"
+        print(f"Sample {sample} failed with {error}")
+    return sample, status, time.perf_counter() - start, error
+
+
+def sample_input_bytes(experiment_path, sample):
+    """Function to return the total size of the FASTQ files of a sample, used to start the largest samples first."""
+    inFileNames = glob.glob(os.path.join(experiment_path, "raw", sample, "*fastq*"))
+    # A combined file from an earlier export is not parsed, so it is not counted
+    return sum(os.path.getsize(f) for f in inFileNames if not f.endswith("_combined.fastq.gz"))
+
+
+def write_run_report(reportFileName, report):
+    """Function to write the status, time and input size of every sample into a tab separated run report."""
+    with open(reportFileName, "w", newline = "") as reportFile:
+        writer = csv.writer(reportFile, delimiter = "\t")
+        writer.writerow(["sample", "stagger", "inputBytes", "status", "seconds", "error"])
+        for row in report:
+            writer.writerow(row)
 
 
 if __name__ == "__main__":
     # ... (your existing code to parse command line arguments)
-    parser = ArgumentParser()
+    parser = ArgumentParser(epilog = "Options of parseFastqMain.py that are not listed here are passed on to every sample as they are given.")
     parser.add_argument("experiment", help = "Specify the path to the experiment directory")
     parser.add_argument("pathScript", help = "Specify the path containing the script files.", type = str)
     parser.add_argument("--pathStaggerFile", help = "Specify the path to the file containing information on length of stagger for each sample")
@@ -49,14 +86,34 @@ if __name__ == "__main__":
     parser.add_argument("-Q", "--minPhred", help = "Specify the minimum phredscore required to include a readout. Filters reads with more than 5 bases before the barcode with low phredscore.", default = "14", type = str) 
     parser.add_argument("-a", "--asciioffset", help = "If PhredScore has letters, ascii offset will be 33, otherwise it will be 64. Most recent version of Illumina uses Phred Score of 33. ", default = "33", type = str)
     parser.add_argument("-e","--excludeReads", help = "If true, output txt.gz files containing reads excluded from the UMI and count files", default = "False", choices = ["True", "False"])
-    args = parser.parse_args()
-
-    # pathExtractionScript is the location to the file that has the script to extract barcode
-    pathExtractionScript = os.path.join(args.pathScript,"Step1_extractBarcode","parseFastqMain.py" )
-
+    parser.add_argument("--matcher", help = "Engine used to find the vector sequences. 'bitparallel' gives the same matches as 'legacy' in a single pass over the read.", default = "legacy", choices = ["bitparallel", "legacy"])
+    parser.add_argument("--aggregation", help = "How reads are counted per barcode: 'list' keeps one UMI per read, 'compact' keeps per-UMI counters to save memory.", default = "list", choices = ["list", "compact"])
+    parser.add_argument("--minMeanQuality", help = "If specified, also reject reads whose mean phredscore is below this value.", default = None, type = str)
+    parser.add_argument("--minBarcodeQuality", help = "If specified, also reject reads with any base in the barcode window below this phredscore.", default = None, type = str)
+    parser.add_argument("--qualityBatch", help = "If specified, check read qualities a batch at a time with NumPy.", action = 'store_true')
+    parser.add_argument("--tableFormat", help = "Format of the barcode count tables: text (tsv), a binary .npz that Step 2 loads directly (npz) or both.", default = "tsv", choices = ["tsv", "npz", "both"])
+    parser.add_argument("--gzipLevel", help = "gzip compression level (1-9) of the barcode tables. By default the level of parseFastqMain.py.", default = None, type = str)
+    parser.add_argument("--noExactFirst", help = "If specified, do not look for exact copies of the vectors before the mismatch search.", action = 'store_true')
+    parser.add_argument("--anchored", help = "If specified, look for each vector around its usual position first (see parseFastqMain.py --anchored).", action = 'store_true')
+    parser.add_argument("--readCacheSize", help = "Number of distinct read sequences whose vector matches are remembered per worker. 0 turns the cache off.", default = "100000", type = str)
+    parser.add_argument("--pairedEnd", help = "If specified, read the R1 and R2 files of each sample together (see parseFastqMain.py --pairedEnd).", action = 'store_true')
+    parser.add_argument("--umiFromHeader", help = "If specified, take the UMI from the end of the read name.", action = 'store_true')
+    parser.add_argument("--resume", help = "If specified, continue each sample from the checkpoint of an interrupted run (see parseFastqMain.py --resume).", action = 'store_true')
+    parser.add_argument("--incremental", help = "If specified, keep the results of each sample so lane files added later are parsed on their own and merged in (see parseFastqMain.py --incremental).", action = 'store_true')
+    parser.add_argument("--profile", help = "If specified, write a <sample>_profile.json with the time of each parse stage for every sample.", action = 'store_true')
+    parser.add_argument("-w", "--workers", help = "Number of processes used inside each sample to parse its reads.", default = "1", type = str)
+    parser.add_argument("--cores", help = "Total number of cores to use. Samples run at the same time as long as their workers fit in this budget. Default is all cores.", default = multiprocessing.cpu_count(), type = int)
+    args, passThroughArguments = parser.parse_known_args()
+
+    # The extraction script is imported from the Step1_extractBarcode folder of the script files
+    sys.path.insert(0, os.path.join(os.path.abspath(args.pathScript), "Step1_extractBarcode"))
+    from parseFastqMain import build_parser
+
+    # The samples run from the experiment directory, but the extraction changes its working directory, so keep the full path
+    experimentPath = os.path.abspath(args.experiment)
 
     #Move to experiment directory
-    os.chdir(args.experiment)
+    os.chdir(experimentPath)
 
     # Including Stagger details for each sample
     if args.pathStaggerFile is not None:
@@ -74,21 +131,69 @@ if __name__ == "__main__":
     print(samples)
 
     #Format additional arguments
-    additionalArguments = ["-checkVector", args.checkVector, "--minPhred", args.minPhred, "--asciioffset", args.asciioffset, "-barcodeLength", args.barcodeLength]
+    additionalArguments = ["-checkVector", args.checkVector, "--minPhred", args.minPhred, "--asciioffset", args.asciioffset, "-barcodeLength", args.barcodeLength, "--matcher", args.matcher, "--workers", args.workers, "--aggregation", args.aggregation, "--readCacheSize", args.readCacheSize, "--tableFormat", args.tableFormat]
     if args.includeReads:
         additionalArguments.extend(["--includeReads"])
     if args.excludeReads == "True":
         additionalArguments.extend(["--excludeReads"])
-
-    # Create a list of sample information tuples
+    if args.gzipLevel is not None:
+        additionalArguments.extend(["--gzipLevel", args.gzipLevel])
+    if args.minMeanQuality is not None:
+        additionalArguments.extend(["--minMeanQuality", args.minMeanQuality])
+    if args.minBarcodeQuality is not None:
+        additionalArguments.extend(["--minBarcodeQuality", args.minBarcodeQuality])
+    if args.qualityBatch:
+        additionalArguments.extend(["--qualityBatch"])
+    if args.profile:
+        additionalArguments.extend(["--profile"])
+    if args.anchored:
+        additionalArguments.extend(["--anchored"])
+    if args.noExactFirst:
+        additionalArguments.extend(["--noExactFirst"])
+    if args.pairedEnd:
+        additionalArguments.extend(["--pairedEnd"])
+    if args.resume:
+        additionalArguments.extend(["--resume"])
+    if args.incremental:
+        additionalArguments.extend(["--incremental"])
+    if args.umiFromHeader:
+        additionalArguments.extend(["--umiFromHeader"])
+    # The other options go to parseFastqMain as they are; they are checked here so a typo stops the run before any sample starts
+    additionalArguments.extend(passThroughArguments)
+    build_parser().parse_args([experimentPath, "sample"] + additionalArguments)
+
+    # Create a list of sample information tuples, largest samples first so the long ones do not start last
+    inputBytes = {sample: sample_input_bytes(experimentPath, sample) for sample in samples}
     sample_info_list = [(sample, stagger, additionalArguments) for sample, stagger in zip(samples, staggers)]
-
-    # Number of worker processes to use (adjust as needed)
-    num_processes = multiprocessing.cpu_count()
-
-    # Create a multiprocessing pool
-    with multiprocessing.Pool(num_processes) as pool:
-        # Distribute the work across processes for each sample
-        pool.starmap(process_sample, [(info, pathExtractionScript, args.experiment) for info in sample_info_list])
-
+    sample_info_list.sort(key = lambda info: inputBytes[info[0]], reverse = True)
+    staggerOf = dict(zip(samples, staggers))
+
+    # Number of samples processed at the same time, each one using --workers cores
+    num_processes = max(1, min(len(sample_info_list), args.cores // max(1, int(args.workers))))
+    print(f"Processing {len(sample_info_list)} samples, {num_processes} at a time with {args.workers} workers each")
+
+    # The samples are extracted in worker processes that import the extraction code once
+    report = []
+    with ProcessPoolExecutor(num_processes) as pool:
+        futures = [pool.submit(process_sample, info, experimentPath) for info in sample_info_list]
+        for future in futures:
+            try:
+                sample, status, seconds, error = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed for running out of memory)
+                sample = sample_info_list[futures.index(future)][0]
+                status, seconds, error = 1, 0.0, f"{type(e).__name__}: {e}"
+            report.append([sample, staggerOf[sample], inputBytes[sample], status, round(seconds, 2), error])
+            print(f"Sample {sample} finished with status {status} in {seconds:.1f} s")
+
+    # Writing the run report next to the analyzed samples
+    os.makedirs(os.path.join(experimentPath, "analyzed"), exist_ok = True)
+    reportFileName = os.path.join(experimentPath, "analyzed", "Step1_runReport.txt")
+    write_run_report(reportFileName, report)
+    print(f"Run report written to {reportFileName}")
+
+    failed = [row[0] for row in report if row[3] != 0]
+    if failed:
+        print(f"Samples that failed: {', '.join(failed)}")
+        sys.exit(1)
     print("All samples processed.")
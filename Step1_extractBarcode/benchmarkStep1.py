@@ -0,0 +1,174 @@
+'''
+Note about the script:
+Benchmark of the Step 1 read parsing on synthetic samples (see syntheticFastq.py), for measuring speedups without patient data.
+For every scale (number of reads) a synthetic sample is written once to <work directory>/raw/synthetic_<reads> and kept for later runs
+with the same generator options. parseBarcode_both or parseBarcode_before is then run over it in a fresh process per run, the same way
+parseFastqMain.py runs it (rejected reads are only counted), and the benchmark reports for each run:
+	1. the reads per second of the parse (best of --repeats runs)
+	2. the peak memory of the process (and of its workers with --workers)
+	3. the number of unique barcodes and an MD5 checksum of the barcode counts (barcode, reads, UMIs in table order) and reject counts
+
+With --compare the same samples are parsed with every value of one setting (e.g. each matcher, or list and compact aggregation),
+the speed of each value is given relative to the first one, and the checksums of all values must agree. The script exits with
+status 1 if they do not.
+
+Command to run this file: python3 <path to benchmarkStep1.py> <work directory> --scales 10000,100000,1000000 --compare matcher --report <path to report.json>
+-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------'''
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from extractionFunctions import parseBarcode_both, parseBarcode_before, RejectSink, DEFAULT_CHUNK_SIZE, is_compact_entry
+from vectorMatcher import MATCHERS, get_matcher, ExactFirstMatcher
+from syntheticFastq import write_synthetic_sample, add_generator_arguments, generator_options
+
+# Settings of a benchmark run that --compare can vary, with their values when they are not compared
+BENCHMARK_DEFAULTS = {"matcher": "bitparallel", "aggregation": "list", "exactFirst": "on", "readCacheSize": "100000", "workers": "1"}
+# Values compared by default for each setting
+COMPARE_VARIANTS = {
+    "matcher": list(MATCHERS),
+    "aggregation": ["list", "compact"],
+    "exactFirst": ["on", "off"],
+    "readCacheSize": ["0", "100000"],
+    "workers": ["1", "2", "4"],
+}
+
+
+def synthetic_sample(workDirectory, reads, options):
+    """
+    Function to return the lane files of the synthetic sample with the given number of reads, writing them first if they do not
+    exist yet or were made with other generator options.
+    """
+    sampleName = f"synthetic_{reads}"
+    sampleDirectory = os.path.join(workDirectory, "raw", sampleName)
+    optionsFile = os.path.join(sampleDirectory, "generator.json")
+    wanted = dict(options, reads=reads)
+    if os.path.exists(optionsFile):
+        with open(optionsFile) as savedOptions:
+            if json.load(savedOptions) == wanted:
+                return sorted(glob.glob(os.path.join(sampleDirectory, "*fastq.gz")))
+        for fileName in glob.glob(os.path.join(sampleDirectory, "*fastq.gz")):
+            os.remove(fileName)
+
+    print(f"Writing synthetic sample {sampleName}")
+    start = time.perf_counter()
+    fileNames = write_synthetic_sample(workDirectory, sampleName, reads, **options)
+    with open(optionsFile, "w") as savedOptions:
+        json.dump(wanted, savedOptions, indent=1)
+    print(f"Written {reads} reads in {time.perf_counter() - start:.1f} s")
+    return fileNames
+
+
+def results_checksum(results):
+    """
+    Function to checksum the outcome of a parse: the barcode counts in table order (as in the _counts table) and the number of
+    reads rejected for each issue. Runs that count the same reads the same way give the same checksum, whatever the matcher or aggregation.
+    """
+    checksum = hashlib.md5()
+    for barcode, values in results[0].items():
+        # Compact entries are [quality, reads, Counter of UMIs], list entries [quality, UMI, UMI, ...]
+        if is_compact_entry(values):
+            reads, umis = values[1], len(values[2])
+        else:
+            reads, umis = len(values) - 1, len(set(values[1:]))
+        checksum.update("{}\t{}\t{}\n".format(barcode, reads, umis).encode())
+    checksum.update(repr([len(rejected) for rejected in results[1:-3]] + [results[-1]]).encode())
+    return checksum.hexdigest()
+
+
+def run_benchmark(inFileNames, checkVector, stagger, barcodeLength, config):
+    """
+    Function to parse the given lane files once with the settings in config (see BENCHMARK_DEFAULTS) and measure it.
+    It runs in its own process, so the peak memory is that of this run only.
+    """
+    from parseFastqMain import peak_rss_mb
+    import resource
+
+    matcher = get_matcher(config["matcher"])
+    if config["exactFirst"] == "on":
+        matcher = ExactFirstMatcher(matcher)
+    parse = parseBarcode_both if checkVector == "both" else parseBarcode_before
+    rejectSinks = tuple(RejectSink() for _ in range(5 if checkVector == "both" else 4))
+
+    start = time.perf_counter()
+    results = parse(inFileNames, stagger, barcodeLength, 14, 33, matcher, int(config["workers"]), DEFAULT_CHUNK_SIZE,
+                    compact=config["aggregation"] == "compact", rejectSinks=rejectSinks, readCacheSize=int(config["readCacheSize"]))
+    seconds = time.perf_counter() - start
+    return {
+        "reads": results[-1],
+        "seconds": seconds,
+        "readsPerSecond": results[-1] / seconds if seconds > 0 else None,
+        "uniqueBarcodes": len(results[0]),
+        "checksum": results_checksum(results),
+        "peakRSSMB": {"main": peak_rss_mb(), "workers": peak_rss_mb(resource.RUSAGE_CHILDREN)},
+    }
+
+
+def measure(inFileNames, checkVector, stagger, barcodeLength, config, repeats):
+    """Function to run run_benchmark repeats times, each in a fresh process, and keep the fastest run and the highest memory."""
+    runs = []
+    for _ in range(repeats):
+        # A new process per run, so imports, caches and memory of earlier runs do not count
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            runs.append(executor.submit(run_benchmark, inFileNames, checkVector, stagger, barcodeLength, config).result())
+    best = min(runs, key=lambda run: run["seconds"])
+    best["peakRSSMB"] = {who: max(run["peakRSSMB"][who] for run in runs) for who in best["peakRSSMB"]}
+    if len({run["checksum"] for run in runs}) > 1:
+        best["checksum"] = "differs between repeats"
+    return best
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("workDirectory", help = "Specify the directory the synthetic samples are written to and kept in")
+    parser.add_argument("--scales", help = "Comma separated numbers of reads of the synthetic samples to benchmark.", default = "10000,100000", type = str)
+    parser.add_argument("--compare", help = "Setting whose values are compared with each other on every sample.", default = None, choices = list(COMPARE_VARIANTS))
+    parser.add_argument("--variants", help = "Comma separated values of the --compare setting. Default: all values listed in COMPARE_VARIANTS.", default = None, type = str)
+    parser.add_argument("-checkVector", help = "Parse the reads like checkVector both or before.", default = "both", choices = ["both", "before"])
+    parser.add_argument("--repeats", help = "Number of times each run is repeated; the fastest one is reported.", default = 1, type = int)
+    parser.add_argument("--report", help = "If specified, also write all measurements to this JSON file.", default = None, type = str)
+    for setting, value in BENCHMARK_DEFAULTS.items():
+        parser.add_argument("--" + setting, help = f"Value of {setting} when it is not compared.", default = value, type = str)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    options = generator_options(args)
+    baseConfig = {setting: getattr(args, setting) for setting in BENCHMARK_DEFAULTS}
+    if args.compare is not None:
+        variants = args.variants.split(",") if args.variants else COMPARE_VARIANTS[args.compare]
+    else:
+        variants = ["default"]
+
+    report = []
+    mismatches = []
+    print("\t".join(["reads", args.compare or "run", "seconds", "reads/s", "relative", "peakMB", "workersPeakMB", "uniqueBarcodes", "checksum"]))
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        inFileNames = synthetic_sample(os.path.abspath(args.workDirectory), scale, options)
+        scaleRuns = []
+        for variant in variants:
+            config = dict(baseConfig, **({args.compare: variant} if args.compare else {}))
+            run = measure(inFileNames, args.checkVector, args.stagger, args.barcodeLength, config, args.repeats)
+            run.update({"scale": scale, "variant": variant, "config": config})
+            run["relative"] = scaleRuns[0]["seconds"] / run["seconds"] if scaleRuns and run["seconds"] > 0 else 1.0
+            scaleRuns.append(run)
+            print("\t".join([str(scale), variant, f"{run['seconds']:.2f}", f"{run['readsPerSecond']:.0f}", f"{run['relative']:.2f}x",
+                             f"{run['peakRSSMB']['main']:.0f}", f"{run['peakRSSMB']['workers']:.0f}", str(run["uniqueBarcodes"]), run["checksum"][:12]]))
+        # Every value of the compared setting has to give the same counts
+        if len({run["checksum"] for run in scaleRuns}) > 1:
+            mismatches.append(scale)
+            print(f"Checksums differ between {args.compare} values at {scale} reads")
+        report.extend(scaleRuns)
+
+    if args.report is not None:
+        with open(args.report, "w") as reportFile:
+            json.dump({"checkVector": args.checkVector, "generator": options, "runs": report}, reportFile, indent=2)
+        print(f"Report written to {args.report}")
+
+    if mismatches:
+        sys.exit(1)
@@ -5,14 +5,41 @@ import gzip
 import os 
 import regex as re #not regular re from python, different package!
 from collections import Counter
-from itertools import zip_longest
+from itertools import zip_longest, islice
+from collections import deque, OrderedDict
+import multiprocessing
+import threading
+import queue
 import math
+import time
+import uuid
+import pickle
+import json
+import hashlib
+import numpy as np
+
+# gzip compression level of the barcode tables (parseFastqMain.py --gzipLevel)
+DEFAULT_GZIP_LEVEL = 6
+# Number of FASTQ records handed to a worker at a time when a sample is parsed with more than one worker
+DEFAULT_CHUNK_SIZE = 50000
+# Number of reads matched before their qualities are checked together
+QUALITY_BATCH_SIZE = 4096
+# Number of reads classified between two checkpoints of a sample
+DEFAULT_CHECKPOINT_INTERVAL = 5000000
+# Length of the seeds used to find where the reverse complement of R2 overlaps R1 in paired-end mode
+PAIR_SEED_LENGTH = 12
+# Largest fraction of mismatched bases allowed in the overlap of R1 and R2
+PAIR_MAX_MISMATCH = 0.1
+# Stages whose time is kept in the parse statistics under ("seconds", stage), in the order they happen to a read
+PARSE_STAGES = ("read", "match", "quality", "classify", "merge", "write")
 
 
 def combine_fastq(inFileNames):
     """
     Combine multiple gzipped FASTQ files into a single gzipped FASTQ file,
     preserving the structure of each FASTQ record.
+    The parsers stream the lane files directly with stream_fastq, so this is only needed
+    to export the combined file (parseFastqMain.py --exportCombined).
 
     Args:
     inFileNames (list): List of input FASTQ file names (gzipped)
@@ -20,17 +47,11 @@ def combine_fastq(inFileNames):
     Returns:
     str: Name of the output file
     """
-    # Get the absolute path of the first input file
-    first_file_path = os.path.abspath(inFileNames[0])
-    
     # Get the directory of the first input file
-    input_directory = os.path.dirname(first_file_path)
-    
-    # Get the name of the folder containing the input files
-    folder_name = os.path.basename(input_directory)
+    input_directory = os.path.dirname(os.path.abspath(inFileNames[0]))
 
     # Create the output filename using the folder name
-    outFileName = f"{folder_name}_combined.fastq.gz"
+    outFileName = combined_file_name(inFileNames)
 
     # Create the full path for the output file
     outFilePath = os.path.join(input_directory, outFileName)
@@ -75,6 +96,163 @@ def combine_fastq(inFileNames):
     return outFileName
 
 
+def combined_file_name(inFileNames):
+    """
+    Return the name combine_fastq gives to the combined file of a sample: <folder>_combined.fastq.gz
+    """
+    return f"{os.path.basename(os.path.dirname(os.path.abspath(inFileNames[0])))}_combined.fastq.gz"
+
+
+def stream_fastq(inFileNames):
+    """
+    Stream the records of multiple gzipped FASTQ files without writing them to disk.
+    Records are taken round-robin, one from each lane file in turn, which is the same order
+    combine_fastq writes them in. A <folder>_combined.fastq.gz left over from an export is skipped
+    so its reads are not counted twice.
+
+    Args:
+    inFileNames (list): List of input FASTQ file names (gzipped)
+
+    Yields:
+    tuple: (title, sequence, quality) for each FASTQ record
+    """
+    combinedName = combined_file_name(inFileNames) if inFileNames else None
+    handles = [gzip.open(f, 'rt') for f in inFileNames if os.path.basename(f) != combinedName]
+    try:
+        iterators = [FastqGeneralIterator(handle) for handle in handles]
+        while iterators:
+            still_open = []
+            for iterator in iterators:
+                seq_record = next(iterator, None)
+                if seq_record is not None:
+                    yield seq_record
+                    still_open.append(iterator)
+            # Drop the lane files that have reached EOF
+            iterators = still_open
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def pair_fastq_files(inFileNames):
+    """
+    Pair the R1 and R2 files of a paired-end sample by their Illumina names (..._R1_001.fastq.gz / ..._R2_001.fastq.gz).
+
+    Args:
+    inFileNames (list): FASTQ file names of the sample, R1 and R2 together
+
+    Returns:
+    list: (R1 file, R2 file) tuples in the order of the R1 files
+    """
+    pairs = []
+    for fileName in inFileNames:
+        name = os.path.basename(fileName)
+        if "_R1" not in name:
+            continue
+        mateName = os.path.join(os.path.dirname(fileName), "_R2".join(name.rsplit("_R1", 1)))
+        if mateName not in inFileNames:
+            raise ValueError(f"No R2 file found for {fileName} (expected {mateName})")
+        pairs.append((fileName, mateName))
+    if not pairs:
+        raise ValueError("No R1/R2 file pairs found in: {}".format(", ".join(inFileNames)))
+    return pairs
+
+
+_COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+
+def extend_with_mate(read1, read2):
+    """
+    Extend an R1 record with the part of its mate that R1 did not reach.
+    The reverse complement of R2 covers the end of the amplicon, so where it overlaps the end of R1
+    the bases after R1 (with their R2 qualities) are appended to R1. R1 is returned unchanged when the 
+    mate adds nothing or no overlap is found: a seed from the start of the reversed mate must occur in R1 
+    with at most PAIR_MAX_MISMATCH of the overlapping bases differing.
+
+    Args:
+    read1 (tuple): (title, sequence, quality) of R1
+    read2 (tuple): (title, sequence, quality) of R2
+
+    Returns:
+    tuple: (title, sequence, quality) of R1, extended if the mate overlaps it
+    """
+    title, sequence, quality = read1
+    mateSequence = read2[1].translate(_COMPLEMENT)[::-1]
+    mateQuality = read2[2][::-1]
+
+    # Two seeds in case the first one carries a sequencing error
+    for seedStart in (0, PAIR_SEED_LENGTH):
+        seed = mateSequence[seedStart:seedStart + PAIR_SEED_LENGTH]
+        if len(seed) < PAIR_SEED_LENGTH:
+            break
+        position = sequence.find(seed)
+        while position >= 0:
+            mateStart = position - seedStart
+            overlap = len(sequence) - mateStart
+            if mateStart >= 0 and overlap > 0:
+                mismatches = sum(1 for a, b in zip(sequence[mateStart:], mateSequence) if a != b)
+                if mismatches <= PAIR_MAX_MISMATCH * min(overlap, len(mateSequence)):
+                    if overlap >= len(mateSequence):
+                        return read1
+                    return title, sequence + mateSequence[overlap:], quality + mateQuality[overlap:]
+            position = sequence.find(seed, position + 1)
+    return read1
+
+
+def read_name(title):
+    """Return the name of a read without its comment or an old style /1 or /2 mate suffix, so mates have the same name."""
+    name = title.split(None, 1)[0]
+    return name[:-2] if name.endswith(("/1", "/2")) else name
+
+
+def stream_fastq_paired(filePairs, pairStats=None):
+    """
+    Stream paired-end reads as single records, reading each R1/R2 file pair in lockstep and the lanes
+    round-robin as in stream_fastq. Each R1 read is extended with the end of the amplicon from its 
+    mate when R1 is too short to reach it (see extend_with_mate), so the records can be classified 
+    like single-end reads.
+
+    Args:
+    filePairs (list): (R1 file, R2 file) tuples, e.g. from pair_fastq_files
+    pairStats (Counter): optional, counts ('pairs', 'read') and ('pairs', 'extended') are added to it
+
+    Yields:
+    tuple: (title, sequence, quality) for each read pair
+    """
+    handles = [(gzip.open(read1File, 'rt'), gzip.open(read2File, 'rt')) for read1File, read2File in filePairs]
+    if pairStats is None:
+        pairStats = Counter()
+    try:
+        iterators = [(FastqGeneralIterator(handle1), FastqGeneralIterator(handle2)) for handle1, handle2 in handles]
+        while iterators:
+            still_open = []
+            for iterator1, iterator2 in iterators:
+                read1 = next(iterator1, None)
+                read2 = next(iterator2, None)
+                if read1 is None or read2 is None:
+                    if read1 is not None or read2 is not None:
+                        raise ValueError("R1 and R2 files do not have the same number of reads")
+                    continue
+                if read_name(read1[0]) != read_name(read2[0]):
+                    raise ValueError(f"Reads {read1[0]} and {read2[0]} are not mates")
+                record = extend_with_mate(read1, read2)
+                pairStats[("pairs", "read")] += 1
+                if record is not read1:
+                    pairStats[("pairs", "extended")] += 1
+                yield record
+                still_open.append((iterator1, iterator2))
+            iterators = still_open
+    finally:
+        for handle1, handle2 in handles:
+            handle1.close()
+            handle2.close()
+
+
+def header_umi(title, separator=":"):
+    """Return the UMI written at the end of the read name, after the last separator (e.g. @...:1101:1000:2000:ACGTAC 1:N:0:1)."""
+    return title.split(None, 1)[0].rsplit(separator, 1)[-1]
+
+
 def find_best_match(sequence, pattern, max_errors, before_or_after):
     """
     This function searches for the best match of the pattern in the sequence, allowing for partial matches
@@ -118,131 +296,480 @@ def find_best_match(sequence, pattern, max_errors, before_or_after):
     return None, [None, None], None
 
 
-def parseBarcode_both(inFileName, staggerLength, barcodeLength, minQuality_Phred, asciioffset):
-	"""Function to parse FASTQ file and create dictionary of key:value pairs. Will only extract reads that contain the vector sequence before and after the barcode, allowing up to 4 or 5 mismatches respectively. 
-	Each key is a unique barcode sequence. Each value is a list containing the Phredscore associated with the barcode
-	and the UMIs (first 4-6 bases) associated with the read. Function will also output the list of reads that are missing vector sequence before the barcode, missing the vector sequence after the barcode, have a bad Qscore before the barcode or contain a short UMI or primer binding sequence. 
-	This is what barcode_dict will look like 
-	barcode_dict = {
-    "barcode_sequence": [
-        "quality_score_of_barcode",
-        "sequence_before_stagger",
-        "sequence_before_stagger",
-        "sequence_before_stagger",
-        ... potentially more sequences
-    ],
-    ... potentially more barcode entries
+def build_homopolymer_filter(runLength=4, bases="ATGC", nRunLength=2):
+    """
+    Build the rules used by find_homopolymer to reject reads with homopolymers or unknown nucleotides.
+    The defaults reproduce the original checks: AAAA, TTTT, GGGG, CCCC and NN anywhere in the read.
+
+    Args:
+    runLength (int): Length of a homopolymer run that rejects the read
+    bases (str): Bases checked for homopolymer runs, in the order they are reported
+    nRunLength (int): Length of a run of N that rejects the read, 0 to not check for N
+
+    Returns:
+    tuple: (rule name, run) pairs, the rule name being the run itself (e.g. 'AAAA')
+    """
+    runs = [base * runLength for base in bases]
+    if nRunLength > 0:
+        runs.append("N" * nRunLength)
+    return tuple((run, run) for run in runs)
+
+
+# Rules used when no filter is given, same as the original AAAA/TTTT/GGGG/CCCC/NN checks
+DEFAULT_HOMOPOLYMER_FILTER = build_homopolymer_filter()
+
+
+def find_homopolymer(sequence, homopolymerFilter=DEFAULT_HOMOPOLYMER_FILTER):
+    """
+    Return the name of the first rule of homopolymerFilter whose run occurs in sequence, or None if the read passes.
+    Each rule is a plain substring test, so a read is scanned in C rather than with one regex per rule.
+    """
+    for rule, run in homopolymerFilter:
+        if run in sequence:
+            return rule
+    return None
+
+
+class ReadCache:
+	"""Bounded LRU cache of what the classify functions work out from a read sequence alone: 
+	where the vectors are and which homopolymer rule (if any) rejects it. Identical reads, which amplicon 
+	libraries are full of, are then matched once. At most maxSize sequences are kept, the least recently 
+	used ones are dropped first. Hits, misses and evictions are counted and handed over with take_stats().
+	Only maxSize and a token naming the sample are sent to pool workers; each worker keeps its own 
+	entries for that sample across chunks (see process_read_cache).
+	"""
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.token = uuid.uuid4().hex
+		self.entries = OrderedDict()
+		self.stats = Counter()
+
+	def __getstate__(self):
+		return {"maxSize": self.maxSize, "token": self.token}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.entries = OrderedDict()
+		self.stats = Counter()
+
+	def get(self, sequence):
+		outcome = self.entries.get(sequence)
+		if outcome is None:
+			self.stats[("readCache", "misses")] += 1
+		else:
+			self.stats[("readCache", "hits")] += 1
+			self.entries.move_to_end(sequence)
+		return outcome
+
+	def put(self, sequence, outcome):
+		self.entries[sequence] = outcome
+		if len(self.entries) > self.maxSize:
+			self.entries.popitem(last=False)
+			self.stats[("readCache", "evictions")] += 1
+
+	def take_stats(self):
+		stats, self.stats = self.stats, Counter()
+		return stats
+
+
+# The read cache this process is filling, so a worker keeps its entries from one chunk of a sample to the next
+_process_read_cache = None
+
+
+def process_read_cache(readCache):
+	"""Function to return the cache this process keeps for the sample readCache belongs to, starting a new one 
+	when a different sample (token) comes in. Returns None when readCache is None.
+	"""
+	global _process_read_cache
+	if readCache is None:
+		return None
+	if _process_read_cache is None or _process_read_cache.token != readCache.token:
+		_process_read_cache = readCache
+	return _process_read_cache
+
+
+def record_barcode(barcode_dict, seq_record, barcodeStart, barcodeLength, umi, compact=False):
+	"""Function to add one accepted read to barcode_dict.
+	In the default list mode each barcode maps to [quality of its first read, UMI, UMI, ...] with one UMI per read. 
+	In compact mode each barcode maps to [quality of its first read, number of reads, Counter of UMIs], 
+	so memory grows with the number of unique (barcode, UMI) pairs instead of the number of reads.
+	"""
+	barcode = seq_record[1][barcodeStart:barcodeStart + barcodeLength] #recording barcode
+	entry = barcode_dict.get(barcode)
+	if entry is None:
+		quality = seq_record[2][barcodeStart:barcodeStart + barcodeLength] # record quality score of the first read
+		barcode_dict[barcode] = [quality, 1, Counter({umi: 1})] if compact else [quality, umi]
+	elif compact:
+		entry[1] += 1
+		entry[2][umi] += 1
+	else:
+		entry.append(umi)
+
+
+def is_compact_entry(values):
+	"""Function to tell if a barcode_dict value was made in compact mode ([quality, reads, Counter of UMIs]).
+	"""
+	return isinstance(values[-1], Counter)
+
+
+class RejectSink:
+	"""Collects the reads rejected for one reason while a sample is being parsed.
+	With an outFileName every rejected (title, sequence, quality) record is appended to that gzipped, tab delimited file 
+	as soon as it is classified, in the same format as writeOutFileBadSeqRecord. Without one only the number of reads is kept. 
+	Either way memory does not grow with the number of rejected reads. len() gives the number of reads rejected.
+	With resumeSize (from a Checkpoint) the file is cut back to that size and written on from there instead of being started again.
+	"""
+	def __init__(self, outFileName=None, resumeSize=None):
+		self.outFileName = outFileName
+		self.count = 0
+		if outFileName is None:
+			self.out_file = None
+		elif resumeSize is not None:
+			# Drop what was written after the checkpoint, the reads are classified again
+			with open(outFileName, 'r+b') as partial:
+				partial.truncate(resumeSize)
+			self.out_file = gzip.open(outFileName, 'at')
+		else:
+			self.out_file = gzip.open(outFileName, 'wt')
+
+	def append(self, seqRecord):
+		self.count += 1
+		if self.out_file is not None:
+			self.out_file.write("\t".join(seqRecord) + "\n")
+
+	def extend(self, seqRecords):
+		# A count-only sink from a worker only carries its count
+		if isinstance(seqRecords, RejectSink):
+			self.count += seqRecords.count
+		else:
+			for seqRecord in seqRecords:
+				self.append(seqRecord)
+
+	def __len__(self):
+		return self.count
+
+	def checkpoint(self):
+		# End the current gzip member so everything written so far is on disk and return the file size (None without a file).
+		# Later reads go into a new member of the same file, which gzip reads back as one stream.
+		if self.out_file is None:
+			return None
+		self.out_file.close()
+		size = os.path.getsize(self.outFileName)
+		self.out_file = gzip.open(self.outFileName, 'at')
+		return size
+
+	def close(self):
+		if self.out_file is not None:
+			self.out_file.close()
+			self.out_file = None
+
+
+def worker_reject_sinks(rejectSinks):
+	"""Function to give the workers of classify_reads_parallel something to collect rejected reads in.
+	Sinks that write a file become plain lists that are written out when the chunk is merged; count-only sinks stay count-only.
+	"""
+	if rejectSinks is None:
+		return None
+	return tuple(None if sink is None or sink.out_file is not None else RejectSink() for sink in rejectSinks)
+
+
+def build_quality_gate(minPhred=14, asciioffset=33, maxLowQuality=5, minMeanQuality=None, minBarcodeQuality=None, barcodeLength=None, batched=False):
+	"""Function to build the quality gate used by check_quality. A read fails the first policy it breaks, checked in this order:
+		vectorLowQuality: maxLowQuality or more bases of the GFP vector before the barcode have a Phred score < minPhred (the original check)
+		meanQuality: the mean Phred score of the whole read is < minMeanQuality (None to skip)
+		barcodeMinQuality: a base of the barcode window (barcodeLength bases after the vector) has a Phred score < minBarcodeQuality (None to skip)
+	With batched = True the qualities of a whole batch of reads are checked at once with NumPy, otherwise read by read on bytes.
+	"""
+	def bytes_at_least(minimum):
+		# Quality characters whose Phred score is at least minimum; deleting them leaves only the low quality bases
+		return bytes(range(min(max(asciioffset + minimum, 0), 256), 256))
+
+	return {
+		"minPhred": minPhred,
+		"asciioffset": asciioffset,
+		"maxLowQuality": maxLowQuality,
+		"minMeanQuality": minMeanQuality,
+		"minBarcodeQuality": minBarcodeQuality,
+		"barcodeLength": barcodeLength,
+		"batched": batched,
+		"vectorGood": bytes_at_least(minPhred),
+		"barcodeGood": bytes_at_least(minBarcodeQuality) if minBarcodeQuality is not None else None,
 	}
 
+
+# Names of the quality policies, in the order they are checked
+QUALITY_POLICIES = ("vectorLowQuality", "meanQuality", "barcodeMinQuality")
+
+
+def check_quality(qualityGate, windows):
+	"""Function to check the quality of a batch of reads against qualityGate (from build_quality_gate).
+	windows is a list of (quality string, vector start, vector end) for each read.
+	Returns a list with, for each read, the name of the policy it fails or None if it passes.
+	"""
+	if qualityGate["batched"] and windows:
+		return check_quality_batched(qualityGate, windows)
+
+	asciioffset = qualityGate["asciioffset"]
+	maxLowQuality = qualityGate["maxLowQuality"]
+	minMeanQuality = qualityGate["minMeanQuality"]
+	barcodeLength = qualityGate["barcodeLength"]
+	vectorGood = qualityGate["vectorGood"]
+	barcodeGood = qualityGate["barcodeGood"]
+
+	failed = []
+	for quality, vectorStart, vectorEnd in windows:
+		quality = quality.encode('ascii')
+		# Deleting every good quality character leaves the low quality bases of the window
+		if len(quality[vectorStart:vectorEnd].translate(None, vectorGood)) >= maxLowQuality:
+			failed.append("vectorLowQuality")
+		elif minMeanQuality is not None and sum(quality) < (minMeanQuality + asciioffset) * len(quality):
+			failed.append("meanQuality")
+		elif barcodeGood is not None and quality[vectorEnd:vectorEnd + barcodeLength].translate(None, barcodeGood):
+			failed.append("barcodeMinQuality")
+		else:
+			failed.append(None)
+	return failed
+
+
+def check_quality_batched(qualityGate, windows):
+	"""Function to check a batch of reads for check_quality with NumPy. All quality strings are joined into one byte array 
+	and every window count or sum is taken from prefix sums over it, so there is no Python loop over the bases.
+	"""
+	asciioffset = qualityGate["asciioffset"]
+	qualities = [window[0] for window in windows]
+	lengths = np.fromiter((len(quality) for quality in qualities), dtype=np.int64, count=len(qualities))
+	readStarts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+	vectorStarts = readStarts + np.fromiter((window[1] for window in windows), dtype=np.int64, count=len(windows))
+	vectorEnds = readStarts + np.fromiter((window[2] for window in windows), dtype=np.int64, count=len(windows))
+	phred = np.frombuffer("".join(qualities).encode('ascii'), dtype=np.uint8).astype(np.int64) - asciioffset
+
+	def window_sums(values, starts, ends):
+		# Sum of values[start:end] for every window, from a prefix sum with a leading 0
+		prefix = np.concatenate(([0], np.cumsum(values)))
+		return prefix[ends] - prefix[starts]
+
+	failed = np.full(len(windows), None, dtype=object)
+	lowVector = window_sums(phred < qualityGate["minPhred"], vectorStarts, vectorEnds) >= qualityGate["maxLowQuality"]
+	failed[lowVector] = "vectorLowQuality"
+	undecided = ~lowVector
+
+	if qualityGate["minMeanQuality"] is not None:
+		lowMean = window_sums(phred, readStarts, readStarts + lengths) < qualityGate["minMeanQuality"] * lengths
+		failed[undecided & lowMean] = "meanQuality"
+		undecided &= ~lowMean
+
+	if qualityGate["minBarcodeQuality"] is not None:
+		# The barcode window stops at the end of the read, like a string slice
+		barcodeEnds = np.minimum(vectorEnds + qualityGate["barcodeLength"], readStarts + lengths)
+		lowBarcode = window_sums(phred < qualityGate["minBarcodeQuality"], vectorEnds, barcodeEnds) > 0
+		failed[undecided & lowBarcode] = "barcodeMinQuality"
+
+	return failed.tolist()
+
+
+def classify_reads_both(records, staggerLength, barcodeLength, minQuality_Phred, asciioffset, matcher=find_best_match, homopolymerFilter=DEFAULT_HOMOPOLYMER_FILTER, compact=False, qualityGate=None, readCache=None, umiSeparator=None, rejectSinks=None):
+	"""Function to classify an iterable of (title, sequence, quality) FASTQ records for parseBarcode_both. 
+	It can be given the whole file or one chunk of it, and returns the barcode dictionary, the rejected reads, 
+	a Counter of why reads were rejected, keyed by (category, rule) e.g. ('badBarcode', 'AAAA'), a Counter of parse statistics 
+	(the seconds spent in each of PARSE_STAGES, keyed ('seconds', stage), plus any counts the matcher keeps) and the number of reads seen. 
+	compact selects how the barcode dictionary stores the UMIs (see record_barcode). 
+	rejectSinks optionally gives (missingVectorBefore, missingVectorAfter, badQscore, badLength, badBarcode) objects with an append method, 
+	e.g. RejectSink; a list is used for any that is None. 
+	qualityGate (from build_quality_gate) sets the quality policies; by default it is the original check on minQuality_Phred.
+	readCache (a ReadCache) optionally remembers the vector matches and homopolymer rule of each read sequence, so identical reads are only matched once.
+	With umiSeparator the UMI is taken from the end of the read name (see header_umi) instead of the bases before the vector.
 	"""
 	barcode_dict = {}
 	# creating dictionaries for issues with identifying vector sequences or low quality barcode sequencing
-	missingVectorBefore = []
-	missingVectorAfter = []
-	badQscore = []
-	badLength = []
-	badBarcode = []
+	missingVectorBefore, missingVectorAfter, badQscore, badLength, badBarcode = [sink if sink is not None else [] for sink in (rejectSinks or (None,) * 5)]
+	rejectReasons = Counter()
+	parseStats = Counter()
+	if qualityGate is None:
+		qualityGate = build_quality_gate(minQuality_Phred, asciioffset, barcodeLength=barcodeLength)
 
 	vectorBeforeBarcode = "TCGACTAAACGCGCTACTTGAT" #
 	vectorAfterBarcode = "ATCCTACTTGTACAGCTCGT"
 	tot_reads = 0
 
-	fastQ_file = combine_fastq(inFileName)
 	find_after_barcode = staggerLength + len(vectorBeforeBarcode) + barcodeLength
 	find_before_barcode = int(math.floor(staggerLength + len(vectorBeforeBarcode) + (barcodeLength / 2)))
-	with gzip.open(fastQ_file, 'rt') as fastq:
-		print("Started with file:{}".format(fastQ_file))
-		for seq_record in FastqGeneralIterator(fastq):
-			tot_reads += 1
+	readCache = process_read_cache(readCache)
+	for batch in timed_chunks(records, QUALITY_BATCH_SIZE, parseStats):
+		tot_reads += len(batch)
+		startTime = time.perf_counter()
+
+		# Find the vectors of every read in the batch first, so the quality of all reads with both vectors can be checked together
+		matches = []
+		for seq_record in batch:
+			# An identical read seen before gets the same matches and homopolymer rule
+			outcome = readCache.get(seq_record[1]) if readCache is not None else None
+			if outcome is None:
+				# Find best match for vector before barcode
+				VBB_match, VBB_position, VBB_errors = matcher(seq_record[1][:find_before_barcode], vectorBeforeBarcode, 4, "before")
 
-			# Find best match for vector before barcode
-			VBB_match, VBB_position, VBB_errors = find_best_match(seq_record[1][:find_before_barcode], vectorBeforeBarcode, 4, "before")
+				# Find best match for vector after barcode
+				VBA_match, VBA_position, VBA_errors = matcher(seq_record[1][find_after_barcode:], vectorAfterBarcode, 5, "after")
+
+				# This checks for homopolymers or unknown nucleotides in the sequence.
+				outcome = (bool(VBB_match), VBB_position, bool(VBA_match), find_homopolymer(seq_record[1], homopolymerFilter))
+				if readCache is not None:
+					readCache.put(seq_record[1], outcome)
+			matches.append(outcome)
+		matchedTime = time.perf_counter()
 
-			# Find best match for vector after barcode
-			VBA_match, VBA_position, VBA_errors = find_best_match(seq_record[1][find_after_barcode:], vectorAfterBarcode, 5, "after")
+		#  This checks the quality of the reads with both vectors, by default whether 5 or more positions in the matched region have a Phred score < minPhred within the GFP primer site.
+		qualityFailures = iter(check_quality(qualityGate, [(seq_record[2], VBB_position[0], VBB_position[1]) for seq_record, (VBB_found, VBB_position, VBA_found, homopolymerRule) in zip(batch, matches) if VBB_found and VBA_found]))
+		checkedTime = time.perf_counter()
 
-			if VBB_match and VBA_match:
-				#  This checks if 5 or more positions in the matched region have a Phred score < minPhred within the GFP primer site.
-				if sum([ord(i) - asciioffset < minQuality_Phred for i in seq_record[2][VBB_position[0]:VBB_position[1]]]) >= 5:
+		for seq_record, (VBB_found, VBB_position, VBA_found, homopolymerRule) in zip(batch, matches):
+			if VBB_found and VBA_found:
+				qualityPolicy = next(qualityFailures)
+				if qualityPolicy is not None:
 					badQscore.append(seq_record) #Skip reads where conditions above are not fulfilled.
+					rejectReasons[("badQscore", qualityPolicy)] += 1
+					continue
 
-				# This checks for homopolymers or unknown nucleotides in the sequence.
-				elif(len(re.findall("(AAAA)", seq_record[1])) > 0 or \
-				len(re.findall("(TTTT)", seq_record[1])) > 0 or \
-				len(re.findall("(GGGG)", seq_record[1])) > 0 or \
-				len(re.findall("(CCCC)", seq_record[1])) > 0 or \
-				len(re.findall("(NN)", seq_record[1])) > 0):
+				# Reads with homopolymers or unknown nucleotides are bad barcodes
+				if homopolymerRule is not None:
 					badBarcode.append(seq_record)
+					rejectReasons[("badBarcode", homopolymerRule)] += 1
 
 				# If the sequence passes all checks, this extracts the barcode and updates the barcode_dict.
 				else:
-					
-					barcode = seq_record[1][VBB_position[1]:VBB_position[1]+ barcodeLength] #recording barcode
-					if barcode not in barcode_dict:
-						barcode_dict[barcode] = [seq_record[2][VBB_position[1]:VBB_position[1]+ barcodeLength]] # record quality score 
-						barcode_dict[barcode].append(seq_record[1][0:VBB_position[0]-staggerLength]) # record stagger sequence
-					elif barcode in barcode_dict:
-						barcode_dict[barcode].append(seq_record[1][0:VBB_position[0]-staggerLength])
-			elif VBB_match and not VBA_match:
+					# record the barcode with its quality score and stagger sequence
+					umi = header_umi(seq_record[0], umiSeparator) if umiSeparator else seq_record[1][0:VBB_position[0]-staggerLength]
+					record_barcode(barcode_dict, seq_record, VBB_position[1], barcodeLength, umi, compact)
+			elif VBB_found and not VBA_found:
 				missingVectorAfter.append(seq_record)
-			elif VBA_match and not VBB_match:
+			elif VBA_found and not VBB_found:
 				missingVectorBefore.append(seq_record)
 
-	print("Completed file " + fastQ_file)
+		# Time is kept per batch rather than per read so it costs next to nothing
+		parseStats[("seconds", "match")] += matchedTime - startTime
+		parseStats[("seconds", "quality")] += checkedTime - matchedTime
+		parseStats[("seconds", "classify")] += time.perf_counter() - checkedTime
 
-	return barcode_dict, missingVectorBefore, missingVectorAfter, badQscore, badLength, badBarcode, tot_reads
+	# Matchers that keep their own counts (e.g. vectorMatcher.AnchoredMatcher) add them to the parse statistics
+	if hasattr(matcher, "take_stats"):
+		parseStats.update(matcher.take_stats())
+	if readCache is not None:
+		parseStats.update(readCache.take_stats())
 
+	return barcode_dict, missingVectorBefore, missingVectorAfter, badQscore, badLength, badBarcode, rejectReasons, parseStats, tot_reads
 
-def parseBarcode_before(inFileName, staggerLength, barcodeLength, minPhred, asciioffset):
-	# Function to parse FASTQ file and create dictionary of key:value pairs. Will only extract reads that contain the vector sequence before the barcode allowing up to 4 mismatches. 
-	# Each key is a unique barcode sequence. Each value is a list containing the Phredscore associated with the barcode
-	# and the UMIs (first 4-6 bases) associated with the read. Function will also output the list of reads that are missing vector sequence before the barcode, missing the vector sequence after the barcode, have a bad Qscore before the barcode or contain a short UMI or primer binding sequence.
+
+def parseBarcode_both(inFileName, staggerLength, barcodeLength, minQuality_Phred, asciioffset, matcher=find_best_match, workers=1, chunkSize=DEFAULT_CHUNK_SIZE, homopolymerFilter=DEFAULT_HOMOPOLYMER_FILTER, compact=False, qualityGate=None, rejectSinks=None, readCacheSize=0, pairedEnd=False, umiSeparator=None, checkpoint=None):
+	"""Function to parse FASTQ file and create dictionary of key:value pairs. Will only extract reads that contain the vector sequence before and after the barcode, allowing up to 4 or 5 mismatches respectively. 
+	Each key is a unique barcode sequence. Each value is a list containing the Phredscore associated with the barcode
+	and the UMIs (first 4-6 bases) associated with the read. Function will also output the list of reads that are missing vector sequence before the barcode, missing the vector sequence after the barcode, have a bad Qscore before the barcode or contain a short UMI or primer binding sequence. 
+	matcher is the function used to locate the vector sequences (see vectorMatcher.MATCHERS); it defaults to find_best_match.
+	With workers > 1 the reads are split into chunks of chunkSize records that are classified in a process pool and merged back in file order, so the results are identical to workers = 1.
+	homopolymerFilter (from build_homopolymer_filter) sets which homopolymer / N runs reject a read; the Counter returned after badBarcode says which rule (or quality policy, see build_quality_gate) rejected how many reads, and the one after it holds the time spent in each parse stage (see classify_reads_both).
+	With compact = True each barcode keeps [quality, number of reads, Counter of UMIs] instead of the list below (see record_barcode).
+	rejectSinks (missingVectorBefore, missingVectorAfter, badQscore, badLength, badBarcode), e.g. RejectSink objects, receive the rejected reads 
+	as they are classified and are returned in place of the lists, so rejected reads do not have to be held in memory.
+	With readCacheSize > 0 the matches of up to that many distinct read sequences are cached (per worker), see ReadCache.
+	With pairedEnd the R1/R2 files are read in lockstep and R1 is extended with the end of the amplicon from R2 (see stream_fastq_paired); 
+	umiSeparator takes the UMI from the read name (see header_umi).
+	checkpoint (a Checkpoint) saves the partial results now and then and continues from the one it loaded (see classify_reads_parallel).
+	This is what barcode_dict will look like 
+	barcode_dict = {
+    "barcode_sequence": [
+        "quality_score_of_barcode",
+        "sequence_before_stagger",
+        "sequence_before_stagger",
+        "sequence_before_stagger",
+        ... potentially more sequences
+    ],
+    ... potentially more barcode entries
+	}
+
+	"""
+	print("Started with files:{}".format(", ".join(inFileName)))
+	pairStats = Counter()
+	records = stream_fastq_paired(pair_fastq_files(inFileName), pairStats) if pairedEnd else stream_fastq(inFileName)
+	# A matcher that learns from the first reads (e.g. vectorMatcher.AnchoredMatcher) does so here, before the reads are split over the workers
+	if hasattr(matcher, "learn"):
+		records = matcher.learn(records, lambda sample, learner: classify_reads_both(sample, staggerLength, barcodeLength, minQuality_Phred, asciioffset, learner, homopolymerFilter, compact, qualityGate))
+	readCache = ReadCache(readCacheSize) if readCacheSize > 0 else None
+	results = classify_reads_parallel(classify_reads_both, records, workers, chunkSize, staggerLength, barcodeLength, minQuality_Phred, asciioffset, matcher, homopolymerFilter, compact, qualityGate, readCache, umiSeparator, rejectSinks=rejectSinks, checkpoint=checkpoint)
+	# How many read pairs were read and extended with their mate
+	results[-2].update(pairStats)
+
+	print("Completed files " + ", ".join(inFileName))
+
+	return results
+
+
+def classify_reads_before(records, staggerLength, barcodeLength, minPhred, asciioffset, matcher=find_best_match, homopolymerFilter=DEFAULT_HOMOPOLYMER_FILTER, compact=False, qualityGate=None, readCache=None, umiSeparator=None, rejectSinks=None):
+	# Function to classify an iterable of (title, sequence, quality) FASTQ records for parseBarcode_before.
+	# It can be given the whole file or one chunk of it, and returns the barcode dictionary, the rejected reads, 
+	# a Counter of why reads were rejected, keyed by (category, rule) e.g. ('badBarcode', 'AAAA'), a Counter of parse statistics
+	# (the seconds spent in each of PARSE_STAGES, keyed ('seconds', stage), plus any counts the matcher keeps) and the number of reads seen.
+	# compact selects how the barcode dictionary stores the UMIs (see record_barcode).
+	# rejectSinks optionally gives (missingVectorBefore, badQscore, badLength, badBarcode) objects with an append method, 
+	# e.g. RejectSink; a list is used for any that is None.
+	# qualityGate (from build_quality_gate) sets the quality policies; by default it is the original check on minPhred.
+	# readCache (a ReadCache) optionally remembers the vector match and homopolymer rule of each read sequence, so identical reads are only matched once.
+	# With umiSeparator the UMI is taken from the end of the read name (see header_umi) instead of the bases before the vector.
 	barcode_dict = {}
 	# creating dictionaries for issues with identifying vector sequences or low quality barcode sequencing
-	missingVectorBefore = []
-	badQscore = []
-	badLength = []
-	badBarcode = []
+	missingVectorBefore, badQscore, badLength, badBarcode = [sink if sink is not None else [] for sink in (rejectSinks or (None,) * 4)]
+	rejectReasons = Counter()
+	parseStats = Counter()
+	if qualityGate is None:
+		qualityGate = build_quality_gate(minPhred, asciioffset, barcodeLength=barcodeLength)
 
 	# the GFP sequence as a vector in the primer site before the barcode {read1 from 5'-3'}
 	vectorBeforeBarcode = "TCGACTAAACGCGCTACTTGAT" #
 	find_before_barcode = int(math.floor(staggerLength + len(vectorBeforeBarcode) + (barcodeLength / 2)))
 	# vectorAfterBarcode = re.compile(r'(?e)(?r)(ATCCTACTTGTACAGCTCGT){e<=5}') #vector sequence after barcode as reg expression. Allow up to 5 mismatches and search from end of string first. ***What determines these numbers?
 	tot_reads = 0
-	
-	fastQ_file = combine_fastq(inFileName)
-	
-	# This starts a loop over all fastQ files associated with each sample.
-	with gzip.open(fastQ_file, 'rt') as fastq:
+	readCache = process_read_cache(readCache)
 
-		# This uses BioPython's FastqGeneralIterator to parse each read in the fastQ file.
-		for seq_record in FastqGeneralIterator(fastq): #Uses BioPythons FastqGeneralIterator to parse each read.
-			tot_reads += 1
+	# This uses BioPython's FastqGeneralIterator records to parse each read, a batch at a time.
+	for batch in timed_chunks(records, QUALITY_BATCH_SIZE, parseStats):
+		tot_reads += len(batch)
+		startTime = time.perf_counter()
 
-			# This searches for the vector before barcode sequence in the current read. Allow up to 4 mismatches. Less than 4 errors - including deletion, insertion and substitution
-			# position is the position of the vector before the barcode sequence aka GFP 
-			# best_match is the best match string that is closest to GFP both in length and sequence
+		# This searches for the vector before barcode sequence in every read of the batch. Allow up to 4 mismatches. Less than 4 errors - including deletion, insertion and substitution
+		# position is the position of the vector before the barcode sequence aka GFP 
+		# best_match is the best match string that is closest to GFP both in length and sequence
+		# best_match is None means none is found, and error_count is the count 
+		matches = []
+		for seq_record in batch:
+			# An identical read seen before gets the same match and homopolymer rule
+			outcome = readCache.get(seq_record[1]) if readCache is not None else None
+			if outcome is None:
+				best_match, position, error_count= matcher(seq_record[1][:find_before_barcode], vectorBeforeBarcode, 4, "before")
+				# This checks for homopolymers or unknown nucleotides in the sequence.
+				outcome = (best_match is not None, position, find_homopolymer(seq_record[1], homopolymerFilter))
+				if readCache is not None:
+					readCache.put(seq_record[1], outcome)
+			matches.append(outcome)
+		matchedTime = time.perf_counter()
 
-			best_match, position, error_count= find_best_match(seq_record[1][:find_before_barcode], vectorBeforeBarcode, 4, "before")
+		# This checks the quality of the reads with the vector, by default whether 5 or more positions in the matched region have a Phred score < minPhred.
+		qualityFailures = iter(check_quality(qualityGate, [(seq_record[2], position[0], position[1]) for seq_record, (found, position, homopolymerRule) in zip(batch, matches) if found]))
+		checkedTime = time.perf_counter()
 
+		for seq_record, (found, position, homopolymerRule) in zip(batch, matches):
 			# If the vector before barcode sequence is found: 
-			# best_match is None means none is found, and error_count is the count 
-			if best_match is not None: 
+			if found: 
 				
-				# This checks if 5 or more positions in the matched region have a Phred score < minPhred.
-				if sum([ord(i) - asciioffset < minPhred for i in seq_record[2][position[0]:position[1]]]) >= 5: #Skip reads where >=5 positions in GFP primer site have phredscore < 14.   
+				qualityPolicy = next(qualityFailures)
+				if qualityPolicy is not None: #Skip reads where >=5 positions in GFP primer site have phredscore < 14.   
 					badQscore.append(seq_record) 
+					rejectReasons[("badQscore", qualityPolicy)] += 1
+					continue
 
 				# elif (int(position[1]) - staggerLength) > 30 or (int(position[0]) - staggerLength) < 4: #Skip positions with UMI shorter than 4 bases or UMI+GFP longer than 30 bases. 
 				# 	badLength.append(seq_record)
 
-				# This checks for homopolymers or unknown nucleotides in the sequence.
-				elif(len(re.findall("(AAAA)", seq_record[1])) > 0 or \
-						len(re.findall("(TTTT)", seq_record[1])) > 0 or \
-						len(re.findall("(GGGG)", seq_record[1])) > 0 or \
-						len(re.findall("(CCCC)", seq_record[1])) > 0 or \
-						len(re.findall("(NN)", seq_record[1])) > 0):
-						badBarcode.append(seq_record)
+				# Reads with homopolymers or unknown nucleotides are bad barcodes
+				if homopolymerRule is not None:
+					badBarcode.append(seq_record)
+					rejectReasons[("badBarcode", homopolymerRule)] += 1
 
 				# # This checks for homopolymers or unknown nucleotides in the sequence.
 				# elif(len(re.findall("(AAAA)", seq_record[1][position[1]:])) > 0 or \
@@ -254,29 +781,410 @@ def parseBarcode_before(inFileName, staggerLength, barcodeLength, minPhred, asci
 				
 				# If the sequence passes all checks, this extracts the barcode and updates the barcode_dict.
 				else:
-					barcode = seq_record[1][position[1]:position[1] + barcodeLength] #recording barcode
-					if barcode not in barcode_dict:
-						barcode_dict[barcode] = [seq_record[2][position[1]:position[1] + barcodeLength]] # recording the quality 
-						barcode_dict[barcode].append(seq_record[1][0:position[0]-staggerLength]) # recording stagger sequence, demultiplexing
-					elif barcode in barcode_dict:
-						barcode_dict[barcode].append(seq_record[1][0:position[0]-staggerLength])
-	
+					# recording the barcode with its quality and stagger sequence, demultiplexing
+					umi = header_umi(seq_record[0], umiSeparator) if umiSeparator else seq_record[1][0:position[0]-staggerLength]
+					record_barcode(barcode_dict, seq_record, position[1], barcodeLength, umi, compact)
+
 			# If the vector before barcode sequence is not found, this adds the read to missingVectorBefore.
 			else:
 				missingVectorBefore.append(seq_record) #Not consider barcode without the GFP tag			
-		
-		print("Completed file " + fastQ_file)
-	return barcode_dict, missingVectorBefore, badQscore, badLength, badBarcode, tot_reads
+
+		# Time is kept per batch rather than per read so it costs next to nothing
+		parseStats[("seconds", "match")] += matchedTime - startTime
+		parseStats[("seconds", "quality")] += checkedTime - matchedTime
+		parseStats[("seconds", "classify")] += time.perf_counter() - checkedTime
+
+	# Matchers that keep their own counts (e.g. vectorMatcher.AnchoredMatcher) add them to the parse statistics
+	if hasattr(matcher, "take_stats"):
+		parseStats.update(matcher.take_stats())
+	if readCache is not None:
+		parseStats.update(readCache.take_stats())
+
+	return barcode_dict, missingVectorBefore, badQscore, badLength, badBarcode, rejectReasons, parseStats, tot_reads
+
+
+def parseBarcode_before(inFileName, staggerLength, barcodeLength, minPhred, asciioffset, matcher=find_best_match, workers=1, chunkSize=DEFAULT_CHUNK_SIZE, homopolymerFilter=DEFAULT_HOMOPOLYMER_FILTER, compact=False, qualityGate=None, rejectSinks=None, readCacheSize=0, pairedEnd=False, umiSeparator=None, checkpoint=None):
+	# Function to parse FASTQ file and create dictionary of key:value pairs. Will only extract reads that contain the vector sequence before the barcode allowing up to 4 mismatches. 
+	# Each key is a unique barcode sequence. Each value is a list containing the Phredscore associated with the barcode
+	# and the UMIs (first 4-6 bases) associated with the read. Function will also output the list of reads that are missing vector sequence before the barcode, missing the vector sequence after the barcode, have a bad Qscore before the barcode or contain a short UMI or primer binding sequence.
+	# matcher is the function used to locate the vector sequence (see vectorMatcher.MATCHERS); it defaults to find_best_match.
+	# With workers > 1 the reads are split into chunks of chunkSize records that are classified in a process pool and merged back in file order, so the results are identical to workers = 1.
+	# homopolymerFilter (from build_homopolymer_filter) sets which homopolymer / N runs reject a read; the Counter returned after badBarcode says which rule (or quality policy, see build_quality_gate) rejected how many reads, and the one after it holds the time spent in each parse stage (see classify_reads_both).
+	# With compact = True each barcode keeps [quality, number of reads, Counter of UMIs] instead of one UMI per read (see record_barcode).
+	# rejectSinks (missingVectorBefore, badQscore, badLength, badBarcode), e.g. RejectSink objects, receive the rejected reads 
+	# as they are classified and are returned in place of the lists, so rejected reads do not have to be held in memory.
+	# With readCacheSize > 0 the matches of up to that many distinct read sequences are cached (per worker), see ReadCache.
+	# With pairedEnd the R1/R2 files are read in lockstep and R1 is extended with the end of the amplicon from R2 (see stream_fastq_paired);
+	# umiSeparator takes the UMI from the read name (see header_umi).
+	# checkpoint (a Checkpoint) saves the partial results now and then and continues from the one it loaded (see classify_reads_parallel).
+	# This streams the reads of all fastQ files associated with each sample, lane by lane in turn, without writing a combined file.
+	pairStats = Counter()
+	records = stream_fastq_paired(pair_fastq_files(inFileName), pairStats) if pairedEnd else stream_fastq(inFileName)
+	# A matcher that learns from the first reads (e.g. vectorMatcher.AnchoredMatcher) does so here, before the reads are split over the workers
+	if hasattr(matcher, "learn"):
+		records = matcher.learn(records, lambda sample, learner: classify_reads_before(sample, staggerLength, barcodeLength, minPhred, asciioffset, learner, homopolymerFilter, compact, qualityGate))
+	readCache = ReadCache(readCacheSize) if readCacheSize > 0 else None
+	results = classify_reads_parallel(classify_reads_before, records, workers, chunkSize, staggerLength, barcodeLength, minPhred, asciioffset, matcher, homopolymerFilter, compact, qualityGate, readCache, umiSeparator, rejectSinks=rejectSinks, checkpoint=checkpoint)
+	# How many read pairs were read and extended with their mate
+	results[-2].update(pairStats)
+	
+	print("Completed files " + ", ".join(inFileName))
+	return results
+
+
+class Checkpoint:
+	"""Saves the partial results of a sample to fileName every interval reads, so an interrupted run can be resumed 
+	by skipping the reads already classified; see classify_reads_parallel. settings describes the run (arguments and input files) 
+	and a saved checkpoint is only used by a run with the same settings.
+	The file is a log of pickled records: the settings, then one record per save with only what changed since the save before 
+	(the new barcodes, the UMIs added to list entries and the compact entries that changed, see record_barcode) and the reject 
+	counts, statistics and reject file sizes at that point. A save writes what the last interval added rather than the whole 
+	barcode dictionary, and a record cut short by a killed run is dropped when the log is loaded.
+	"""
+	def __init__(self, fileName, interval=DEFAULT_CHECKPOINT_INTERVAL, settings=None):
+		self.fileName = fileName
+		self.interval = interval
+		self.settings = settings
+		self.state = None
+		self.savedAt = 0
+		# End of the last complete record in the file, None until the file is started
+		self.logSize = None
+		# Barcodes changed since the last save, in the order they were first seen, and how many values of each list entry are saved
+		self.changed = {}
+		self.savedLengths = {}
+
+	def load(self):
+		# Load the saved checkpoint, if there is one for the same settings. Returns the number of reads it covers.
+		if not os.path.exists(self.fileName):
+			return 0
+		barcode_dict = {}
+		record = None
+		with open(self.fileName, "rb") as checkpointFile:
+			try:
+				header = pickle.load(checkpointFile)
+			except (EOFError, pickle.UnpicklingError):
+				return 0
+			if header["settings"] != self.settings:
+				print(f"Checkpoint {self.fileName} was made with other settings or input files, starting from the first read")
+				return 0
+			logSize = checkpointFile.tell()
+			while True:
+				try:
+					nextRecord = pickle.load(checkpointFile)
+				except (EOFError, pickle.UnpicklingError):
+					break
+				for barcode, values in nextRecord["barcodes"].items():
+					if barcode in barcode_dict and not is_compact_entry(values):
+						barcode_dict[barcode].extend(values)
+					else:
+						barcode_dict[barcode] = values
+				record = nextRecord
+				logSize = checkpointFile.tell()
+		if record is None:
+			return 0
+		self.state = {"results": [barcode_dict] + record["results"], "rejectFileSizes": record["rejectFileSizes"]}
+		self.logSize = logSize
+		self.savedLengths = {barcode: len(values) for barcode, values in barcode_dict.items() if not is_compact_entry(values)}
+		self.savedAt = record["results"][-1]
+		return self.savedAt
+
+	def reject_file_size(self, outFileName):
+		# Size the reject file had when the loaded checkpoint was saved, None if there is no checkpoint
+		if self.state is None:
+			return None
+		return self.state["rejectFileSizes"].get(outFileName)
+
+	def restore(self, results):
+		# Put the saved results back into results (as made by classify on no reads). Returns the number of reads they cover.
+		if self.state is None:
+			return 0
+		for i, saved in enumerate(self.state["results"]):
+			if isinstance(results[i], RejectSink):
+				results[i].count = saved
+			else:
+				results[i] = saved
+		return results[-1]
+
+	def record(self, chunk_results):
+		# Note the barcodes of a chunk before it is merged into the results, they are the ones the next save has to write
+		self.changed.update(dict.fromkeys(chunk_results[0]))
+
+	def save_if_due(self, results):
+		if results[-1] - self.savedAt >= self.interval:
+			self.save(results)
+
+	def save(self, results):
+		# The reject files are flushed before the checkpoint is written, so they always hold at least what it covers
+		rejectFileSizes = {}
+		saved = []
+		for result in results[1:]:
+			if isinstance(result, RejectSink):
+				size = result.checkpoint()
+				if size is not None:
+					rejectFileSizes[result.outFileName] = size
+				saved.append(result.count)
+			else:
+				saved.append(result)
+		# Only the values added since the last save: the UMIs after the saved ones of a list entry (all of it for a new barcode), 
+		# or the whole entry of a compact barcode, whose counters are updated in place
+		barcodes = {}
+		for barcode in self.changed:
+			values = results[0][barcode]
+			if is_compact_entry(values):
+				barcodes[barcode] = values
+			else:
+				barcodes[barcode] = values[self.savedLengths.get(barcode, 0):]
+				self.savedLengths[barcode] = len(values)
+		# The record is added after the last complete one; a run killed while writing it leaves a cut short record that load() drops
+		with open(self.fileName, "wb" if self.logSize is None else "r+b") as checkpointFile:
+			if self.logSize is None:
+				pickle.dump({"settings": self.settings}, checkpointFile, protocol=pickle.HIGHEST_PROTOCOL)
+			else:
+				checkpointFile.seek(self.logSize)
+				checkpointFile.truncate()
+			pickle.dump({"barcodes": barcodes, "results": saved, "rejectFileSizes": rejectFileSizes}, checkpointFile, protocol=pickle.HIGHEST_PROTOCOL)
+			checkpointFile.flush()
+			os.fsync(checkpointFile.fileno())
+			self.logSize = checkpointFile.tell()
+		self.changed = {}
+		self.savedAt = results[-1]
+		print(f"Checkpoint saved after {self.savedAt} reads")
+
+	def remove(self):
+		if os.path.exists(self.fileName):
+			os.remove(self.fileName)
+
+
+def file_manifest_entry(fileName):
+	"""Function to describe an input file for SampleState: its name, size, modification time and MD5 checksum.
+	"""
+	checksum = hashlib.md5()
+	with open(fileName, "rb") as inFile:
+		for block in iter(lambda: inFile.read(1 << 20), b""):
+			checksum.update(block)
+	return {"path": fileName, "size": os.path.getsize(fileName), "mtime": os.path.getmtime(fileName), "md5": checksum.hexdigest()}
+
+
+class SampleState:
+	"""Keeps the results of a finished sample so that lane files added later (e.g. a re-sequencing top-up) can be parsed 
+	on their own and merged into them. stateFileName holds the pickled results (barcode dictionary, reject counts and 
+	statistics, see classify_reads_parallel) and manifestFileName lists the input files they cover (path, size, modification 
+	time and MD5 checksum) with the settings of the run, as JSON. settings describes the run like for a Checkpoint.
+
+	new_files() gives the input files still to be parsed: all of them when there is no state, when it was made with other 
+	settings or when one of the files it covers has changed or gone; otherwise only the files it does not cover. 
+	A covered file whose size and modification time are unchanged is trusted, otherwise its checksum decides.
+	"""
+	def __init__(self, stateFileName, manifestFileName, settings=None):
+		self.stateFileName = stateFileName
+		self.manifestFileName = manifestFileName
+		self.settings = settings
+		self.manifest = None
+		self.state = None
+
+	def new_files(self, inFileNames):
+		self.manifest = None
+		self.state = None
+		if not (os.path.exists(self.manifestFileName) and os.path.exists(self.stateFileName)):
+			return list(inFileNames)
+		with open(self.manifestFileName) as manifestFile:
+			manifest = json.load(manifestFile)
+		if manifest["settings"] != self.settings:
+			print(f"{self.manifestFileName} was made with other settings, parsing all input files again")
+			return list(inFileNames)
+		for entry in manifest["files"]:
+			fileName = entry["path"]
+			if fileName not in inFileNames:
+				print(f"{fileName} was parsed before but is gone, parsing all input files again")
+				return list(inFileNames)
+			if (os.path.getsize(fileName), os.path.getmtime(fileName)) != (entry["size"], entry["mtime"]) and file_manifest_entry(fileName)["md5"] != entry["md5"]:
+				print(f"{fileName} changed since it was parsed, parsing all input files again")
+				return list(inFileNames)
+		with open(self.stateFileName, "rb") as stateFile:
+			state = pickle.load(stateFile)
+		if state["results"][-1] != manifest["reads"]:
+			print(f"{self.stateFileName} does not match {self.manifestFileName}, parsing all input files again")
+			return list(inFileNames)
+		self.manifest = manifest
+		self.state = state
+		parsed = {entry["path"] for entry in manifest["files"]}
+		return [fileName for fileName in inFileNames if fileName not in parsed]
+
+	def reject_file_size(self, outFileName):
+		# Size the reject file had when the state was saved, None if there is no state to add to
+		if self.state is None:
+			return None
+		return self.state["rejectFileSizes"].get(outFileName)
+
+	def merge(self, results):
+		# Merge the results of the new files (as returned by parseBarcode_both / parseBarcode_before) after the saved ones,
+		# so barcodes and UMIs of the earlier files come first. Reject sinks stay the objects in results and only get the saved counts.
+		if self.state is None:
+			return results
+		merged = []
+		for saved, result in zip(self.state["results"], results):
+			if isinstance(result, RejectSink):
+				result.count += saved
+				merged.append(result)
+			elif isinstance(result, Counter):
+				# Stage times describe this run only, the counts are added up
+				result.update({key: count for key, count in saved.items() if key[0] != "seconds"})
+				merged.append(result)
+			elif isinstance(result, dict):
+				merged.append(merge_barcode_dicts(saved, result))
+			else:
+				merged.append(saved + result)
+		return tuple(merged)
+
+	def save(self, results, inFileNames):
+		# The reject sinks must be closed first, so the sizes saved are those of complete files
+		saved = []
+		rejectFileSizes = {}
+		for result in results:
+			if isinstance(result, RejectSink):
+				if result.outFileName is not None:
+					rejectFileSizes[result.outFileName] = os.path.getsize(result.outFileName)
+				saved.append(result.count)
+			else:
+				saved.append(result)
+		# Files already in the manifest keep their checksum (with the current size and modification time), only the new ones are read for it
+		known = {entry["path"]: entry for entry in self.manifest["files"]} if self.manifest is not None else {}
+		files = [dict(known[fileName], size=os.path.getsize(fileName), mtime=os.path.getmtime(fileName)) if fileName in known else file_manifest_entry(fileName) for fileName in inFileNames]
+		# The state is written before the manifest and each replaces its old version in one step; 
+		# a run killed in between leaves a manifest whose read count does not match the state, which new_files() rejects
+		with open(self.stateFileName + ".tmp", "wb") as stateFile:
+			pickle.dump({"results": saved, "rejectFileSizes": rejectFileSizes}, stateFile, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(self.stateFileName + ".tmp", self.stateFileName)
+		with open(self.manifestFileName + ".tmp", "w") as manifestFile:
+			json.dump({"settings": self.settings, "reads": results[-1], "files": files}, manifestFile, indent=1)
+		os.replace(self.manifestFileName + ".tmp", self.manifestFileName)
+
+
+def chunk_records(records, chunkSize):
+	"""Function to group an iterator of FASTQ records into lists of at most chunkSize records, keeping file order.
+	"""
+	chunk = []
+	for seq_record in records:
+		chunk.append(seq_record)
+		if len(chunk) == chunkSize:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+
+def timed_chunks(records, chunkSize, parseStats, stage="read"):
+	"""Function to group records like chunk_records, adding the time spent waiting for each chunk 
+	(gzip decoding and FASTQ parsing when records is a file stream) to parseStats[("seconds", stage)].
+	"""
+	chunks = chunk_records(records, chunkSize)
+	while True:
+		startTime = time.perf_counter()
+		chunk = next(chunks, None)
+		parseStats[("seconds", stage)] += time.perf_counter() - startTime
+		if chunk is None:
+			return
+		yield chunk
+
+
+def merge_barcode_dicts(barcode_dict, chunk_dict):
+	"""Function to merge the barcode dictionary of a later chunk into barcode_dict. 
+	New barcodes keep the quality score of their first read and existing ones only get the extra UMIs appended 
+	(or added to their read and UMI counters in compact mode), so merging chunks in file order gives the same 
+	dictionary (including key and UMI order) as a single serial pass.
+	"""
+	for barcode, values in chunk_dict.items():
+		if barcode not in barcode_dict:
+			barcode_dict[barcode] = values
+		elif is_compact_entry(values):
+			barcode_dict[barcode][1] += values[1]
+			barcode_dict[barcode][2].update(values[2])
+		else:
+			barcode_dict[barcode].extend(values[1:])
+	return barcode_dict
+
+
+def merge_classified_chunk(results, chunk_results):
+	"""Function to merge the output of classify_reads_both / classify_reads_before for a chunk into the running results.
+	The first element is the barcode dictionary and the last is the read count. In between, lists of rejected reads 
+	are extended and Counters (the reasons reads were rejected and the parse statistics) are added up.
+	"""
+	merge_barcode_dicts(results[0], chunk_results[0])
+	for rejected, chunk_rejected in zip(results[1:-1], chunk_results[1:-1]):
+		if isinstance(rejected, Counter):
+			rejected.update(chunk_rejected)
+		else:
+			rejected.extend(chunk_rejected)
+	results[-1] += chunk_results[-1]
+	return results
+
+
+def classify_reads_parallel(classify, records, workers, chunkSize, *classifyArgs, rejectSinks=None, checkpoint=None):
+	"""Function to run classify (classify_reads_both or classify_reads_before) over the records of one sample.
+	With workers <= 1 the records are classified in this process. Otherwise record-aligned chunks are sent to a pool 
+	of workers, at most 2 chunks per worker are in flight at a time so memory stays bounded, and the chunk results 
+	are merged in submission order so the output does not depend on the number of workers. 
+	Rejected reads of each chunk are passed on to rejectSinks as the chunk is merged.
+	The stage times of the chunks are added up over the workers, and the time this process spends reading 
+	and merging the chunks is added to the 'read' and 'merge' stages.
+	With a checkpoint (a Checkpoint) the chunks are classified and merged the same way even with one worker, the results 
+	are saved every checkpoint.interval reads, and the results of a loaded checkpoint are restored first and its reads skipped.
+	"""
+	if workers <= 1 and checkpoint is None:
+		return classify(records, *classifyArgs, rejectSinks=rejectSinks)
+
+	# Start from the results of an empty input, which already hold the sinks the chunks are merged into
+	results = list(classify([], *classifyArgs, rejectSinks=rejectSinks))
+	# Carry on from the reads an interrupted run already classified, reading them again but not classifying them
+	if checkpoint is not None:
+		readsDone = checkpoint.restore(results)
+		if readsDone:
+			print(f"Resuming after read {readsDone}")
+			records = islice(records, readsDone, None)
+	workerSinks = worker_reject_sinks(rejectSinks)
+	parseStats = results[-2]
+	pending = deque()
+
+	def merge_chunk(chunk_results):
+		startTime = time.perf_counter()
+		if checkpoint is not None:
+			checkpoint.record(chunk_results)
+		merge_classified_chunk(results, chunk_results)
+		parseStats[("seconds", "merge")] += time.perf_counter() - startTime
+		if checkpoint is not None:
+			checkpoint.save_if_due(results)
+
+	if workers <= 1:
+		for chunk in timed_chunks(records, chunkSize, parseStats):
+			merge_chunk(classify(chunk, *classifyArgs, rejectSinks=workerSinks))
+		return tuple(results)
+
+	with multiprocessing.Pool(workers) as pool:
+		for chunk in timed_chunks(records, chunkSize, parseStats):
+			pending.append(pool.apply_async(classify, (chunk,) + classifyArgs, {"rejectSinks": workerSinks}))
+			# Wait for the oldest chunk once the queue is full so the reader does not run ahead of the workers
+			if len(pending) >= 2 * workers:
+				merge_chunk(pending.popleft().get())
+		while pending:
+			merge_chunk(pending.popleft().get())
+
+	return tuple(results)
 
 
 def writeOutFileUMIs(barcode_dict, outFileName):
 	"""Function to write barcode dictionary to gzipped tab delimited file. Each line contains
     a unique barcode, it's phredscore, and all associated UMIs. 
+    For a compact barcode dictionary each UMI is written once per read, grouped in the order the UMIs were first seen.
     """
 	with gzip.open(outFileName, 'wt') as out_file:
 		for barcode in barcode_dict:
 			out_file.write(barcode)
-			out_file.write("\t" + "\t".join(barcode_dict[barcode]))
+			if is_compact_entry(barcode_dict[barcode]):
+				out_file.write("\t" + barcode_dict[barcode][0])
+				for umi, count in barcode_dict[barcode][2].items():
+					out_file.write(("\t" + umi) * count)
+			else:
+				out_file.write("\t" + "\t".join(barcode_dict[barcode]))
 			out_file.write("\n")
 
 def writeOutFileBadSeqRecord(badSeqList, outFileName):
@@ -296,7 +1204,10 @@ def count_read_UMI(barcode_dictionary):
 	for i in barcode_dictionary:
 		#First component is the number of reads per barcode 
 		#Second component is the number of unique UMIs
-		new_dict[i] = (sum(Counter(barcode_dictionary[i][1:]).values()), len(Counter(barcode_dictionary[i][1:]).keys()))
+		if is_compact_entry(barcode_dictionary[i]):
+			new_dict[i] = (barcode_dictionary[i][1], len(barcode_dictionary[i][2]))
+		else:
+			new_dict[i] = (len(barcode_dictionary[i]) - 1, len(set(barcode_dictionary[i][1:])))
 		tot_reads += new_dict[i][0]
 	return new_dict, tot_reads
 
@@ -330,3 +1241,112 @@ def writeOutFileBarcodeUMICounts(barcode_dict_summary, outFileName):
 			out_file.write("\t" + str(barcode_dict_summary[barcode][1]))
 			out_file.write("\n")    
 
+
+# Tables writeOutFileTables can write, in the order their columns are described in parseFastqMain.py
+OUTPUT_TABLES = ("UMI", "counts", "UMICounts", "readCounts")
+# Number of barcodes per block of lines handed to a table's writer
+WRITE_BLOCK_SIZE = 10000
+
+
+def gzip_block_writer(outFileName, compresslevel, blocks, errors):
+	"""Function run by each writer thread of writeOutFileTables. Writes the encoded blocks it receives until it gets None.
+	"""
+	done = False
+	try:
+		with gzip.open(outFileName, 'wb', compresslevel=compresslevel) as out_file:
+			while True:
+				block = blocks.get()
+				if block is None:
+					done = True
+					break
+				out_file.write(block)
+	except Exception as error:
+		errors.append(error)
+		# Keep draining so the main thread never blocks on a full queue, unless the last block was already taken
+		# (e.g. closing the file failed), as then no other None is coming
+		while not done:
+			done = blocks.get() is None
+
+
+def writeOutFileTables(barcode_dict, outFileNames, compresslevel=DEFAULT_GZIP_LEVEL, concurrent=True, columns=None):
+	"""Function to write several of the Step 1 tables from one walk over barcode_dict. 
+	outFileNames maps table names from OUTPUT_TABLES to the gzipped file each one is written to:
+		UMI: barcode, its phredscore and all associated UMIs (as writeOutFileUMIs)
+		counts: barcode, read count and UMI count (as writeOutFileBarcodeCounts)
+		UMICounts: barcode and UMI count (as writeOutFileBarcodeUMICounts)
+		readCounts: barcode and read count (as writeOutFileBarcodeReadCounts)
+	The read and UMI counts are worked out per barcode on the way, so count_read_UMI is not needed. 
+	With concurrent = True each file is compressed by its own thread at gzip level compresslevel; zlib releases the GIL 
+	while compressing, so the files are written at the same time. Returns the total number of reads, like count_read_UMI.
+	columns, if given, is a dict whose 'barcodes', 'reads' and 'umis' lists are filled on the same walk (for barcodeTable.save_barcode_table).
+	"""
+	tables = [table for table in OUTPUT_TABLES if table in outFileNames]
+	errors = []
+	threads = {}
+	queues = {}
+	out_files = {}
+	for table in tables:
+		if concurrent:
+			# A short queue keeps at most a few blocks per table in memory
+			queues[table] = queue.Queue(maxsize=4)
+			threads[table] = threading.Thread(target=gzip_block_writer, args=(outFileNames[table], compresslevel, queues[table], errors))
+			threads[table].start()
+		else:
+			out_files[table] = gzip.open(outFileNames[table], 'wb', compresslevel=compresslevel)
+
+	def flush(lines):
+		for table in tables:
+			block = "".join(lines[table]).encode()
+			lines[table] = []
+			if concurrent:
+				queues[table].put(block)
+			else:
+				out_files[table].write(block)
+
+	tot_reads = 0
+	lines = {table: [] for table in tables}
+	needCounts = columns is not None or any(table != "UMI" for table in tables)
+	if columns is not None:
+		for column in ("barcodes", "reads", "umis"):
+			columns[column] = []
+	try:
+		for number, (barcode, values) in enumerate(barcode_dict.items(), 1):
+			compact = is_compact_entry(values)
+			#First component is the number of reads per barcode 
+			#Second component is the number of unique UMIs
+			reads = values[1] if compact else len(values) - 1
+			tot_reads += reads
+			if needCounts:
+				umis = len(values[2]) if compact else len(set(values[1:]))
+
+			if columns is not None:
+				columns["barcodes"].append(barcode)
+				columns["reads"].append(reads)
+				columns["umis"].append(umis)
+
+			if "UMI" in lines:
+				if compact:
+					lines["UMI"].append(barcode + "\t" + values[0] + "".join(("\t" + umi) * count for umi, count in values[2].items()) + "\n")
+				else:
+					lines["UMI"].append(barcode + "\t" + "\t".join(values) + "\n")
+			if "counts" in lines:
+				lines["counts"].append("{}\t{}\t{}\n".format(barcode, reads, umis))
+			if "UMICounts" in lines:
+				lines["UMICounts"].append("{}\t{}\n".format(barcode, umis))
+			if "readCounts" in lines:
+				lines["readCounts"].append("{}\t{}\n".format(barcode, reads))
+
+			if number % WRITE_BLOCK_SIZE == 0:
+				flush(lines)
+		flush(lines)
+	finally:
+		for table in tables:
+			if concurrent:
+				queues[table].put(None)
+				threads[table].join()
+			else:
+				out_files[table].close()
+
+	if errors:
+		raise errors[0]
+	return tot_reads
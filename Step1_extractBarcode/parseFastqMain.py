@@ -10,6 +10,8 @@ The output of this script will be:
 		b. sampleName_UMICounts or sampleName_UMICounts_liberal - contains the barcode sequence along with number of associated UMIs
 		c. sampleName_UMIs or sampleName_UMIs_liberal - contains the barcode sequence, its quality score for first instance and the list of associated UMIs
 		d. sampleName_readCountsOnly or sampleName_readCountsOnly_liberal - contains the barccode sequence and its count number
+		e. With --tableFormat npz or both, sampleName_barcodes.npz or sampleName_barcodes_liberal.npz - the barcodes (2-bit packed), read counts and UMI counts as a binary table (see barcodeTable.py)
+		f. With --incremental, sampleName_state.pkl and sampleName_manifest.json (or _liberal) - the results of the sample and the input files they cover, so lane files added later are parsed on their own and merged in
 	3. If excluded reads is true, more files which contain details about bad samples are also outputted to the same folder. It will contain details of barcodes missing vector sequences, having bad quality score or having four repeated bases contiguously
 	4. A summary text file containing details about length of barcode dictionary, number of UMIs and number of bad Barcodes classified into different issues. 
 
@@ -26,12 +28,18 @@ from Bio.SeqIO.QualityIO import FastqGeneralIterator
 import regex as re
 from collections import Counter
 from argparse import ArgumentParser
-import os, glob
+import os, glob, sys
+import json, time, resource, threading
 import numpy as np
 from extractionFunctions import parseBarcode_both,parseBarcode_before,\
-													 writeOutFileBarcodeCounts,writeOutFileBadSeqRecord,\
-													 writeOutFileBarcodeReadCounts,writeOutFileUMIs,\
-													 count_read_UMI, writeOutFileBarcodeUMICounts
+													 DEFAULT_CHUNK_SIZE, combine_fastq, combined_file_name,\
+													 build_homopolymer_filter, RejectSink,\
+													 build_quality_gate, QUALITY_POLICIES, writeOutFileTables, PARSE_STAGES,\
+													 Checkpoint, DEFAULT_CHECKPOINT_INTERVAL, SampleState, DEFAULT_GZIP_LEVEL
+from vectorMatcher import MATCHERS, get_matcher, AnchoredMatcher, ExactFirstMatcher
+# The binary barcode table is shared with Step 2, so it lives in the script folder above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from barcodeTable import save_barcode_table
 
 
 def check_file_created(filename):
@@ -40,115 +48,413 @@ def check_file_created(filename):
     else:
         print(f"Failed to create file: {filename}")
 
+# Arguments that change how a sample is run but not its results, so a checkpoint can be resumed with different values
+RUN_ONLY_ARGUMENTS = ("pathExperiment", "workers", "chunkSize", "exportCombined", "gzipLevel", "serialWrite", "readCacheSize", "profile", "resume", "checkpointEvery", "incremental")
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # Peak resident memory in MB; Linux reports ru_maxrss in KB and macOS in bytes
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def lifetime_peaks():
+	# Peaks of this process and of its largest finished child over the whole life of the process, for the profile
+	return {"main": peak_rss_mb(), "workers": peak_rss_mb(resource.RUSAGE_CHILDREN), "scope": "process lifetime"}
+
+def read_peak_rss_mb(pid="self"):
+	# Peak resident memory (VmHWM) in MB of a process, read from /proc (Linux). None if it cannot be read
+	try:
+		with open("/proc/{}/status".format(pid)) as status:
+			for line in status:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) / 1024
+	except (OSError, ValueError):
+		pass
+	return None
+
+def child_pids():
+	# Processes whose parent is this one (e.g. the --workers pool), from the parent pid field of /proc/<pid>/stat
+	pid = os.getpid()
+	children = []
+	for entry in os.listdir("/proc"):
+		if not entry.isdigit():
+			continue
+		try:
+			with open("/proc/{}/stat".format(entry)) as stat:
+				if int(stat.read().rsplit(")", 1)[1].split()[1]) == pid:
+					children.append(entry)
+		except (OSError, ValueError, IndexError):
+			continue
+	return children
+
+
+class SamplePeakMemory:
+	"""Measures the peak resident memory of one sample for --profile. ru_maxrss (peak_rss_mb) is the peak over the whole life of 
+	the process and of every child it ever had, and Envelope.py runs several samples one after another in one worker process, 
+	so instead the peak of this process is reset when the sample starts (/proc/self/clear_refs) and read when it ends, and a thread 
+	reads the peak of each child process (the --workers pool, which is started for the sample) every interval seconds. 
+	Where /proc is not available (e.g. macOS) the lifetime peaks of peak_rss_mb are reported, with scope 'process lifetime'.
+	"""
+	def __init__(self, interval=0.2):
+		self.interval = interval
+		self.workerPeaks = {}
+		self.stopped = threading.Event()
+		self.thread = None
+		try:
+			with open("/proc/self/clear_refs", "w") as clearRefs:
+				clearRefs.write("5")
+			self.perSample = read_peak_rss_mb() is not None
+		except OSError:
+			self.perSample = False
+		if self.perSample:
+			self.thread = threading.Thread(target=self.run, daemon=True)
+			self.thread.start()
+
+	def sample_workers(self):
+		for pid in child_pids():
+			peak = read_peak_rss_mb(pid)
+			if peak is not None:
+				self.workerPeaks[pid] = max(peak, self.workerPeaks.get(pid, 0))
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.sample_workers()
+
+	def stop(self):
+		if self.thread is not None:
+			self.stopped.set()
+			self.thread.join()
+			self.thread = None
+
+	def peaks(self):
+		# Peak in MB of this process and of the largest worker while the sample ran
+		if not self.perSample:
+			return lifetime_peaks()
+		self.sample_workers()
+		return {"main": read_peak_rss_mb(), "workers": max(self.workerPeaks.values(), default = 0), "scope": "sample"}
+
 #Command line parser
-parser = ArgumentParser()
-parser.add_argument("pathExperiment", help = "Specify the path to the experiment directory")
-parser.add_argument("sampleName", help = "Specify the name of sample directory containing the fastq.gz files")
-parser.add_argument("-o", "--outFilePrefix", help = "Specify the output file prefix for table of barcodes and UMIs. If none specified, will use sampleDirectory") 
-parser.add_argument("-s", "--stagger", help = "Specify the length of the stagger.", type=int, default = 0)
-parser.add_argument("-r", "--includeReads", help = "If specified, output additional tables with barcodes and only read counts or UMI counts. Otherwise outputs only one table with both counts", action = 'store_true')
-parser.add_argument("-checkVector", help = "Option to check vector sequence before or on both sides of the barcode sequence.", default = "both", choices = ["both", "before"]) 
-parser.add_argument("-barcodeLength", help = "If checkVector before specified, input here your desired barcode length.", type = int) 
-parser.add_argument("-Q", "--minPhred", help = "Specify the minimum phredscore required to include a readout. Filters reads with more than 5 bases before the barcode with low phredscore.", default = 14, type = int) 
-parser.add_argument("-a", "--asciioffset", help = "If PhredScore has letters, ascii offset will be 33, otherwise it will be 64. Most recent version of Illumina uses Phred Score offset of 33. ", default = 33, type = int)
-parser.add_argument("-e", "--excludeReads", help = "If specified, output txt.gz files containing reads excluded from the count files.", action = 'store_true')
-args = parser.parse_args()
-
-experimentDirectory = args.pathExperiment
-
-#Making the directory for output files.
-outFileDirectory = os.path.join(experimentDirectory, "analyzed", args.sampleName, 'extractedBarcodeData') 
-if not os.path.exists(outFileDirectory):
-    os.makedirs(outFileDirectory)
-
-if args.outFilePrefix is not None:
-    outFilePrefix = args.outFilePrefix
-else:
-    outFilePrefix = args.sampleName
-
-if args.checkVector == 'both':
-	outFileUMI = outFilePrefix + "_UMI.gz"
-	outFileCounts = outFilePrefix + "_counts.gz"
-	outFileUMICounts = outFilePrefix + "_UMICountsOnly.gz"
-	outFileReadCounts = outFilePrefix + "_readCountsOnly.gz"
-elif args.checkVector == 'before':
-	outFileUMI = outFilePrefix + "_Index_liberal.gz"
-	outFileCounts = outFilePrefix + "_counts_liberal.gz"
-	outFileUMICounts = outFilePrefix + "_UMICountsOnly_liberal.gz"
-	outFileReadCounts = outFilePrefix + "_readCountsOnly_liberal.gz"
-
-outFileMissingBeforeBarcode = outFilePrefix + "_missingBeforeBarcode.gz"
-outFileMissingAfterBarcode = outFilePrefix + "_missingAfterBarcode.gz"
-outFileBadLength = outFilePrefix + "_badLength.gz"
-outFileBadPhred = outFilePrefix + "_badPhred.gz"
-staggerLength = args.stagger
-minPhred = int(args.minPhred)
-print(minPhred)
-asciioffset = int(args.asciioffset)
-print(asciioffset)
-barcodeLength = int(args.barcodeLength)
-print(barcodeLength)
-
-# Moving to sample directory 
-os.chdir(os.path.join(experimentDirectory, "raw", args.sampleName))
-
-# Printing an update that the parsing for this sample has begun
-print("Parsing sample {}".format(args.sampleName))
-
-inFileNames = glob.glob("*fastq*")
-
-#Filter the barcode
-if args.checkVector == "both":
-	barcode_dict, missingBeforeBarcode, missingAfterBarcode, badQscore, badLength, badBarcode, tot_reads = parseBarcode_both(inFileNames, args.stagger, barcodeLength, minPhred, asciioffset)
-elif args.checkVector == "before":
-	barcode_dict, missingBeforeBarcode, badQscore, badLength, badBarcode, tot_reads = parseBarcode_before(inFileNames, args.stagger, barcodeLength, minPhred, asciioffset)
-
-
-#Writing out barcode and associated phredscore and UMIs to file. 
-os.chdir(outFileDirectory)
-writeOutFileUMIs(barcode_dict, outFileUMI)             
-
-# If excluded reads are true, bad Barcodes are also written with each issue in a separate file
-if args.excludeReads == True:
-	writeOutFileBadSeqRecord(missingBeforeBarcode, outFileMissingBeforeBarcode)
-	check_file_created(outFileMissingBeforeBarcode)
-	writeOutFileBadSeqRecord(badQscore, outFileBadPhred)
-	check_file_created(outFileBadPhred)
-	writeOutFileBadSeqRecord(badBarcode, outFileBadLength)
-	check_file_created(outFileBadLength)
+def build_parser():
+	"""Function to build the command line parser of this script. Envelope.py uses it to run samples in its own worker processes."""
+	parser = ArgumentParser()
+	parser.add_argument("pathExperiment", help = "Specify the path to the experiment directory")
+	parser.add_argument("sampleName", help = "Specify the name of sample directory containing the fastq.gz files")
+	parser.add_argument("-o", "--outFilePrefix", help = "Specify the output file prefix for table of barcodes and UMIs. If none specified, will use sampleDirectory") 
+	parser.add_argument("-s", "--stagger", help = "Specify the length of the stagger.", type=int, default = 0)
+	parser.add_argument("-r", "--includeReads", help = "If specified, output additional tables with barcodes and only read counts or UMI counts. Otherwise outputs only one table with both counts", action = 'store_true')
+	parser.add_argument("-checkVector", help = "Option to check vector sequence before or on both sides of the barcode sequence.", default = "both", choices = ["both", "before"]) 
+	parser.add_argument("-barcodeLength", help = "If checkVector before specified, input here your desired barcode length.", type = int) 
+	parser.add_argument("-Q", "--minPhred", help = "Specify the minimum phredscore required to include a readout. Filters reads with more than 5 bases before the barcode with low phredscore.", default = 14, type = int) 
+	parser.add_argument("-a", "--asciioffset", help = "If PhredScore has letters, ascii offset will be 33, otherwise it will be 64. Most recent version of Illumina uses Phred Score offset of 33. ", default = 33, type = int)
+	parser.add_argument("-e", "--excludeReads", help = "If specified, output txt.gz files containing reads excluded from the count files.", action = 'store_true')
+	parser.add_argument("-w", "--workers", help = "Number of processes used to parse this sample. Reads are split into chunks and merged back in file order, so the outputs do not depend on this number.", default = 1, type = int)
+	parser.add_argument("--chunkSize", help = "Number of reads per chunk when --workers is more than 1.", default = DEFAULT_CHUNK_SIZE, type = int)
+	parser.add_argument("--exportCombined", help = "If specified, also write all lane files of the sample into raw/<sample>/<sample>_combined.fastq.gz. The reads are parsed straight from the lane files either way.", action = 'store_true')
+	parser.add_argument("--maxLowQuality", help = "Reject a read when this many bases of the GFP vector before the barcode have a phredscore below --minPhred.", default = 5, type = int)
+	parser.add_argument("--minMeanQuality", help = "If specified, also reject reads whose mean phredscore over the whole read is below this value.", default = None, type = float)
+	parser.add_argument("--minBarcodeQuality", help = "If specified, also reject reads with any base in the barcode window below this phredscore.", default = None, type = int)
+	parser.add_argument("--qualityBatch", help = "If specified, check the quality of each batch of reads at once with NumPy instead of read by read. The same reads are rejected either way.", action = 'store_true')
+	parser.add_argument("--homopolymerLength", help = "Length of a single-base run (e.g. AAAA) that rejects a read as a bad barcode.", default = 4, type = int)
+	parser.add_argument("--homopolymerBases", help = "Bases checked for homopolymer runs, in the order they are checked and reported.", default = "ATGC", type = str)
+	parser.add_argument("--nLength", help = "Length of a run of unknown nucleotides (N) that rejects a read as a bad barcode. 0 disables the check.", default = 2, type = int)
+	parser.add_argument("--aggregation", help = "How reads are counted per barcode. 'list' keeps one UMI per read; 'compact' keeps a read counter and a per-UMI counter, so memory grows with unique barcode/UMI pairs. The _UMI file then lists each UMI once per read, grouped by UMI.", default = "list", choices = ["list", "compact"])
+	parser.add_argument("--gzipLevel", help = "gzip compression level (1-9) of the barcode tables. Lower is faster and gives bigger files.", default = DEFAULT_GZIP_LEVEL, type = int, choices = range(1, 10))
+	parser.add_argument("--tableFormat", help = "Format of the barcode count tables. 'npz' writes the _UMI text table plus a binary <prefix>_barcodes.npz that Step 2 loads directly (the text count tables can be exported from it with barcodeTable.py); 'both' writes all text tables and the .npz.", default = "tsv", choices = ["tsv", "npz", "both"])
+	parser.add_argument("--serialWrite", help = "If specified, compress the barcode tables one after another instead of in parallel threads.", action = 'store_true')
+	parser.add_argument("--noExactFirst", help = "If specified, do not look for exact copies of the vectors with a plain string search before the mismatch search. The matches are the same either way.", action = 'store_true')
+	parser.add_argument("--anchored", help = "If specified, look for each vector in a window around its usual position first and only scan the whole read when it is not found there. The position is learned from the first --anchorReads reads.", action = 'store_true')
+	parser.add_argument("--anchorReads", help = "Number of reads used to learn the usual vector positions for --anchored.", default = 1000, type = int)
+	parser.add_argument("--anchorSlack", help = "Number of positions either side of the usual vector position searched with --anchored. By default the distance that covers 95%% of the learned positions.", default = None, type = int)
+	parser.add_argument("--readCacheSize", help = "Number of distinct read sequences whose vector matches are remembered (per worker), so identical reads are matched once. 0 turns the cache off.", default = 100000, type = int)
+	parser.add_argument("--pairedEnd", help = "If specified, read the R1 and R2 files of the sample together. R1 reads too short to reach the end of the amplicon are extended with their R2 mate where the two overlap.", action = 'store_true')
+	parser.add_argument("--umiFromHeader", help = "If specified, take the UMI from the end of the read name (after the last --umiHeaderSeparator) instead of the bases before the vector.", action = 'store_true')
+	parser.add_argument("--umiHeaderSeparator", help = "Character before the UMI in the read name for --umiFromHeader.", default = ":", type = str)
+	parser.add_argument("--checkpointEvery", help = "Save the partial results of the sample every this many reads, so an interrupted run can be continued with --resume. Checkpoints are off unless this or --resume is given; with --resume alone they are saved every {} reads. 0 turns checkpoints off.".format(DEFAULT_CHECKPOINT_INTERVAL), default = None, type = int)
+	parser.add_argument("--resume", help = "If specified, continue from the checkpoint of an interrupted run of this sample with the same settings. Without a checkpoint the sample is parsed from the start.", action = 'store_true')
+	parser.add_argument("--incremental", help = "If specified, keep the results of the sample and a manifest of the input files they cover next to the outputs. A later run with the same settings then only parses the lane files added since (e.g. a re-sequencing top-up) and merges them into the saved counts and summary. The barcodes, counts and rejected reads are those of a full run, but the lanes of earlier runs come first instead of being read in turn with the new ones, so rows and UMIs can be in another order.", action = 'store_true')
+	parser.add_argument("--profile", help = "If specified, write the time and reads per second of each parse stage, the reject counts and the peak memory of the sample (of this process and of its largest worker) to <sample>_profile.json next to the summary, and the read cache and exact match statistics to the summary. With --workers the stage times are added up over the workers.", action = 'store_true')
+	parser.add_argument("--matcher", help = "Engine used to find the vector sequences. 'bitparallel' gives the same matches as 'legacy' in a single pass over the read.", default = "legacy", choices = list(MATCHERS))
+	return parser
+
+
+def extract_sample(args):
+	"""Function to extract the barcodes of one sample from the parsed command line arguments and write its tables and summary.
+	Returns the number of reads parsed."""
+	# parse_sample changes the working directory, so the caller's one is put back once the sample is done, also when it fails
+	# (Envelope.py runs the next samples in the same worker process)
+	startDirectory = os.getcwd()
+	peakMemory = SamplePeakMemory() if args.profile else None
+	try:
+		return parse_sample(args, peakMemory)
+	finally:
+		if peakMemory is not None:
+			peakMemory.stop()
+		os.chdir(startDirectory)
+
+
+def parse_sample(args, peakMemory=None):
+	"""Function to do the work of extract_sample, from the directories of the sample. Returns the number of reads parsed.
+	peakMemory is the SamplePeakMemory started for the sample when it is profiled."""
+	# The working directory is changed below, so the experiment path is made absolute first
+	experimentDirectory = os.path.abspath(args.pathExperiment)
+
+	#Making the directory for output files.
+	outFileDirectory = os.path.join(experimentDirectory, "analyzed", args.sampleName, 'extractedBarcodeData') 
+	if not os.path.exists(outFileDirectory):
+		os.makedirs(outFileDirectory)
+
+	if args.outFilePrefix is not None:
+		outFilePrefix = args.outFilePrefix
+	else:
+		outFilePrefix = args.sampleName
+
+	if args.checkVector == 'both':
+		outFileUMI = outFilePrefix + "_UMI.gz"
+		outFileCounts = outFilePrefix + "_counts.gz"
+		outFileUMICounts = outFilePrefix + "_UMICountsOnly.gz"
+		outFileReadCounts = outFilePrefix + "_readCountsOnly.gz"
+		outFileTable = outFilePrefix + "_barcodes.npz"
+		outFileState = outFilePrefix + "_state.pkl"
+		outFileManifest = outFilePrefix + "_manifest.json"
+	elif args.checkVector == 'before':
+		outFileUMI = outFilePrefix + "_Index_liberal.gz"
+		outFileCounts = outFilePrefix + "_counts_liberal.gz"
+		outFileUMICounts = outFilePrefix + "_UMICountsOnly_liberal.gz"
+		outFileReadCounts = outFilePrefix + "_readCountsOnly_liberal.gz"
+		outFileTable = outFilePrefix + "_barcodes_liberal.npz"
+		outFileState = outFilePrefix + "_state_liberal.pkl"
+		outFileManifest = outFilePrefix + "_manifest_liberal.json"
+
+	outFileMissingBeforeBarcode = outFilePrefix + "_missingBeforeBarcode.gz"
+	outFileMissingAfterBarcode = outFilePrefix + "_missingAfterBarcode.gz"
+	outFileBadLength = outFilePrefix + "_badLength.gz"
+	outFileBadPhred = outFilePrefix + "_badPhred.gz"
+	staggerLength = args.stagger
+	minPhred = int(args.minPhred)
+	print(minPhred)
+	asciioffset = int(args.asciioffset)
+	print(asciioffset)
+	barcodeLength = int(args.barcodeLength)
+	print(barcodeLength)
+	matcher = get_matcher(args.matcher)
+	print("Using the {} matcher".format(args.matcher))
+	if args.anchored:
+		matcher = AnchoredMatcher(matcher, args.anchorReads, args.anchorSlack)
+	# Exact copies of the vectors are found with str.find, only the other reads need the mismatch search
+	if not args.noExactFirst:
+		matcher = ExactFirstMatcher(matcher)
+	umiSeparator = args.umiHeaderSeparator if args.umiFromHeader else None
+	homopolymerFilter = build_homopolymer_filter(args.homopolymerLength, args.homopolymerBases.upper(), args.nLength)
+	qualityGate = build_quality_gate(minPhred, asciioffset, args.maxLowQuality, args.minMeanQuality, args.minBarcodeQuality, barcodeLength, args.qualityBatch)
+
+	# Moving to sample directory 
+	os.chdir(os.path.join(experimentDirectory, "raw", args.sampleName))
+
+	# Printing an update that the parsing for this sample has begun
+	print("Parsing sample {}".format(args.sampleName))
+
+	# Lane files are read in name order; a combined file from an earlier export is not an input
+	inFileNames = sorted(glob.glob("*fastq*"))
+	if inFileNames:
+		inFileNames = [f for f in inFileNames if f != combined_file_name(inFileNames)]
+
+	if not args.pairedEnd and any("_R2" in f for f in inFileNames):
+		print("Warning: R2 files found, they are parsed as single-end reads unless --pairedEnd is given")
+
+	settings = {name: value for name, value in vars(args).items() if name not in RUN_ONLY_ARGUMENTS}
+
+	# With --incremental only the input files the saved results of an earlier run do not cover are parsed
+	sampleState = None
+	parseFileNames = inFileNames
+	if args.incremental:
+		sampleState = SampleState(os.path.join(outFileDirectory, outFileState), os.path.join(outFileDirectory, outFileManifest), settings)
+		parseFileNames = sampleState.new_files(inFileNames)
+		if sampleState.state is not None:
+			print("{} of {} input files were parsed by an earlier run, parsing the other {}".format(len(inFileNames) - len(parseFileNames), len(inFileNames), len(parseFileNames)))
+
+	# Checkpoints are kept next to the outputs; one is only resumed when the arguments and input files are the same
+	# and they are only saved when asked for, as saving them takes the run off the serial path when there is one worker
+	checkpoint = None
+	checkpointEvery = args.checkpointEvery
+	if checkpointEvery is None:
+		checkpointEvery = DEFAULT_CHECKPOINT_INTERVAL if args.resume else 0
+	if checkpointEvery > 0:
+		settings = dict(settings, inputFiles = [(f, os.path.getsize(f), os.path.getmtime(f)) for f in parseFileNames])
+		checkpoint = Checkpoint(os.path.join(outFileDirectory, outFilePrefix + "_checkpoint.pkl"), checkpointEvery, settings)
+		if args.resume:
+			readsDone = checkpoint.load()
+			print("Found a checkpoint after read {}".format(readsDone) if readsDone else "No checkpoint to resume from")
+
+	# The combined file is only written when it is asked for, and not again when resuming
+	if args.exportCombined and not (checkpoint is not None and checkpoint.state is not None and os.path.exists(combined_file_name(inFileNames))):
+		combine_fastq(inFileNames)
+
+	# Rejected reads are written out while the sample is parsed if excluded reads are true, each issue in a separate file.
+	# Otherwise only the number of reads rejected for each issue is kept.
+	# When resuming, the files are continued from where the checkpoint left them, and with saved results from an earlier run from where that run left them.
+	def reject_sink(outFileName):
+		if args.excludeReads == True:
+			outFilePath = os.path.join(outFileDirectory, outFileName)
+			resumeSize = checkpoint.reject_file_size(outFilePath) if checkpoint is not None else None
+			if resumeSize is None and sampleState is not None:
+				resumeSize = sampleState.reject_file_size(outFilePath)
+			return RejectSink(outFilePath, resumeSize)
+		return RejectSink()
+
+	missingBeforeBarcode = reject_sink(outFileMissingBeforeBarcode)
+	badQscore = reject_sink(outFileBadPhred)
+	badLength = RejectSink()
+	badBarcode = reject_sink(outFileBadLength)
+	if args.checkVector == "both":
+		missingAfterBarcode = reject_sink(outFileMissingAfterBarcode)
+
+	#Filter the barcode
+	startTime = time.perf_counter()
 	if args.checkVector == "both":
-		writeOutFileBadSeqRecord(missingAfterBarcode, outFileMissingAfterBarcode)
-		check_file_created(outFileMissingAfterBarcode)
-
-barcode_counts_dict, UMI_counts = count_read_UMI(barcode_dict)                  
-    
-#Writing out barcode and associated read/UMI counts to file. 
-if args.includeReads:
-	writeOutFileBarcodeUMICounts(barcode_counts_dict,outFileUMICounts)
-	check_file_created(outFileUMICounts)
-	writeOutFileBarcodeCounts(barcode_counts_dict, outFileCounts)
-	check_file_created(outFileCounts)
-	writeOutFileBarcodeReadCounts(barcode_counts_dict, outFileReadCounts)
-	check_file_created(outFileReadCounts)
-else:
-	writeOutFileBarcodeCounts(barcode_counts_dict, outFileCounts)
-	check_file_created(outFileCounts)
-
-print("Writing Summary for {}".format(args.sampleName))
-# Writing the summary file for this sample
-summary_file = args.sampleName + "_summary.txt"
-with open(summary_file, "w") as summary:
-	summary.write("Number of reads parsed is {}\n".format(tot_reads))
-	summary.write("The number of unique barcode is {}\n".format(len(barcode_dict)))
-	summary.write("Number of reads missing sequence (GFP) before barcode is {}\n".format(len(missingBeforeBarcode)))
+		rejectSinks = (missingBeforeBarcode, missingAfterBarcode, badQscore, badLength, badBarcode)
+	elif args.checkVector == "before":
+		rejectSinks = (missingBeforeBarcode, badQscore, badLength, badBarcode)
+	if sampleState is not None and sampleState.state is not None and not parseFileNames:
+		# The saved results cover every input file, so nothing is parsed and the tables are written again from them
+		print("No new input files, writing the tables from the saved results")
+		results = ({},) + rejectSinks + (Counter(), Counter(), 0)
+	elif args.checkVector == "both":
+		results = parseBarcode_both(parseFileNames, args.stagger, barcodeLength, minPhred, asciioffset, matcher, args.workers, args.chunkSize, homopolymerFilter, args.aggregation == "compact", qualityGate, rejectSinks, args.readCacheSize, args.pairedEnd, umiSeparator, checkpoint)
+	elif args.checkVector == "before":
+		results = parseBarcode_before(parseFileNames, args.stagger, barcodeLength, minPhred, asciioffset, matcher, args.workers, args.chunkSize, homopolymerFilter, args.aggregation == "compact", qualityGate, rejectSinks, args.readCacheSize, args.pairedEnd, umiSeparator, checkpoint)
+
+	for sink in rejectSinks:
+		sink.close()
+	parseTime = time.perf_counter() - startTime
+
+	# The new files are added to the saved results, which are then saved again with all the input files
+	runReads = results[-1]
+	if sampleState is not None:
+		results = sampleState.merge(results)
+		sampleState.save(results, inFileNames)
+
 	if args.checkVector == "both":
-		summary.write("Number of reads missing sequence (GFP) after barcode is {}\n".format(len(missingAfterBarcode)))
-	summary.write("Number of reads having bad Q Score {}\n".format(len(badQscore)))
-	summary.write("Number of reads having bad barcode ('AAAA,''TTTT,' 'GGGG,' 'CCCC' ) {}\n".format(len(badBarcode)))
-	summary.write("Total number of reads is:{}\n".format(str(UMI_counts)))
+		barcode_dict, missingBeforeBarcode, missingAfterBarcode, badQscore, badLength, badBarcode, rejectReasons, parseStats, tot_reads = results
+	elif args.checkVector == "before":
+		barcode_dict, missingBeforeBarcode, badQscore, badLength, badBarcode, rejectReasons, parseStats, tot_reads = results
+	del results
+
+
+	os.chdir(outFileDirectory)
+
+	# If excluded reads are true, bad Barcodes were written with each issue in a separate file during parsing
+	if args.excludeReads == True:
+		check_file_created(outFileMissingBeforeBarcode)
+		check_file_created(outFileBadPhred)
+		check_file_created(outFileBadLength)
+		if args.checkVector == "both":
+			check_file_created(outFileMissingAfterBarcode)
+
+	#Writing out barcode and associated phredscore and UMIs, and the read/UMI counts, to file in one pass over the barcodes. 
+	# With the binary table only the _UMI table is written as text, the counts go into the .npz
+	outFileTables = {"UMI": outFileUMI}
+	if args.tableFormat != "npz":
+		outFileTables["counts"] = outFileCounts
+		if args.includeReads:
+			outFileTables["UMICounts"] = outFileUMICounts
+			outFileTables["readCounts"] = outFileReadCounts
+	columns = {} if args.tableFormat != "tsv" else None
+	startTime = time.perf_counter()
+	UMI_counts = writeOutFileTables(barcode_dict, outFileTables, args.gzipLevel, not args.serialWrite, columns)
+	if columns is not None:
+		save_barcode_table(outFileTable, columns["barcodes"], columns["reads"], columns["umis"])
+		del columns
+	parseStats[("seconds", "write")] += time.perf_counter() - startTime
+	for outFileName in outFileTables.values():
+		check_file_created(outFileName)
+	if args.tableFormat != "tsv":
+		check_file_created(outFileTable)
+
+	# The outputs are complete, so the checkpoint is not needed any more
+	if checkpoint is not None:
+		checkpoint.remove()
+
+	print("Writing Summary for {}".format(args.sampleName))
+	# Writing the summary file for this sample
+	summary_file = args.sampleName + "_summary.txt"
+	with open(summary_file, "w") as summary:
+		summary.write("Number of reads parsed is {}\n".format(tot_reads))
+		summary.write("The number of unique barcode is {}\n".format(len(barcode_dict)))
+		summary.write("Number of reads missing sequence (GFP) before barcode is {}\n".format(len(missingBeforeBarcode)))
+		if args.checkVector == "both":
+			summary.write("Number of reads missing sequence (GFP) after barcode is {}\n".format(len(missingAfterBarcode)))
+		summary.write("Number of reads having bad Q Score {}\n".format(len(badQscore)))
+		# The lines of the options that are not on by default are only written when they are used, so a default run gives the usual summary
+		if args.minMeanQuality is not None or args.minBarcodeQuality is not None:
+			# Which quality policy rejected the read, the first one that fails wins
+			for policy in QUALITY_POLICIES:
+				summary.write("\tBad Q Score due to {}: {}\n".format(policy, rejectReasons[("badQscore", policy)]))
+		if homopolymerFilter == build_homopolymer_filter():
+			summary.write("Number of reads having bad barcode ('AAAA,''TTTT,' 'GGGG,' 'CCCC' ) {}\n".format(len(badBarcode)))
+		else:
+			summary.write("Number of reads having bad barcode ({}) {}\n".format(", ".join("'{}'".format(rule) for rule, run in homopolymerFilter), len(badBarcode)))
+			# Which rule rejected the read, the first one in the list above that matches wins
+			for rule, run in homopolymerFilter:
+				summary.write("\tBad barcode due to {}: {}\n".format(rule, rejectReasons[("badBarcode", rule)]))
+		summary.write("Total number of reads is:{}\n".format(str(UMI_counts)))
+		if args.incremental:
+			summary.write("Input files parsed in the last run: {} of {}\n".format(len(parseFileNames), len(inFileNames)))
+		if args.pairedEnd:
+			summary.write("Number of read pairs whose R1 was extended with R2 is {} of {}\n".format(parseStats[("pairs", "extended")], parseStats[("pairs", "read")]))
+		# The read cache and the exact search are on by default, so their statistics are only written with --profile
+		if args.profile and args.readCacheSize > 0:
+			# How many reads were identical to one already matched
+			hits = parseStats[("readCache", "hits")]
+			summary.write("Read cache ({} sequences): {} of {} reads were repeats ({:.1f}%), {} sequences evicted\n".format(args.readCacheSize, hits, hits + parseStats[("readCache", "misses")], 100 * hits / tot_reads if tot_reads else 0, parseStats[("readCache", "evictions")]))
+		if args.profile and not args.noExactFirst:
+			# How often an exact copy of the vector made the mismatch search unnecessary
+			for side in ("before", "after"):
+				hits = parseStats[("exactHit", side)]
+				searched = hits + parseStats[("exactMiss", side)]
+				if searched:
+					summary.write("Exact match of the vector {} the barcode: found for {} of {} searches ({:.1f}%)\n".format(side, hits, searched, 100 * hits / searched))
+		if args.anchored:
+			# How often the vector was found in the window around its learned position
+			anchoredMatcher = matcher.matcher if isinstance(matcher, ExactFirstMatcher) else matcher
+			for (side, pattern), (offset, slack) in anchoredMatcher.anchors.items():
+				hits = parseStats[("anchorHit", side)]
+				searched = hits + parseStats[("anchorMiss", side)]
+				summary.write("Anchored search of the vector {} the barcode at {} +/- {}: found in the window for {} of {} searches ({:.1f}%)\n".format(side, offset, slack, hits, searched, 100 * hits / searched if searched else 0))
+
+	if args.profile:
+		# Machine readable profile of this run, to compare runs with each other
+		rejected = {"missingBeforeBarcode": len(missingBeforeBarcode), "badQscore": len(badQscore), "badLength": len(badLength), "badBarcode": len(badBarcode)}
+		if args.checkVector == "both":
+			rejected["missingAfterBarcode"] = len(missingAfterBarcode)
+		profile = {
+			"sample": args.sampleName,
+			"checkVector": args.checkVector,
+			"matcher": args.matcher,
+			"workers": args.workers,
+			"reads": tot_reads,
+			"readsThisRun": runReads,
+			"uniqueBarcodes": len(barcode_dict),
+			"wallSeconds": {"parse": parseTime, "write": parseStats[("seconds", "write")]},
+			"stages": {stage: {"seconds": parseStats[("seconds", stage)],
+							   "readsPerSecond": runReads / parseStats[("seconds", stage)] if parseStats[("seconds", stage)] > 0 else None}
+					   for stage in PARSE_STAGES},
+			"rejected": rejected,
+			"counters": {"{}:{}".format(category, name): count for (category, name), count in sorted(parseStats.items()) if category != "seconds"},
+			"rejectReasons": {"{}:{}".format(category, rule): count for (category, rule), count in sorted(rejectReasons.items())},
+			"peakRSSMB": peakMemory.peaks() if peakMemory is not None else lifetime_peaks(),
+		}
+		profile_file = args.sampleName + "_profile.json"
+		with open(profile_file, "w") as profileOut:
+			json.dump(profile, profileOut, indent = 2)
+		check_file_created(profile_file)
 
-print("Finished parsing Sample {}".format(args.sampleName))
+	print("Finished parsing Sample {}".format(args.sampleName))
+	return tot_reads
 
 
+def main(argv=None):
+	args = build_parser().parse_args(argv)
+	extract_sample(args)
 
 
+if __name__ == "__main__":
+	main()
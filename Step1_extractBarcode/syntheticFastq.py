@@ -0,0 +1,202 @@
+'''
+Note about the script:
+Writes a synthetic sample of gzipped single end FASTQ lane files laid out like the amplicon parseFastqMain.py expects, so Step 1 can be
+timed and compared without patient data (see benchmarkStep1.py). Every read is built as:
+	UMI (umiMin-umiMax random bases) + stagger (random bases) + GFP vector before the barcode + barcode + GFP vector after the barcode + random tail up to readLength
+The barcodes are drawn from a pool of --barcodes sequences with Zipf-like abundances (--skew), and the reads are damaged in the ways Step 1 checks for:
+	1. substitutions in the vectors (--vectorErrorRate per base) and reads with one vector scrambled (--missingVectorRate)
+	2. barcodes of the pool carrying a homopolymer run such as AAAA (--homopolymerRate)
+	3. unknown bases (N) anywhere in the read (--nRate per base)
+	4. reads cut short before the end of the amplicon (--truncateRate) and reads of random bases only (--junkRate)
+	5. phred scores following a quality profile (good, typical or poor) that drops along the read, with some very low quality (#) bases
+
+The output is <experiment path>/raw/<sample name>/<sample name>_L00<lane>_R1_001.fastq.gz, the reads split evenly over --lanes lanes.
+The same --seed always gives the same files.
+
+Command to run this file: python3 <path to syntheticFastq.py> <path to Experiment> <Sample Name> --reads <number of reads> --lanes <number of lanes> -s <Stagger Length> --seed <seed>
+-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------'''
+
+import os
+import gzip
+from argparse import ArgumentParser
+import numpy as np
+
+# The vector sequences parseBarcode_both / parseBarcode_before look for on each side of the barcode
+VECTOR_BEFORE_BARCODE = "TCGACTAAACGCGCTACTTGAT"
+VECTOR_AFTER_BARCODE = "ATCCTACTTGTACAGCTCGT"
+BASE_BYTES = np.frombuffer(b"ACGT", dtype=np.uint8)
+# Phred score at the start and at the end of the read, and the fraction of bases that drop to a score of 2 (#), per profile
+QUALITY_PROFILES = {
+    "good": (36, 32, 0.01),
+    "typical": (36, 26, 0.04),
+    "poor": (32, 14, 0.12),
+}
+# Number of reads built at a time; the read and quality matrices of a batch are held in memory together
+GENERATE_BATCH_SIZE = 20000
+
+
+def random_bases(rng, shape, maxRun=None):
+    """
+    Function to draw random A, C, G, T bases as an array of ASCII codes. With maxRun, runs of the same base along the last
+    axis are cut at maxRun bases: Step 1 rejects whole reads with a run of 4, and designed barcode libraries avoid them too.
+    """
+    codes = rng.integers(0, 4, size=shape)
+    if maxRun is not None:
+        for column in range(maxRun, codes.shape[-1]):
+            inRun = np.ones(codes.shape[:-1], dtype=bool)
+            for back in range(1, maxRun + 1):
+                inRun &= codes[..., column - back] == codes[..., column]
+            # Shift the base that would make the run too long to one of the other three
+            codes[..., column][inRun] = (codes[..., column][inRun] + rng.integers(1, 4, size=int(inRun.sum()))) % 4
+    return BASE_BYTES[codes]
+
+
+def make_barcode_pool(rng, barcodes, barcodeLength, homopolymerRate=0.05, homopolymerLength=4):
+    """
+    Function to make the pool of barcodes the reads are drawn from. A fraction homopolymerRate of them gets a run of
+    homopolymerLength identical bases at a random position, which Step 1 rejects as a bad barcode.
+
+    Returns:
+    numpy.ndarray: uint8 array of shape (barcodes, barcodeLength) with the ASCII codes of the bases
+    """
+    pool = random_bases(rng, (barcodes, barcodeLength), homopolymerLength - 1)
+    withRun = np.flatnonzero(rng.random(barcodes) < homopolymerRate)
+    starts = rng.integers(0, barcodeLength - homopolymerLength + 1, size=len(withRun))
+    runBases = random_bases(rng, len(withRun))
+    for offset in range(homopolymerLength):
+        pool[withRun, starts + offset] = runBases
+    return pool
+
+
+def barcode_weights(barcodes, skew=1.0):
+    """Function to give the barcodes of the pool Zipf-like abundances: the barcode of rank r is drawn with a weight of 1 / r^skew."""
+    weights = 1.0 / np.arange(1, barcodes + 1) ** skew
+    return weights / weights.sum()
+
+
+def quality_matrix(rng, reads, readLength, profile="typical", asciioffset=33):
+    """Function to draw the phred scores of a batch of reads from a quality profile, as ASCII codes."""
+    startQuality, endQuality, lowFraction = QUALITY_PROFILES[profile]
+    scores = np.linspace(startQuality, endQuality, readLength) + rng.normal(0, 2, size=(reads, readLength))
+    scores[rng.random((reads, readLength)) < lowFraction] = 2
+    return (np.clip(np.rint(scores), 2, 41) + asciioffset).astype(np.uint8)
+
+
+def synthetic_reads(rng, reads, pool, weights, stagger=0, umiMin=4, umiMax=8, readLength=150, vectorErrorRate=0.02,
+                    missingVectorRate=0.03, nRate=0.001, truncateRate=0.05, junkRate=0.01, profile="typical"):
+    """
+    Function to build a batch of reads. All reads are laid out in one matrix with room for the longest UMI, and each read
+    is the readLength bases starting where its own UMI starts.
+
+    Returns:
+    tuple: (read matrix, quality matrix (one row per read, from its first base), start of each read in the read matrix, length of each read)
+    """
+    barcodeLength = pool.shape[1]
+    vectorBefore = np.frombuffer(VECTOR_BEFORE_BARCODE.encode(), dtype=np.uint8)
+    vectorAfter = np.frombuffer(VECTOR_AFTER_BARCODE.encode(), dtype=np.uint8)
+    vectorStart = umiMax + stagger
+    barcodeStart = vectorStart + len(vectorBefore)
+    afterStart = barcodeStart + barcodeLength
+    width = umiMax + max(readLength, stagger + len(vectorBefore) + barcodeLength + len(vectorAfter))
+
+    # Random bases everywhere (UMI, stagger and tail), then the vectors and barcodes on top
+    sequences = random_bases(rng, (reads, width), 3)
+    sequences[:, vectorStart:barcodeStart] = vectorBefore
+    sequences[:, barcodeStart:afterStart] = pool[rng.choice(len(pool), size=reads, p=weights)]
+    sequences[:, afterStart:afterStart + len(vectorAfter)] = vectorAfter
+
+    # Sequencing errors in the vectors, and reads where one of the vectors is lost altogether
+    for start, length in ((vectorStart, len(vectorBefore)), (afterStart, len(vectorAfter))):
+        errors = rng.random((reads, length)) < vectorErrorRate
+        sequences[:, start:start + length][errors] = random_bases(rng, int(errors.sum()))
+    missing = np.flatnonzero(rng.random(reads) < missingVectorRate)
+    missingBefore = rng.random(len(missing)) < 0.5
+    for scrambled, start, length in ((missing[missingBefore], vectorStart, len(vectorBefore)), (missing[~missingBefore], afterStart, len(vectorAfter))):
+        sequences[scrambled, start:start + length] = random_bases(rng, (len(scrambled), length))
+
+    # Reads of random bases only, and unknown bases anywhere
+    junk = np.flatnonzero(rng.random(reads) < junkRate)
+    sequences[junk] = random_bases(rng, (len(junk), width))
+    sequences[rng.random((reads, width)) < nRate] = ord("N")
+
+    starts = umiMax - rng.integers(umiMin, umiMax + 1, size=reads)
+    lengths = np.full(reads, readLength)
+    truncated = np.flatnonzero(rng.random(reads) < truncateRate)
+    lengths[truncated] = rng.integers(30, readLength, size=len(truncated))
+    return sequences, quality_matrix(rng, reads, readLength, profile), starts, lengths
+
+
+def write_synthetic_sample(experimentPath, sampleName, reads=100000, lanes=2, seed=1, barcodes=10000, barcodeLength=90, skew=1.0,
+                           homopolymerRate=0.05, compresslevel=1, **readOptions):
+    """
+    Function to write a synthetic sample to <experimentPath>/raw/<sampleName>, the reads split evenly over the lane files.
+    readOptions are passed on to synthetic_reads (stagger, umiMin, umiMax, readLength, vectorErrorRate, missingVectorRate,
+    nRate, truncateRate, junkRate, profile). Random bases compress slowly, so the files are written at gzip level 1 by default.
+
+    Returns:
+    list: paths of the lane files written
+    """
+    rng = np.random.default_rng(seed)
+    pool = make_barcode_pool(rng, barcodes, barcodeLength, homopolymerRate)
+    weights = barcode_weights(barcodes, skew)
+
+    sampleDirectory = os.path.join(experimentPath, "raw", sampleName)
+    os.makedirs(sampleDirectory, exist_ok=True)
+    laneReads = [reads // lanes + (1 if lane < reads % lanes else 0) for lane in range(lanes)]
+    fileNames = []
+    for lane, count in enumerate(laneReads, 1):
+        fileName = os.path.join(sampleDirectory, f"{sampleName}_L{lane:03d}_R1_001.fastq.gz")
+        with gzip.open(fileName, "wb", compresslevel=compresslevel) as out_file:
+            for batchStart in range(0, count, GENERATE_BATCH_SIZE):
+                batchReads = min(GENERATE_BATCH_SIZE, count - batchStart)
+                sequences, qualities, starts, lengths = synthetic_reads(rng, batchReads, pool, weights, **readOptions)
+                records = []
+                for i in range(batchReads):
+                    start, end = starts[i], starts[i] + lengths[i]
+                    records.append(b"@SYN:%d:%d 1:N:0:1\n%s\n+\n%s\n" % (lane, batchStart + i, sequences[i, start:end].tobytes(), qualities[i, :lengths[i]].tobytes()))
+                out_file.write(b"".join(records))
+        fileNames.append(fileName)
+    return fileNames
+
+
+def add_generator_arguments(parser):
+    """Function to add the options of the synthetic reads to a command line parser (shared with benchmarkStep1.py)."""
+    parser.add_argument("--lanes", help = "Number of lane files the reads are split over.", default = 2, type = int)
+    parser.add_argument("--seed", help = "Seed of the random generator; the same seed gives the same files.", default = 1, type = int)
+    parser.add_argument("--barcodes", help = "Number of distinct barcodes in the pool the reads are drawn from.", default = 10000, type = int)
+    parser.add_argument("--skew", help = "Zipf exponent of the barcode abundances. 0 draws all barcodes equally often.", default = 1.0, type = float)
+    parser.add_argument("-barcodeLength", help = "Length of the barcodes.", default = 90, type = int)
+    parser.add_argument("-s", "--stagger", help = "Length of the stagger between the UMI and the vector.", default = 0, type = int)
+    parser.add_argument("--umiMin", help = "Shortest UMI.", default = 4, type = int)
+    parser.add_argument("--umiMax", help = "Longest UMI.", default = 8, type = int)
+    parser.add_argument("--readLength", help = "Length of the reads that are not truncated.", default = 150, type = int)
+    parser.add_argument("--vectorErrorRate", help = "Probability of a substitution at each base of the vectors.", default = 0.02, type = float)
+    parser.add_argument("--missingVectorRate", help = "Fraction of reads with one of the two vectors replaced by random bases.", default = 0.03, type = float)
+    parser.add_argument("--homopolymerRate", help = "Fraction of the barcodes of the pool with a run of 4 identical bases.", default = 0.05, type = float)
+    parser.add_argument("--nRate", help = "Probability of an unknown base (N) at each position of a read.", default = 0.001, type = float)
+    parser.add_argument("--truncateRate", help = "Fraction of reads cut short at a random length.", default = 0.05, type = float)
+    parser.add_argument("--junkRate", help = "Fraction of reads made of random bases only.", default = 0.01, type = float)
+    parser.add_argument("--qualityProfile", help = "Phred score profile along the reads.", default = "typical", choices = list(QUALITY_PROFILES))
+    parser.add_argument("--gzipLevel", help = "gzip compression level (1-9) of the lane files.", default = 1, type = int, choices = range(1, 10))
+    return parser
+
+
+def generator_options(args):
+    """Function to turn the parsed options of add_generator_arguments into the keyword arguments of write_synthetic_sample."""
+    return {"lanes": args.lanes, "seed": args.seed, "barcodes": args.barcodes, "barcodeLength": args.barcodeLength, "skew": args.skew,
+            "homopolymerRate": args.homopolymerRate, "stagger": args.stagger, "umiMin": args.umiMin, "umiMax": args.umiMax,
+            "readLength": args.readLength, "vectorErrorRate": args.vectorErrorRate, "missingVectorRate": args.missingVectorRate,
+            "nRate": args.nRate, "truncateRate": args.truncateRate, "junkRate": args.junkRate, "profile": args.qualityProfile,
+            "compresslevel": args.gzipLevel}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("pathExperiment", help = "Specify the path to the experiment directory the raw/<sample> folder is written to")
+    parser.add_argument("sampleName", help = "Specify the name of the synthetic sample")
+    parser.add_argument("--reads", help = "Total number of reads of the sample.", default = 100000, type = int)
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    for fileName in write_synthetic_sample(args.pathExperiment, args.sampleName, args.reads, **generator_options(args)):
+        print(f"Written {fileName}")
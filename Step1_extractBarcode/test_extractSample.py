@@ -0,0 +1,30 @@
+import os
+import json
+import pytest
+from parseFastqMain import build_parser, extract_sample
+from syntheticFastq import write_synthetic_sample
+
+
+def test_failed_sample_puts_the_working_directory_back(tmp_path, monkeypatch):
+    # Envelope.py runs several samples in one worker process, so a failed sample must not leave it in the sample's folder
+    monkeypatch.chdir(tmp_path)
+    # A lane file that is not gzipped fails once the sample's raw folder is the working directory
+    os.makedirs(tmp_path / "raw" / "S1")
+    (tmp_path / "raw" / "S1" / "S1_L001_R1_001.fastq.gz").write_text("not gzipped\n")
+    with pytest.raises(OSError):
+        extract_sample(build_parser().parse_args([str(tmp_path), "S1", "-barcodeLength", "90"]))
+    assert os.getcwd() == str(tmp_path)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason = "needs the Linux /proc peak memory")
+def test_profile_peak_memory_is_that_of_the_sample(tmp_path):
+    # Envelope.py runs samples one after another in one process; memory used before the sample must not count as its peak
+    write_synthetic_sample(str(tmp_path), "S1", 500, 1, 1)
+    earlier = bytearray(400 * 1024 * 1024)
+    earlier[::4096] = b"x" * len(earlier[::4096])
+    del earlier
+    extract_sample(build_parser().parse_args([str(tmp_path), "S1", "-barcodeLength", "90", "--profile"]))
+    with open(os.path.join(tmp_path, "analyzed", "S1", "extractedBarcodeData", "S1_profile.json")) as profile:
+        peaks = json.load(profile)["peakRSSMB"]
+    assert peaks["scope"] == "sample"
+    assert 0 < peaks["main"] < 400
@@ -0,0 +1,43 @@
+import os
+import gzip
+import hashlib
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from parseFastqMain import main
+from syntheticFastq import write_synthetic_sample
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def write_paired_sample(experimentPath, sampleName, reads, lanes, seed):
+    # Synthetic R1 lanes, each with an R2 file holding the reverse complement of every read under the same read name
+    for read1File in write_synthetic_sample(experimentPath, sampleName, reads, lanes, seed, barcodes=200):
+        with gzip.open(read1File, "rt") as read1, gzip.open(read1File.replace("_R1_", "_R2_"), "wt") as read2:
+            for title, sequence, quality in FastqGeneralIterator(read1):
+                read2.write("@{}\n{}\n+\n{}\n".format(title.replace(" 1:", " 2:"), sequence.translate(COMPLEMENT)[::-1], quality[::-1]))
+
+
+def output_checksums(experimentPath, sampleName):
+    outputDirectory = os.path.join(experimentPath, "analyzed", sampleName, "extractedBarcodeData")
+    checksums = {}
+    for fileName in sorted(os.listdir(outputDirectory)):
+        if fileName.endswith(".gz"):
+            with gzip.open(os.path.join(outputDirectory, fileName), "rb") as table:
+                checksums[fileName] = hashlib.md5(table.read()).hexdigest()
+        elif fileName.endswith("_summary.txt"):
+            with open(os.path.join(outputDirectory, fileName)) as summary:
+                checksums[fileName] = [line for line in summary if not line.startswith("Input files parsed")]
+    return checksums
+
+
+def test_paired_end_incremental_rerun_without_new_files(tmp_path):
+    experimentPath = str(tmp_path)
+    write_paired_sample(experimentPath, "S1", 2000, 2, 3)
+    arguments = [experimentPath, "S1", "-r", "-e", "-barcodeLength", "90", "--pairedEnd", "--incremental"]
+
+    main(arguments)
+    firstRun = output_checksums(experimentPath, "S1")
+    # Every lane pair is covered by the saved results, so the second run parses nothing and writes the same tables
+    main(arguments)
+    assert output_checksums(experimentPath, "S1") == firstRun
+    with open(os.path.join(experimentPath, "analyzed", "S1", "extractedBarcodeData", "S1_summary.txt")) as summary:
+        assert "Input files parsed in the last run: 0 of 4\n" in summary.read()
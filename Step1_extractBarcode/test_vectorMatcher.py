@@ -0,0 +1,55 @@
+import random
+import vectorMatcher
+from extractionFunctions import find_best_match
+from vectorMatcher import find_best_match_bitparallel, build_match_masks, FIELD_HIGH
+
+
+def random_sequence(rng, length, alphabet="ACGT"):
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def mutate(rng, sequence, count):
+    sequence = list(sequence)
+    for position in rng.sample(range(len(sequence)), count):
+        sequence[position] = rng.choice([base for base in "ACGTN" if base != sequence[position]])
+    return "".join(sequence)
+
+
+def reads_with_pattern(rng, pattern, count):
+    reads = []
+    for _ in range(count):
+        # Vectors with a few mismatches, truncated at the end of the read, or absent
+        vector = mutate(rng, pattern, rng.randint(0, 4))[:len(pattern) - rng.choice([0, 0, 1, 3])]
+        reads.append(random_sequence(rng, rng.randint(0, 20)) + vector + random_sequence(rng, rng.choice([0, 10])))
+        reads.append(random_sequence(rng, 70, "ACGTN"))
+    return reads
+
+
+def test_bitparallel_matches_legacy():
+    rng = random.Random(1)
+    pattern = random_sequence(rng, 22)
+    for max_errors in (0, 2, 5):
+        for read in reads_with_pattern(rng, pattern, 200):
+            assert find_best_match_bitparallel(read, pattern, max_errors, "before") == find_best_match(read, pattern, max_errors, "before")
+
+
+def test_long_patterns_and_large_error_budgets_fall_back_to_legacy(monkeypatch):
+    rng = random.Random(2)
+    long_pattern = random_sequence(rng, 40)
+    short_pattern = random_sequence(rng, 20)
+    # These would carry one 6-bit counter into the next, so no masks are built for them
+    assert build_match_masks(long_pattern, 3) is None
+    assert build_match_masks(short_pattern, FIELD_HIGH) is None
+    assert build_match_masks(random_sequence(rng, FIELD_HIGH), FIELD_HIGH - 1) is not None
+
+    calls = []
+
+    def legacy(sequence, pattern, max_errors, before_or_after):
+        calls.append(pattern)
+        return find_best_match(sequence, pattern, max_errors, before_or_after)
+
+    monkeypatch.setattr(vectorMatcher, "find_best_match", legacy)
+    for pattern, max_errors in ((long_pattern, 3), (short_pattern, FIELD_HIGH)):
+        for read in reads_with_pattern(rng, pattern, 50):
+            assert find_best_match_bitparallel(read, pattern, max_errors, "after") == find_best_match(read, pattern, max_errors, "after")
+    assert len(calls) == 200
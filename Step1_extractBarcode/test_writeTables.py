@@ -0,0 +1,31 @@
+import gzip
+import threading
+import extractionFunctions
+from extractionFunctions import writeOutFileTables
+
+
+class FailingCloseFile(gzip.GzipFile):
+    # Stands in for a disk that fills up at the final flush of a table
+    def close(self):
+        super().close()
+        raise OSError("No space left on device")
+
+
+def test_write_tables_reports_an_error_raised_when_closing(tmp_path, monkeypatch):
+    monkeypatch.setattr(extractionFunctions.gzip, "open", lambda fileName, mode, compresslevel: FailingCloseFile(fileName, mode, compresslevel))
+    barcode_dict = {"ACGT": ["FFFF", "AAAA", "CCCC"], "TTGA": ["FFFF", "GGGG"]}
+    outFileNames = {table: str(tmp_path / (table + ".gz")) for table in ("UMI", "counts")}
+    raised = []
+
+    def write():
+        try:
+            writeOutFileTables(barcode_dict, outFileNames)
+        except OSError as error:
+            raised.append(error)
+
+    # The writer threads have already taken the last block when the close fails, so the error must come back instead of a hang
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    writer.join(timeout=20)
+    assert not writer.is_alive()
+    assert len(raised) == 1 and "No space left" in str(raised[0])
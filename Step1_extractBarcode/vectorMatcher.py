@@ -0,0 +1,265 @@
+# This contains the matcher engines used to locate the GFP vector sequences in a read.
+# The bit-parallel engine returns exactly what extractionFunctions.find_best_match returns,
+# it just gets there in one pass over the read instead of one sliding-window scan per truncation length.
+
+from collections import Counter, defaultdict
+from itertools import islice, chain
+from extractionFunctions import find_best_match
+
+# Number of bits given to each mismatch counter. A counter never exceeds the pattern length and the
+# threshold bias added on top of it is at most FIELD_HIGH - 1, so as long as the pattern has at most
+# FIELD_HIGH bases and max_errors is below FIELD_HIGH, 6 bits never carry into the next counter.
+# Longer patterns or larger error budgets are handed to the legacy scan instead (see build_match_masks).
+FIELD_BITS = 6
+FIELD_MASK = (1 << FIELD_BITS) - 1
+# The top bit of each counter is set once the counter goes over the number of errors allowed for it
+FIELD_HIGH = 1 << (FIELD_BITS - 1)
+
+# Precomputed tables for every (pattern, max_errors) pair seen so far
+_masks_cache = {}
+
+
+def build_match_masks(pattern, max_errors):
+    """
+    Precompute the per-base bitmasks and thresholds used by find_best_match_bitparallel.
+
+    Counter i of the state holds the number of mismatches between pattern[:i+1] and the
+    text ending at the current read position. Counter L-1 therefore scores the truncated
+    pattern of length L, so every truncation length is scored by the same pass.
+
+    Args:
+    pattern (str): Vector sequence to search for
+    max_errors (int): Maximum number of errors (mismatches plus truncated bases) allowed
+
+    Returns:
+    tuple: (per-base mismatch masks, mask for unknown bases, state mask, list of truncation
+            lengths, per-position (bias, high bit) thresholds, steady-state thresholds),
+           or None when the counters of this pattern and error budget would not fit in FIELD_BITS
+    """
+    key = (pattern, max_errors)
+    if key in _masks_cache:
+        return _masks_cache[key]
+
+    pattern_length = len(pattern)
+    if pattern_length > FIELD_HIGH or not 0 <= max_errors < FIELD_HIGH:
+        _masks_cache[key] = None
+        return None
+
+    # For each base, put a 1 in counter i when pattern[i] is a different base
+    base_masks = {}
+    for base in set(pattern) | set("ACGTN"):
+        mask = 0
+        for i, p in enumerate(pattern):
+            if p != base:
+                mask |= 1 << (i * FIELD_BITS)
+        base_masks[base] = mask
+    # Any other character (lower case, '.', ...) mismatches every position, same as the legacy comparison
+    unknown_mask = sum(1 << (i * FIELD_BITS) for i in range(pattern_length))
+    state_mask = (1 << (pattern_length * FIELD_BITS)) - 1
+
+    # Truncation lengths in the order the legacy function tries them, longest first
+    lengths = [length for length in range(pattern_length, pattern_length - max_errors - 1, -1) if length > 0]
+
+    def thresholds(valid_lengths):
+        # The bias pushes a counter's top bit on as soon as it exceeds the errors allowed for that length
+        bias = 0
+        high = 0
+        for length in valid_lengths:
+            allowed = max_errors - (pattern_length - length)
+            shift = (length - 1) * FIELD_BITS
+            bias |= (FIELD_HIGH - 1 - allowed) << shift
+            high |= FIELD_HIGH << shift
+        return bias, high
+
+    # Counter L-1 only covers a full window once at least L bases have been read,
+    # so the first positions of the read only check the lengths that already fit.
+    early_thresholds = [thresholds([length for length in lengths if length - 1 <= j]) for j in range(pattern_length)]
+    steady_thresholds = thresholds(lengths)
+
+    masks = (base_masks, unknown_mask, state_mask, lengths, early_thresholds, steady_thresholds)
+    _masks_cache[key] = masks
+    return masks
+
+
+def find_best_match_bitparallel(sequence, pattern, max_errors, before_or_after):
+    """
+    Bit-parallel (Baeza-Yates-Gonnet shift-add) version of find_best_match.
+    It scores every start position and every truncation length of the pattern in a single
+    pass and returns the same best match, position and error count as the legacy function.
+    Patterns too long (or error budgets too large) for the packed counters fall back to find_best_match.
+    """
+    masks = build_match_masks(pattern, max_errors)
+    if masks is None:
+        return find_best_match(sequence, pattern, max_errors, before_or_after)
+    base_masks, unknown_mask, state_mask, lengths, early_thresholds, steady_thresholds = masks
+    pattern_length = len(pattern)
+
+    # Best (errors, start) found so far for each truncation length
+    best = {}
+    state = 0
+    early_count = len(early_thresholds)
+    steady_bias, steady_high = steady_thresholds
+
+    for j, base in enumerate(sequence):
+        # Shift every counter up by one pattern position and add the mismatches for this base
+        state = ((state << FIELD_BITS) + base_masks.get(base, unknown_mask)) & state_mask
+
+        if j < early_count:
+            bias, high = early_thresholds[j]
+            if not high:
+                continue
+        else:
+            bias, high = steady_bias, steady_high
+
+        # Skip this position unless at least one truncation length is within its error budget
+        if (state + bias) & high == high:
+            continue
+
+        for length in lengths:
+            if length - 1 > j:
+                continue
+            shift = (length - 1) * FIELD_BITS
+            errors = (state >> shift) & FIELD_MASK
+            if errors <= max_errors - (pattern_length - length):
+                # Strictly fewer errors keeps the earliest window on ties, like the legacy scan
+                if length not in best or errors < best[length][0]:
+                    best[length] = (errors, j - length + 1)
+
+        # An exact full-length match can not be beaten by any later window
+        if pattern_length in best and best[pattern_length][0] == 0:
+            break
+
+    # The longest truncation length that matched wins, as in the legacy function
+    for length in lengths:
+        if length in best:
+            errors, start = best[length]
+            return sequence[start:start + length], [start, start + length], errors + (pattern_length - length)
+
+    return None, [None, None], None
+
+
+# The matcher engines that can be selected with --matcher
+MATCHERS = {
+    "legacy": find_best_match,
+    "bitparallel": find_best_match_bitparallel,
+}
+
+
+def get_matcher(name):
+    """
+    Return the matcher function registered under name in MATCHERS.
+    """
+    if name not in MATCHERS:
+        raise ValueError(f"Unknown matcher '{name}'. Choose from: {', '.join(MATCHERS)}")
+    return MATCHERS[name]
+
+
+class AnchoredMatcher:
+    """
+    Matcher that first searches a small window around the position the vector is expected at,
+    and only runs the full scan of the wrapped matcher when the window has no full-length match.
+
+    The expected start of each vector (offset) and the window half-width (slack) are learned from
+    the first learnReads reads of the sample by learn(), before the reads are split over workers,
+    so every worker uses the same anchors. slack defaults to the distance from the offset that
+    covers the given fraction of the learned positions.
+
+    A full-length match inside the window is taken as is, so a read whose vector matches better
+    somewhere far from the expected position can be matched differently than by the full scan.
+    Truncated matches (at the ends of the read) always go to the full scan.
+
+    The number of reads matched in the window and sent to the full scan are kept per vector
+    ('before' / 'after') and handed over with take_stats().
+    """
+
+    def __init__(self, matcher, learnReads=1000, slack=None, coverage=0.95):
+        self.matcher = matcher
+        self.learnReads = learnReads
+        self.slack = slack
+        self.coverage = coverage
+        # (before_or_after, pattern) -> (offset, slack)
+        self.anchors = {}
+        self.stats = Counter()
+
+    def __call__(self, sequence, pattern, max_errors, before_or_after):
+        anchor = self.anchors.get((before_or_after, pattern))
+        if anchor is not None:
+            offset, slack = anchor
+            windowStart = max(0, offset - slack)
+            match, position, errors = self.matcher(sequence[windowStart:offset + slack + len(pattern)], pattern, max_errors, before_or_after)
+            if match is not None and position[1] - position[0] == len(pattern):
+                self.stats[("anchorHit", before_or_after)] += 1
+                return match, [position[0] + windowStart, position[1] + windowStart], errors
+        self.stats[("anchorMiss", before_or_after)] += 1
+        return self.matcher(sequence, pattern, max_errors, before_or_after)
+
+    def learn(self, records, classify):
+        """
+        Learn the anchors from the first learnReads records.
+        classify(sampleRecords, matcher) must run the read classification over sampleRecords with the given
+        matcher; the start of every full-length vector match it finds is recorded.
+        Returns an iterator over all the records, including the ones used for learning.
+        """
+        sample = list(islice(records, self.learnReads))
+        positions = defaultdict(list)
+
+        def recorder(sequence, pattern, max_errors, before_or_after):
+            match, position, errors = self.matcher(sequence, pattern, max_errors, before_or_after)
+            if match is not None and position[1] - position[0] == len(pattern):
+                positions[(before_or_after, pattern)].append(position[0])
+            return match, position, errors
+
+        classify(sample, recorder)
+
+        self.anchors = {}
+        for key, starts in positions.items():
+            offset = Counter(starts).most_common(1)[0][0]
+            if self.slack is not None:
+                slack = self.slack
+            else:
+                distances = sorted(abs(start - offset) for start in starts)
+                slack = distances[int(self.coverage * (len(distances) - 1))]
+            self.anchors[key] = (offset, slack)
+        return chain(sample, records)
+
+    def take_stats(self):
+        """Return the window hit and miss counts collected so far and start counting from zero again."""
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+
+class ExactFirstMatcher:
+    """
+    Matcher that looks for an exact copy of the whole vector with str.find before running the
+    wrapped matcher. An exact full-length copy has no errors and is the longest truncation length,
+    so the first one in the read is exactly what the full search returns; only reads without one
+    go through the mismatch search.
+
+    The number of searches answered by str.find and passed on are kept per vector ('before' / 'after')
+    and handed over with take_stats(), together with the counts of the wrapped matcher.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.stats = Counter()
+
+    def __call__(self, sequence, pattern, max_errors, before_or_after):
+        start = sequence.find(pattern)
+        if start >= 0:
+            self.stats[("exactHit", before_or_after)] += 1
+            return pattern, [start, start + len(pattern)], 0
+        self.stats[("exactMiss", before_or_after)] += 1
+        return self.matcher(sequence, pattern, max_errors, before_or_after)
+
+    def learn(self, records, classify):
+        """Let the wrapped matcher learn from the first reads if it does so (e.g. AnchoredMatcher)."""
+        if hasattr(self.matcher, "learn"):
+            return self.matcher.learn(records, classify)
+        return records
+
+    def take_stats(self):
+        """Return the fast path counts (and those of the wrapped matcher) and start counting from zero again."""
+        stats, self.stats = self.stats, Counter()
+        if hasattr(self.matcher, "take_stats"):
+            stats.update(self.matcher.take_stats())
+        return stats
@@ -1,6 +1,7 @@
 import os, subprocess
 from argparse import ArgumentParser
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 #Command line parser
 parser = ArgumentParser()
@@ -9,6 +10,10 @@ parser.add_argument("experimentPath", help = "Specify the path to the experiment
 parser.add_argument("sampleArray", help="Array of samples within the Experiment data.", type=str)
 parser.add_argument("lvHistogramFraction",help = "Specify if the histogram has to be constructed for the full barcode or for a partial part. Options: full, partial", choices=["full", "partial"], default="full")
 parser.add_argument("lvHistogramLength", help = "Desired length of barcode for this experiment")
+parser.add_argument("-lengths", help = "Comma separated prefix lengths written by multibarcodeAnalyzer.py. Step 3 uses 30, 40 and 50.", type = str, default = "30,40,50")
+parser.add_argument("-workers", help = "Number of samples processed at the same time (prefix tables and LV histogram of each sample). The Multiple_Samples files are joined once all samples are done.", type = int, default = 1)
+parser.add_argument("-collapsePrefixes", help = "If specified, the _Barcode_<length>.txt files have one row per prefix with the counts summed (see multibarcodeAnalyzer.py).", action = 'store_true')
+parser.add_argument("-matrixOutput", help = "How LVHistogram.py saves the distances of each sampling: csv (every ordered pair), condensed (each pair once), binary (gzipped uint8 condensed matrix) or none (only histogram and mean).", choices=["csv", "condensed", "binary", "none"], default="csv")
 args = parser.parse_args()
 
 # pathLvHistogram = os.path.join(args.scriptPath, "Step2_LVHistogram_MultipleSample","LvHistogram.py" )
@@ -28,13 +33,44 @@ args = parser.parse_args()
 
 pathSamples = os.path.join(args.scriptPath, "Step2_LVHistogram_MultipleSample","multibarcodeAnalyzer.py" )
 pathLvHistogram= os.path.join(args.scriptPath, "LVHistogram.py" )
+experimentPath = os.path.abspath(args.experimentPath)
+collapseOption = ["-collapsePrefixes"] if args.collapsePrefixes else []
+
+
+def run_lv_histogram(sample, pathtosummary):
+    """
+    Function to run LVHistogram.py on the barcode file of one sample (or Multiple_Samples), adding its mean distances to pathtosummary.
+    """
+    # Path to the sample that we want to do an LV analysis on and the sample folder it is in
+    if args.lvHistogramFraction == "partial" :
+        pathtosample = os.path.join(experimentPath, "analyzed", sample, "LV_Analysis", "{}_Barcode_{}.txt".format(sample, args.lvHistogramLength))
+    else :
+        pathtosample = os.path.join(experimentPath, "analyzed", sample, "LV_Analysis", "{}_Barcode_full.txt".format(sample))
+    pathtofolder = os.path.join(experimentPath, "analyzed", sample)
+
+    # Run LV Histogram 
+    commandLvHistogram = ["python3", pathLvHistogram, pathtofolder, pathtosample, pathtosummary, sample, "-inputFraction",args.lvHistogramFraction, "-inputLength",args.lvHistogramLength, "-matrixOutput", args.matrixOutput]
+    subprocess.call(commandLvHistogram)
+
+
+def process_sample(sample):
+    """
+    Function to do all of Step 2 for one sample: the barcode files of every prefix length and the LV histogram.
+    The mean distances are written to a summary file of the sample, which is returned so it can be added to LVmeandistance.txt
+    in the order of the samples.
+    """
+    commandSample = ["python3", pathSamples, experimentPath, sample, "-inputFraction",args.lvHistogramFraction, "-inputLength",args.lvHistogramLength, "-lengths", args.lengths, "-combine", "none"] + collapseOption
+    subprocess.call(commandSample)
+
+    sampleSummary = os.path.join(experimentPath, "analyzed", sample, "LV_Analysis", "{}_LVmeandistance.txt".format(sample))
+    if os.path.exists(sampleSummary):
+        os.remove(sampleSummary)
+    run_lv_histogram(sample, sampleSummary)
+    return sampleSummary
 
-# Creating txts of barcode_length and multiple samples
-commandMultipleSamples = ["python3", pathSamples, args.experimentPath, args.sampleArray, "-inputFraction",args.lvHistogramFraction, "-inputLength",args.lvHistogramLength]
-subprocess.call(commandMultipleSamples)
 
 # Move to the Experiment folder 
-os.chdir(args.experimentPath)
+os.chdir(experimentPath)
 
 # Create txt file in the Experiment folder 
 summary_file = "LVmeandistance.txt"
@@ -51,23 +87,25 @@ with open(summary_file, "w") as summary:
     summary.write("------------------------------------\n\n")
 
 # Save the path to this summary file 
-pathtosummary = os.path.join(args.experimentPath,summary_file)
+pathtosummary = os.path.join(experimentPath,summary_file)
 
 #Split the data into a list so it can be parsed properly 
 sampleArray = args.sampleArray.split(',')
-sampleArray.append("Multiple_Samples")
-
-# Creating the LV distance histogram for each sample separately
-for sample in sampleArray:
-
-    # Path to the sample that we want to do an LV analysis on and the sample folder it is in
-    if args.lvHistogramFraction == "partial" :
-        pathtosample = os.path.join(args.experimentPath, "analyzed", sample, "LV_Analysis", "{}_Barcode_{}.txt".format(sample, args.lvHistogramLength))
-    else :
-        pathtosample = os.path.join(args.experimentPath, "analyzed", sample, "LV_Analysis", "{}_Barcode_full.txt".format(sample))
-    pathtofolder = os.path.join(args.experimentPath, "analyzed", sample)
-
-    # Run LV Histogram 
-    commandLvHistogram = ["python3", pathLvHistogram, pathtofolder, pathtosample, pathtosummary, sample, "-inputFraction",args.lvHistogramFraction, "-inputLength",args.lvHistogramLength]
-    subprocess.call(commandLvHistogram)
 
+# Process the samples, -workers of them at the same time. Every sample runs in its own python3 processes,
+# so the threads of the pool only start them and wait for them
+with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+    sampleSummaries = list(executor.map(process_sample, sampleArray))
+
+# Add the mean distances of each sample to the summary in the order of the sample array, whatever order they finished in
+with open(pathtosummary, "a") as summary:
+    for sampleSummary in sampleSummaries:
+        if os.path.exists(sampleSummary):
+            with open(sampleSummary) as sampleLines:
+                summary.write(sampleLines.read())
+            os.remove(sampleSummary)
+
+# Reduce stage: join the barcode files of all samples into Multiple_Samples, then make its LV histogram
+commandMultipleSamples = ["python3", pathSamples, experimentPath, args.sampleArray, "-inputFraction",args.lvHistogramFraction, "-inputLength",args.lvHistogramLength, "-lengths", args.lengths, "-combine", "only"] + collapseOption
+subprocess.call(commandMultipleSamples)
+run_lv_histogram("Multiple_Samples", pathtosummary)
@@ -2,6 +2,7 @@ import gzip
 import regex as re
 from argparse import ArgumentParser
 import os
+import sys
 import numpy as np
 import random
 import itertools
@@ -9,40 +10,178 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import gc
+import shutil
 from matplotlib.backends.backend_pdf import PdfPages
+# The binary barcode table written by Step 1 is read with barcodeTable.py in the script folder above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from barcodeTable import load_barcode_table
+from barcodeEncoding import encode_barcodes, decode_barcodes, take_rows, truncate_prefix, hash_barcodes, barcodes_equal
 # from Step2functions import analyze_LV, create_histogram
 
+
+def prefix_table(Barcode, counts, sample, prefixLengths, encoded=None):
+    """
+    Function to build the table of one sample with a column for the full barcodes (Sequence), one for each prefix length
+    (Barcode_<length>), the read counts and the sample name. The barcodes are 2-bit packed once (barcodeEncoding.py, or the
+    packed table of Step 1 given as encoded) and every prefix is cut from the packed words with truncate_prefix.
+    Returns the table and the packed prefixes of every length, which write_prefix_files uses to collapse them.
+    """
+    if encoded is None:
+        encoded = encode_barcodes(Barcode)
+    columns = {"Sequence": np.asarray(Barcode, dtype=str)}
+    encodedPrefixes = {}
+    for length in prefixLengths:
+        column = "Barcode_" + str(length)
+        encodedPrefixes[column] = truncate_prefix(encoded, length)
+        columns[column] = decode_barcodes(encodedPrefixes[column])
+    columns["Counts"] = np.asarray(counts)
+    columns["Sample"] = np.full(len(columns["Sequence"]), sample)
+    return pd.DataFrame(columns), encodedPrefixes
+
+
+def collapse_prefixes(prefixes, counts, encoded=None):
+    """
+    Function to group equal prefixes and sum their counts. Returns the unique prefixes (in the order they first appear), their
+    summed counts and the prefix ID of every row, i.e. the line of its prefix in the collapsed file counted from 1 like starcode --seq-id does.
+    The prefixes are grouped by the 64-bit hash of their packed words (encoded, packed here if not given) and every row is checked
+    to be equal to the first row of its group; should two different prefixes share a hash, they are grouped by their text instead.
+    """
+    prefixes = np.asarray(prefixes)
+    if encoded is None:
+        encoded = encode_barcodes(prefixes)
+    codes, uniqueHashes = pd.factorize(hash_barcodes(encoded))
+    # factorize numbers the groups in the order they first appear, so the first row of each group is its first code
+    firstRows = np.unique(codes, return_index=True)[1]
+    if not barcodes_equal(encoded, take_rows(encoded, firstRows[codes])).all():
+        codes, uniques = pd.factorize(prefixes)
+        firstRows = np.unique(codes, return_index=True)[1]
+    summed = np.bincount(codes, weights=counts, minlength=len(firstRows)).astype(np.int64)
+    return prefixes[firstRows], summed, (codes + 1).astype(np.int32)
+
+
+def write_prefix_files(table, prefixLengths, outFilePrefix, append=False, collapse=False, encodedPrefixes=None):
+    """
+    Function to write the outputs of a table made by prefix_table: <prefix>_Barcode_<length>.txt for every prefix length and
+    <prefix>_Barcode_full.txt (barcode and counts, no header) and <prefix>_AllBarcode.csv with every column.
+    With append, the rows are added to the end of the existing files and the header of the csv is not written again.
+    With collapse, each _Barcode_<length>.txt has one row per prefix with the counts summed, and the prefix ID of every row of
+    the csv is saved per length in <prefix>_prefixIndex.npz (used by finalProcessing.py in Step 3). encodedPrefixes are the packed
+    prefixes made by prefix_table, so they are not packed again to be collapsed.
+    """
+    mode = "a" if append else "w"
+    prefixIndex = {}
+    for length in prefixLengths:
+        column = "Barcode_" + str(length)
+        if collapse:
+            prefixes, counts, prefixIndex[column] = collapse_prefixes(table[column].to_numpy(), table["Counts"].to_numpy(), encodedPrefixes[column] if encodedPrefixes else None)
+            pd.DataFrame({column: prefixes, "Counts": counts}).to_csv(outFilePrefix + "_Barcode_" + str(length) + ".txt", index = False, header = False, sep = "\t")
+        else:
+            table[[column, "Counts"]].to_csv(outFilePrefix + "_Barcode_" + str(length) + ".txt", mode = mode, index = False, header = False, sep = "\t")
+    table[["Sequence", "Counts"]].to_csv(outFilePrefix + "_Barcode_full.txt", mode = mode, index = False, header = False, sep = "\t")
+    table.to_csv(outFilePrefix + "_AllBarcode.csv", mode = mode, index = False, header = not append, sep = "\t")
+    if not append:
+        write_prefix_index(outFilePrefix, prefixIndex, collapse)
+
+
+def write_prefix_index(outFilePrefix, prefixIndex, collapse):
+    """
+    Function to save the prefix IDs of collapsed prefix files, or to remove the file of an earlier collapsed run so Step 3 does not use it.
+    """
+    indexFile = outFilePrefix + "_prefixIndex.npz"
+    if collapse:
+        np.savez_compressed(indexFile, **prefixIndex)
+    elif os.path.exists(indexFile):
+        os.remove(indexFile)
+
+
+def combine_collapsed_prefixes(experimentPath, SampleList, prefixLengths, outFilePrefix):
+    """
+    Function to write the collapsed Multiple_Samples prefix files from the collapsed files of each sample. The prefixes of all samples
+    are grouped again with their counts summed, and the prefix IDs of each sample are changed to the IDs in the combined files.
+    """
+    prefixIndex = {}
+    for length in prefixLengths:
+        column = "Barcode_" + str(length)
+        prefixes, counts, rowIds = [], [], []
+        prefixCount = 0
+        for sample in SampleList:
+            sampleFilePrefix = os.path.join(experimentPath, "analyzed", sample, "LV_Analysis", sample)
+            collapsed = pd.read_csv(sampleFilePrefix + "_Barcode_" + str(length) + ".txt", sep = "\t", header = None, names = [column, "Counts"], dtype = {column: str}, na_filter = False)
+            with np.load(sampleFilePrefix + "_prefixIndex.npz") as sampleIndex:
+                # Move the IDs of this sample past the prefixes of the samples before it
+                rowIds.append(sampleIndex[column] + prefixCount)
+            prefixes.append(collapsed[column].to_numpy())
+            counts.append(collapsed["Counts"].to_numpy())
+            prefixCount += len(collapsed)
+        combinedPrefixes, combinedCounts, combinedIds = collapse_prefixes(np.concatenate(prefixes), np.concatenate(counts))
+        pd.DataFrame({column: combinedPrefixes, "Counts": combinedCounts}).to_csv(outFilePrefix + "_Barcode_" + str(length) + ".txt", index = False, header = False, sep = "\t")
+        prefixIndex[column] = combinedIds[np.concatenate(rowIds) - 1]
+    write_prefix_index(outFilePrefix, prefixIndex, True)
+
+
+def combine_sample_files(experimentPath, SampleList, prefixLengths, outFilePrefix, collapse=False):
+    """
+    Function to write the Multiple_Samples files by joining the files of each sample (written by write_prefix_files) in the order
+    of SampleList. The files are copied in blocks, so the samples never have to be loaded again; only the header of the first
+    AllBarcode csv is kept. Collapsed prefix files are grouped again over all samples by combine_collapsed_prefixes.
+    """
+    fileNames = ["_Barcode_full.txt", "_AllBarcode.csv"]
+    if collapse:
+        combine_collapsed_prefixes(experimentPath, SampleList, prefixLengths, outFilePrefix)
+    else:
+        fileNames = ["_Barcode_" + str(length) + ".txt" for length in prefixLengths] + fileNames
+        write_prefix_index(outFilePrefix, {}, False)
+    for fileName in fileNames:
+        with open(outFilePrefix + fileName, "w") as combined:
+            for sampleNumber, sample in enumerate(SampleList):
+                with open(os.path.join(experimentPath, "analyzed", sample, "LV_Analysis", sample + fileName)) as sampleFile:
+                    header = sampleFile.readline() if fileName.endswith(".csv") else ""
+                    if sampleNumber == 0:
+                        combined.write(header)
+                    shutil.copyfileobj(sampleFile, combined)
+    return header.split()
+
+
 # Arguments for the script
 parser = ArgumentParser()
 parser.add_argument("experimentPath", help = "Specify the path to the experiment directory", type = str)
 parser.add_argument("sampleNames", help = "Array of samples within the Experiment data.", type = str)
 parser.add_argument("-inputFraction", help = "Specify if the histogram has to be constructed for the full barcode or for a partial part. Options: full, partial", choices=["full", "partial"], default="full")
 parser.add_argument("-inputLength", help= "If you have chosen partial in the inputFraction, enter the length of barcode you want to construct the histogram for.", type=int, default = 50)
+parser.add_argument("-lengths", help = "Comma separated prefix lengths written as Barcode_<length> files and columns. Step 3 (starcodeRun.py, finalProcessing.py) uses 30, 40 and 50.", type = str, default = "30,40,50")
+parser.add_argument("-combine", help = "How the Multiple_Samples files are made. append: add each sample to them as it is done, none: only write the files of each sample, only: join the files of each sample written by an earlier run with -combine none (used by Step2.py -workers).", choices=["append", "none", "only"], default="append")
+parser.add_argument("-collapsePrefixes", help = "If specified, write each _Barcode_<length>.txt with one row per prefix and the counts summed, and the prefix ID of every barcode to _prefixIndex.npz for Step 3.", action = 'store_true')
 
 args = parser.parse_args()
 
 # #Move into current directory
 # os.chdir('..')
 
-# Using the inputs to determine if we want partial or full and outputs txt and csv files for further processing. 
-if(args.inputFraction == "partial"):
-    inputlength = int(args.inputLength)
-    frac = 1
-else: 
-    frac = 0
+# Assigning different lengths of substring to later determine LV distance 
+lengths = [int(length) for length in args.lengths.split(",")]
 
-# Initiate an empty dataframe to combine all samples into Multiple_Samples 
-barcodeMultipleSamples = pd.DataFrame()
+# Using the inputs to determine if we want partial or full and outputs txt and csv files for further processing. 
+# A partial length that is not in the list gets its own column and files too
+prefixLengths = list(lengths)
+if args.inputFraction == "partial" and args.inputLength not in prefixLengths:
+    prefixLengths.append(args.inputLength)
 
-# Assigning different lengths of substring to later determine LV distance 
-lengths = [30, 40, 50]
+# creating output directory for the combined samples; if it does not exist, make it 
+experimentPath = os.path.abspath(args.experimentPath)
+multipleSamplesPath = os.path.join(experimentPath, "analyzed", "Multiple_Samples", "LV_Analysis")
+os.makedirs(multipleSamplesPath, exist_ok=True)
 
 # Separate the samples by a comma and make it into a list
 SampleList = args.sampleNames.split(",")
 
-for sample in SampleList:
+# Only join the files of the samples written by earlier runs, see combine_sample_files
+if args.combine == "only":
+    print(combine_sample_files(experimentPath, SampleList, prefixLengths, os.path.join(multipleSamplesPath, "Multiple_Samples"), args.collapsePrefixes))
+    sys.exit(0)
+
+for sampleNumber, sample in enumerate(SampleList):
     #Move into analyzed directory
-    os.chdir(os.path.join(args.experimentPath, "analyzed", sample)) #identifying the input file location and moving to it
+    os.chdir(os.path.join(experimentPath, "analyzed", sample)) #identifying the input file location and moving to it
 
     #Make LV_Analysis and matrix folder
     if not os.path.exists("LV_Analysis"):
@@ -52,110 +191,62 @@ for sample in SampleList:
     #Move to extractdedBarcodeData directory
     os.chdir(os.path.join("extractedBarcodeData")) 
 
-    Barcode_raw = [] #to store all the Barcodes
-    counts = [] # to store the counts
-
-    # Open required file and parse it to create an array of all barcodes
-    readCountsFile = sample + "_readCountsOnly.gz" #both
-    if not os.path.exists(readCountsFile):
-        readCountsFile = sample + "_readCountsOnly_liberal.gz" #before
-
-    #Open the file and append to the data 
-    with gzip.open(readCountsFile, 'rt') as reads:   
-        for line in reads:
-            try:
-                Barcode_raw.append(line.split()[0])
-                counts.append(int(line.split()[1]))
-            except:
-                print("error",line)
-
-    # Make it into a numpy array 
-    Barcode = np.array(Barcode_raw)
-
-    # Save some data 
-    del(Barcode_raw)
+    # If Step 1 wrote the binary table (--tableFormat npz/both), load the barcodes and counts from it directly
+    tableFile = sample + "_barcodes.npz" #both
+    if not os.path.exists(tableFile):
+        tableFile = sample + "_barcodes_liberal.npz" #before
+
+    if os.path.exists(tableFile):
+        # The barcodes stay packed for the prefixes, only the full barcodes are decoded
+        table = load_barcode_table(tableFile, decode = False)
+        encoded = table["encoded"]
+        Barcode = decode_barcodes(encoded)
+        counts = table["reads"]
+        del(table)
+    else:
+        Barcode_raw = [] #to store all the Barcodes
+        counts = [] # to store the counts
+
+        # Open required file and parse it to create an array of all barcodes
+        readCountsFile = sample + "_readCountsOnly.gz" #both
+        if not os.path.exists(readCountsFile):
+            readCountsFile = sample + "_readCountsOnly_liberal.gz" #before
+
+        #Open the file and append to the data 
+        with gzip.open(readCountsFile, 'rt') as reads:   
+            for line in reads:
+                try:
+                    barcode, count = line.split()[:2]
+                    Barcode_raw.append(barcode)
+                    counts.append(int(count))
+                except:
+                    print("error",line)
+
+        # Make it into a numpy array 
+        Barcode = np.array(Barcode_raw)
+        encoded = None
+
+        # Save some data 
+        del(Barcode_raw)
     gc.collect()
 
     # Moves "up" one level in the directory structure.
     os.chdir("..")
 
-    # Save the barcodes of varying lengths separately
-    Barcode_1 = []
-    Barcode_2 = []
-    Barcode_3 = []
-    if(frac):
-        Barcode_frac = []
-
-    # Read every line and make the lengths as mentioned 
-    for i in Barcode:
-        Barcode_1.append(i[:lengths[0]])
-        Barcode_2.append(i[:lengths[1]])
-        Barcode_3.append(i[:lengths[2]])
-        if(frac):
-            Barcode_frac.append(i[:inputlength])
-
-    
-    # Make an array of the Sample Names only that is the same length as the total barcodes in the Barcode variable
-    sample_array = np.full(len(Barcode_1), sample)
-
-    # if the inputLength is not within the list of length, then there should be another column that includes that fraction
-    if frac == 1 and inputlength not in lengths:
-        maps = {"Sequence": np.array(Barcode), "Barcode_" + str(lengths[0]): np.array(Barcode_1), "Barcode_" + str(lengths[1]): np.array(Barcode_2), "Barcode_" + str(lengths[2]): np.array(Barcode_3), "Barcode_" + str(inputlength): np.array(Barcode_frac), "Counts":np.array(counts), "Sample":sample_array}
-                # Saving the barcode for starcode processing later on
-        m5 = {"Sequence": Barcode_frac, "Counts": counts}
-        Barcode_5 = pd.DataFrame.from_dict(m5)
-        Barcode_5.to_csv("LV_Analysis/" + sample + "_Barcode_" + str(inputlength) + ".txt", index = False, header=False, sep='\t')
-    else: 
-        maps = {"Sequence": np.array(Barcode), "Barcode_" + str(lengths[0]): np.array(Barcode_1), "Barcode_" + str(lengths[1]): np.array(Barcode_2), "Barcode_" + str(lengths[2]): np.array(Barcode_3), "Counts":np.array(counts), "Sample":sample_array}
-    
-    # Saving all the data for later/further processing 
-    m1 = {"Sequence": Barcode_1, "Counts": counts}
-    Barcode_1 = pd.DataFrame.from_dict(m1)
-    Barcode_1.to_csv("LV_Analysis/" + sample + "_Barcode_" + str(lengths[0]) + ".txt", index = False, header=False, sep='\t')
-    m2 = {"Sequence": Barcode_2, "Counts": counts}
-    Barcode_2 = pd.DataFrame.from_dict(m2)
-    Barcode_2.to_csv("LV_Analysis/" + sample + "_Barcode_" + str(lengths[1]) + ".txt", index = False, header=False, sep='\t')
-    m3 = {"Sequence": Barcode_3, "Counts": counts}
-    Barcode_3 = pd.DataFrame.from_dict(m3)
-    Barcode_3.to_csv("LV_Analysis/" + sample + "_Barcode_" + str(lengths[2]) + ".txt", index = False, header=False, sep='\t')
-    m4 = {"Sequence": Barcode, "Counts": counts}
-    Barcode_4 = pd.DataFrame.from_dict(m4)
-    Barcode_4.to_csv("LV_Analysis/" + sample + "_Barcode_full.txt", index = False, header=False, sep='\t')
-
-    # Make a full barcode csv including all the different lengths 
-    Barcode_new = pd.DataFrame.from_dict(maps)
-    Barcode_new.to_csv("LV_Analysis/" + sample + "_AllBarcode.csv", index = False, sep='\t')
-
-    # Iterating through the samples to extract the barcodes and combine into a single dataframe
-    if barcodeMultipleSamples.empty:
-        barcodeMultipleSamples = Barcode_new
-    else:
-        barcodeMultipleSamples = pd.concat([barcodeMultipleSamples, Barcode_new], ignore_index=True)
-
-# creating output directory
-os.chdir(os.path.join(args.experimentPath, "analyzed"))
-# If it does not exist, make it 
-os.makedirs(os.path.join("Multiple_Samples", "LV_Analysis"), exist_ok=True)
-
-os.chdir(os.path.join("Multiple_Samples", "LV_Analysis"))
-
-# Outside of the loop 
-# Saving the various combined barcode files
-Barcode_30 = barcodeMultipleSamples[['Barcode_30','Counts']]
-Barcode_30.to_csv('Multiple_Samples_Barcode_30.txt', index=False, header=False, sep="\t")
-Barcode_40 = barcodeMultipleSamples[['Barcode_40','Counts']]
-Barcode_40.to_csv('Multiple_Samples_Barcode_40.txt', index=False, header=False, sep="\t")
-Barcode_50 = barcodeMultipleSamples[['Barcode_50','Counts']]
-Barcode_50.to_csv('Multiple_Samples_Barcode_50.txt', index=False, header=False, sep="\t")
-
-if frac == 1 and inputlength not in lengths:
-    string = "Barcode_" + str(args.inputLength)
-    Barcode_frac = barcodeMultipleSamples[[string,'Counts']]
-    Barcode_frac.to_csv("Multiple_Samples_" + "Barcode_" + str(args.inputLength) + ".txt", index=False, header=False, sep="\t")
-
-Barcode_100 = barcodeMultipleSamples[['Sequence','Counts']]
-Barcode_100.to_csv("Multiple_Samples_Barcode_full.txt",index=False, header=False, sep="\t")
+    # Make the full barcode table with every prefix length, and write all the files of the sample from it
+    Barcode_new, encodedPrefixes = prefix_table(Barcode, counts, sample, prefixLengths, encoded)
+    del(Barcode, counts, encoded)
+    write_prefix_files(Barcode_new, prefixLengths, "LV_Analysis/" + sample, collapse = args.collapsePrefixes, encodedPrefixes = encodedPrefixes)
+
+    # Combine the samples into Multiple_Samples by appending the rows of each sample to its files as soon as the sample is done,
+    # so only one sample table is in memory at a time. Collapsed prefixes have to be grouped over all samples, so they are combined after the loop
+    if args.combine == "append" and not args.collapsePrefixes:
+        write_prefix_files(Barcode_new, prefixLengths, os.path.join(multipleSamplesPath, "Multiple_Samples"), append = sampleNumber > 0)
+    columns = Barcode_new.columns
+    del(Barcode_new, encodedPrefixes)
+    gc.collect()
 
-print(barcodeMultipleSamples.columns)
+if args.combine == "append" and args.collapsePrefixes:
+    combine_sample_files(experimentPath, SampleList, prefixLengths, os.path.join(multipleSamplesPath, "Multiple_Samples"), True)
 
-barcodeMultipleSamples.to_csv("Multiple_Samples_AllBarcode.csv",index=False, sep="\t") 
\ No newline at end of file
+print(columns)
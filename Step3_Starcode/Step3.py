@@ -17,6 +17,7 @@ parser.add_argument("distanceStarcode", help = "Specify the Levenshtein distance
 parser.add_argument("threadsStarcode", help = "Number of threads to use for Starcode" )
 parser.add_argument("sampleArrayStarcode", help = "List of samples where barcodes have to be merged. For multiple samples, sample name is Multiple_Samples." )
 parser.add_argument("Fraction",help = "Specify if its running starcode for the full barcode or for a partial part. Options: full, partial", choices=["full", "partial"], default="full")
+parser.add_argument("-matrixOutput", help = "How LVHistogram.py saves the distances of each sampling: csv (every ordered pair), condensed (each pair once), binary (gzipped uint8 condensed matrix) or none (only histogram and mean).", choices=["csv", "condensed", "binary", "none"], default="csv")
 
 args = parser.parse_args()
 
@@ -91,7 +92,7 @@ if(args.combinedSample == "no"):
 		pathtofolder = os.path.join(args.pathExperiment, "analyzed", sample, "starcode")
 
 		# Run LV Histogram on the newly made files using starcode  
-		commandLvHistogram = ["python3", pathLvHistogram, pathtofolder, pathtosample, pathtosummary, sample, "-inputFraction", args.Fraction, "-inputLength",args.lengthStarcode]
+		commandLvHistogram = ["python3", pathLvHistogram, pathtofolder, pathtosample, pathtosummary, sample, "-inputFraction", args.Fraction, "-inputLength",args.lengthStarcode, "-matrixOutput", args.matrixOutput]
 		print(commandLvHistogram)
 		subprocess.call(commandLvHistogram)
 
@@ -122,7 +123,7 @@ else:
 	pathtofolder = os.path.join(args.pathExperiment, "analyzed", "Multiple_Samples", "starcode")
 
 	# Run LVHistogram 
-	commandLvHistogram = ["python3", pathLvHistogram, pathtofolder, pathtosample, pathtosummary, "Multiple_Samples", "-inputFraction", args.Fraction, "-inputLength",args.lengthStarcode]
+	commandLvHistogram = ["python3", pathLvHistogram, pathtofolder, pathtosample, pathtosummary, "Multiple_Samples", "-inputFraction", args.Fraction, "-inputLength",args.lengthStarcode, "-matrixOutput", args.matrixOutput]
 	print(commandLvHistogram)
 	subprocess.call(commandLvHistogram)
 
@@ -143,7 +144,7 @@ else:
 				extracted = file.split(pattern)[0]
 
 				# Run LVHistogram 	
-				commandLvHistogram = ["python3", pathLvHistogram, Separatedsamples, file_path, pathtosummary, extracted , "-inputFraction", args.Fraction, "-inputLength",args.lengthStarcode]
+				commandLvHistogram = ["python3", pathLvHistogram, Separatedsamples, file_path, pathtosummary, extracted , "-inputFraction", args.Fraction, "-inputLength",args.lengthStarcode, "-matrixOutput", args.matrixOutput]
 				print(commandLvHistogram)
 				subprocess.call(commandLvHistogram)
 
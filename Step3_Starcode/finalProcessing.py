@@ -4,6 +4,7 @@ This is a python script to update the barcode csv with starcoode merged barcodes
 Output files:
 	1. The barcode and its substrings are updated in the csv file and that is saved as a csv file
     2. Separate textfiles are created to store the specified length of barcode for each sample separately if they were combined
+If Step 2 was run with -collapsePrefixes, the starcode IDs of the prefix files are matched to the csv rows with <sample>_prefixIndex.npz
 
 command to run this script: python3 finalProcessing.py <experiment name> <combined - yes/no> <sample name> -d <distance used for merging in Starcode> -length <Length of barcode for final analysis>
 -----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -49,6 +50,10 @@ else:
 # Initialized all the paths needed to read the inputs
 CombinedFilePath = os.path.join(args.pathExperiment, "analyzed",sampleName,"LV_Analysis",str(sampleName) + "_AllBarcode.csv")
 Combined_Barcode = pd.read_csv(CombinedFilePath, sep="\t")
+# If Step 2 collapsed the prefix files (-collapsePrefixes), starcode numbers the prefixes instead of the rows of the csv;
+# the prefix ID of every row is then read from the _prefixIndex.npz file next to the csv
+prefixIndexPath = os.path.join(args.pathExperiment, "analyzed",sampleName,"LV_Analysis",str(sampleName) + "_prefixIndex.npz")
+prefixIndex = dict(np.load(prefixIndexPath)) if os.path.exists(prefixIndexPath) else None
 StarcodeInputPath = os.path.join(args.pathExperiment, "analyzed",sampleName,"starcode")
 os.chdir(StarcodeInputPath)
 
@@ -57,7 +62,7 @@ if(args.combined == "yes"):
     # Make a new file that indicates all the new barcodes
     for ind, i in enumerate(lengths):
         print("Combining", i)
-        Combined_Barcode = Barcode_scanner(Combined_Barcode, sampleName, i, str(args.d), ind)
+        Combined_Barcode = Barcode_scanner(Combined_Barcode, sampleName, i, str(args.d), ind, prefixIndex)
 
     print("Combined")
     os.chdir("..")
@@ -79,7 +84,7 @@ else:
     # os.chdir(StarcodeInputPath)
 
     for ind, i in enumerate(lengths):
-        Combined_Barcode = Barcode_scanner(Combined_Barcode, sampleName, i, str(args.d), ind)
+        Combined_Barcode = Barcode_scanner(Combined_Barcode, sampleName, i, str(args.d), ind, prefixIndex)
     os.chdir("..")
 
     Combined_Barcode.to_csv("updatedAllBarcode.csv", index=False)
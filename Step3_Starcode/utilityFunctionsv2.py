@@ -23,7 +23,24 @@ def process_batch(batch_data):
         'index': np.concatenate(all_indices)
     })
 
-def Barcode_scanner(Combined_Barcode, sampleName, length, distance, ind):
+def centroid_by_prefix(data, rowPrefixIds, current):
+    # The --seq-id numbers of a collapsed prefix file are prefix IDs (see multibarcodeAnalyzer.py -collapsePrefixes),
+    # so find the cluster of every prefix ID and give each row the centroid of the cluster of its prefix ID
+    centroids = np.array([record[0] for record in data], dtype=object)
+    clusterIds = [np.array(record[2].split(','), dtype=np.int64) for record in data]
+    largestId = max([ids.max() for ids in clusterIds] + [rowPrefixIds.max() if len(rowPrefixIds) else 0])
+    clusterOf = np.full(largestId + 1, -1, dtype=np.int64)
+    for cluster, ids in enumerate(clusterIds):
+        clusterOf[ids] = cluster
+
+    # Rows whose prefix is in no cluster keep their barcode, like rows missing from the starcode output do
+    rowClusters = clusterOf[rowPrefixIds]
+    updated = np.array(current, dtype=object)
+    found = rowClusters >= 0
+    updated[found] = centroids[rowClusters[found]]
+    return updated
+
+def Barcode_scanner(Combined_Barcode, sampleName, length, distance, ind, prefixIndex=None):
     batch_size = 10000  # Adjust this based on your system's memory
     
     # Step 1: Get the columns from Combined_Barcode
@@ -41,6 +58,11 @@ def Barcode_scanner(Combined_Barcode, sampleName, length, distance, ind):
         # Step 4: Read the entire file into memory
         with open(f'{sampleName}_Barcode{length}_d{distance}.txt', 'r') as f:
             data = [line.strip().split('\t') for line in f]
+
+        # Collapsed prefix file: the IDs are mapped to the rows with the prefix IDs saved by multibarcodeAnalyzer.py
+        if prefixIndex is not None and column in prefixIndex:
+            Combined_Barcode[column] = centroid_by_prefix(data, prefixIndex[column], Combined_Barcode[column].to_numpy())
+            return Combined_Barcode
         
         # Step 5: Process data in parallel
         with ThreadPoolExecutor() as executor:
@@ -0,0 +1,289 @@
+'''
+Note about the script:
+2-bit encoding of barcodes shared by the steps of the pipeline (barcodeTable.py in Step 1 and 2, multibarcodeAnalyzer.py in Step 2
+and LVHistogram.py in Step 2 and 3). A 90-100 nt barcode takes 2 uint64 words (16 bytes) instead of 4 bytes per base in a NumPy
+unicode array or a Python string per barcode in a list or a pandas object column.
+
+The barcodes of a table are kept together as an "encoded" tuple of 4 arrays, in the order of the barcodes given to encode_barcodes:
+	1. words - uint64 array of shape (n, words per barcode); word k holds bases 32k to 32k+31, 2 bits per base (A=0, C=1, G=2, T=3),
+	   first base in the top bits and zeros after the end of the barcode. Sorting the rows word by word, then by length, therefore
+	   sorts the barcodes alphabetically.
+	2. lengths - uint16 array with the number of bases of each barcode
+	3. otherIndex - the rows of the barcodes with any other character (e.g. N); their words are all zeros
+	4. otherBarcodes - those barcodes as a bytes array, kept as plain text
+
+All the functions below work on the whole table at once (prefix truncation, hashing, equality, Hamming distance, unique rows and decoding).
+-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------'''
+
+import zlib
+import numpy as np
+
+# Code of each base; every other byte gets NO_BASE
+BASES = b"ACGT"
+NO_BASE = 255
+BASES_PER_WORD = 32
+_BASE_CODES = np.full(256, NO_BASE, dtype=np.uint8)
+_BASE_CODES[np.frombuffer(BASES, dtype=np.uint8)] = np.arange(len(BASES), dtype=np.uint8)
+_CODE_BASES = np.frombuffer(BASES, dtype=np.uint8)
+# The 4 bases of every packed byte, first base in the top bits
+_BYTE_BASES = _CODE_BASES[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+# Same codes with the zero byte (padding of NumPy bytes arrays, never part of a barcode read from text) as code 0
+_PADDED_BASE_CODES = _BASE_CODES.copy()
+_PADDED_BASE_CODES[0] = 0
+# Every odd bit of a word (the low bit of each base), used to fold a 2-bit difference onto 1 bit per base
+_LOW_BITS = np.uint64(0x5555555555555555)
+# Number of set bits of every byte, for NumPy versions without np.bitwise_count
+_BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def word_count(length):
+    """Function to give the number of uint64 words needed for barcodes of the given length."""
+    return (int(length) + BASES_PER_WORD - 1) // BASES_PER_WORD
+
+
+def encode_barcodes(barcodes):
+    """
+    Function to pack barcode strings 2 bits per base into uint64 words.
+
+    Args:
+    barcodes (list): Barcode strings (str or bytes)
+
+    Returns:
+    tuple: the encoded table (words, lengths, otherIndex, otherBarcodes), see the note at the top of the script
+    """
+    barcodes = np.asarray(barcodes, dtype=bytes)
+    count = len(barcodes)
+    lengths = np.char.str_len(barcodes).astype(np.uint16) if count else np.zeros(0, dtype=np.uint16)
+    width = int(lengths.max()) if count else 0
+    wordsPerBarcode = word_count(width)
+
+    # Widening the bytes dtype pads every barcode with zero bytes up to a whole number of words
+    paddedWidth = max(1, wordsPerBarcode * BASES_PER_WORD)
+    bases = barcodes.astype(f"S{paddedWidth}").view(np.uint8).reshape(count, paddedWidth)[:, :wordsPerBarcode * BASES_PER_WORD]
+    # The zero bytes of the padding after the end of a barcode read as code 0 rather than as an unknown base
+    codes = np.take(_PADDED_BASE_CODES, bases)
+    other = (codes == NO_BASE).any(axis=1)
+    codes[other] = 0
+
+    # 4 bases per byte, first base in the top bits; read as big-endian words the bytes give the first base in the top bits of the word
+    groups = codes.reshape(count, wordsPerBarcode * 8, 4)
+    packed = (groups[:, :, 0] << 6) | (groups[:, :, 1] << 4) | (groups[:, :, 2] << 2) | groups[:, :, 3]
+    words = np.ascontiguousarray(packed, dtype=np.uint8).view(">u8").astype(np.uint64)
+    otherIndex = np.flatnonzero(other)
+    return words, lengths, otherIndex, barcodes[otherIndex]
+
+
+def decode_barcodes(encoded, rows=None):
+    """
+    Function to turn an encoded table back into barcode strings, in the order of its rows.
+
+    Args:
+    encoded (tuple): Table made by encode_barcodes
+    rows (numpy.ndarray): If given, only decode these rows (in this order)
+
+    Returns:
+    numpy.ndarray: the barcodes as a str array
+    """
+    words, lengths, otherIndex, otherBarcodes = encoded
+    if rows is not None:
+        encoded = take_rows(encoded, rows)
+        words, lengths, otherIndex, otherBarcodes = encoded
+    count, wordsPerBarcode = words.shape
+
+    # Every packed byte is turned into its 4 bases at once, and only the columns up to the longest barcode are kept
+    packed = words.astype(">u8").view(np.uint8).reshape(count, wordsPerBarcode * 8)
+    width = int(lengths.max()) if count else 0
+    bases = np.take(_BYTE_BASES, packed, axis=0).reshape(count, wordsPerBarcode * BASES_PER_WORD)[:, :width].copy()
+    # Bytes after the end of each barcode are set to 0, which numpy drops from the end of bytes strings
+    shorter = np.flatnonzero(lengths < width)
+    if len(shorter):
+        bases[shorter] *= np.arange(width) < lengths[shorter, None]
+    barcodes = bases.view(f"S{width}").reshape(count) if count and width else np.zeros(count, dtype="S1")
+    barcodes = barcodes.astype(str)
+    if len(otherIndex):
+        barcodes = barcodes.astype(f"<U{max(barcodes.dtype.itemsize // 4, int(np.char.str_len(otherBarcodes).max()))}")
+        barcodes[otherIndex] = otherBarcodes.astype(str)
+    return barcodes
+
+
+def take_rows(encoded, rows):
+    """
+    Function to select rows of an encoded table (by index array or boolean mask), keeping the other barcodes that fall in the selection.
+    """
+    words, lengths, otherIndex, otherBarcodes = encoded
+    rows = np.arange(len(lengths))[rows]
+    # Text of the other barcodes by row, to carry it over to the rows they end up at
+    isOther = np.zeros(len(lengths), dtype=bool)
+    isOther[otherIndex] = True
+    otherText = np.empty(len(lengths), dtype=otherBarcodes.dtype if len(otherBarcodes) else "S1")
+    otherText[otherIndex] = otherBarcodes
+    newOtherIndex = np.flatnonzero(isOther[rows])
+    return words[rows], lengths[rows], newOtherIndex, otherText[rows[newOtherIndex]]
+
+
+def truncate_prefix(encoded, length):
+    """
+    Function to keep only the first length bases of every barcode (e.g. 30, 40 or 50); shorter barcodes are kept whole.
+
+    Returns:
+    tuple: the encoded table of the prefixes, with only the words the prefixes need
+    """
+    words, lengths, otherIndex, otherBarcodes = encoded
+    wordsPerBarcode = min(word_count(length), words.shape[1])
+    prefixWords = words[:, :wordsPerBarcode].copy()
+    # Clear the bases after the prefix in its last word
+    tailBases = length - (wordsPerBarcode - 1) * BASES_PER_WORD
+    if wordsPerBarcode and tailBases < BASES_PER_WORD:
+        prefixWords[:, -1] &= ~np.uint64((1 << (2 * (BASES_PER_WORD - tailBases))) - 1)
+    # Other barcodes whose prefix stops before the first unknown base are packed like the rest
+    otherWords, otherLengths, stillOther, prefixBarcodes = encode_barcodes([barcode[:length] for barcode in otherBarcodes])
+    if len(otherIndex):
+        prefixWords[otherIndex, :otherWords.shape[1]] = otherWords
+    return prefixWords, np.minimum(lengths, length).astype(np.uint16), otherIndex[stillOther], prefixBarcodes
+
+
+def hash_barcodes(encoded):
+    """
+    Function to give every barcode a 64-bit hash, equal for equal barcodes within and across tables.
+    The packed words are mixed with a multiply-xorshift; the other barcodes are hashed from their text.
+    """
+    words, lengths, otherIndex, otherBarcodes = encoded
+    hashes = lengths.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    with np.errstate(over="ignore"):
+        for column in range(words.shape[1]):
+            mixed = hashes ^ (words[:, column] + np.uint64(0x9E3779B97F4A7C15) + (hashes << np.uint64(6)) + (hashes >> np.uint64(2)))
+            mixed *= np.uint64(0xBF58476D1CE4E5B9)
+            mixed ^= mixed >> np.uint64(31)
+            # Only the words a barcode uses are mixed in, so tables of different widths give the same hashes
+            hashes = np.where(lengths > column * BASES_PER_WORD, mixed, hashes)
+    hashes[otherIndex] = [zlib.crc32(barcode) | (1 << 63) for barcode in otherBarcodes]
+    return hashes
+
+
+def _same_width(first, second):
+    """Function to pad the words of two encoded tables with zeros to the same number of words per barcode."""
+    firstWords, secondWords = first[0], second[0]
+    width = max(firstWords.shape[1], secondWords.shape[1])
+    pad = lambda words: np.pad(words, ((0, 0), (0, width - words.shape[1]))) if words.shape[1] < width else words
+    return pad(firstWords), pad(secondWords)
+
+
+def _other_text(encoded):
+    """Function to give the text of the other barcodes of a table as a row-long array (empty strings for packed rows)."""
+    words, lengths, otherIndex, otherBarcodes = encoded
+    text = np.zeros(len(lengths), dtype=otherBarcodes.dtype if len(otherBarcodes) else "S1")
+    text[otherIndex] = otherBarcodes
+    return text
+
+
+def barcodes_equal(first, second):
+    """
+    Function to compare two encoded tables of the same number of rows row by row.
+
+    Returns:
+    numpy.ndarray: bool array, True where the barcodes are the same
+    """
+    firstWords, secondWords = _same_width(first, second)
+    equal = (firstWords == secondWords).all(axis=1) & (first[1] == second[1])
+    # The words of other barcodes are zeros, so those rows are compared by their text
+    return equal & (_other_text(first) == _other_text(second))
+
+
+def _prefix_masks(lengths, wordsPerBarcode):
+    """Function to give, for every row, the masks of the words that keep the first lengths[row] bases."""
+    basesInWord = np.clip(np.asarray(lengths, dtype=np.int64)[:, None] - BASES_PER_WORD * np.arange(wordsPerBarcode), 0, BASES_PER_WORD)
+    # Shifting a uint64 by 64 is not defined, so full words get their mask separately
+    shift = (2 * (BASES_PER_WORD - np.minimum(basesInWord, BASES_PER_WORD - 1))).astype(np.uint64)
+    masks = ~((np.uint64(1) << shift) - np.uint64(1))
+    return np.where(basesInWord == BASES_PER_WORD, ~np.uint64(0), np.where(basesInWord == 0, np.uint64(0), masks))
+
+
+def popcount(words):
+    """Function to count the set bits of every uint64 in an array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    return _BYTE_POPCOUNT[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_distance(first, second):
+    """
+    Function to count the positions at which two encoded tables differ, row by row (same number of rows).
+    Bases past the end of the shorter barcode count as differences. Rows with an other barcode on either side are compared by their text.
+
+    Returns:
+    numpy.ndarray: int array of distances
+    """
+    firstWords, secondWords = _same_width(first, second)
+    firstLengths, secondLengths = first[1].astype(np.int64), second[1].astype(np.int64)
+    shorter = np.minimum(firstLengths, secondLengths)
+    # Only compare the bases both barcodes have; the padding of the shorter one would otherwise read as A
+    difference = (firstWords ^ secondWords) & _prefix_masks(shorter, firstWords.shape[1])
+    # A base differs when either of its 2 bits differs; fold that onto the low bit of the base and count
+    distances = popcount((difference | (difference >> np.uint64(1))) & _LOW_BITS).sum(axis=1, dtype=np.int64)
+    distances += np.abs(firstLengths - secondLengths)
+
+    otherRows = np.union1d(first[2], second[2])
+    if len(otherRows):
+        firstText, secondText = decode_barcodes(first, otherRows), decode_barcodes(second, otherRows)
+        distances[otherRows] = [sum(a != b for a, b in zip(x, y)) + abs(len(x) - len(y)) for x, y in zip(firstText, secondText)]
+    return distances
+
+
+def _row_keys(words, lengths):
+    """Function to give every row a bytes key (its words then its length, big-endian) that sorts like the barcode it packs."""
+    keys = np.hstack([words.astype(">u8").view(np.uint8).reshape(len(lengths), words.shape[1] * 8),
+                      lengths.astype(">u2").view(np.uint8).reshape(len(lengths), 2)])
+    return np.ascontiguousarray(keys).view(f"S{keys.shape[1]}").reshape(len(lengths))
+
+
+def _other_positions(words, lengths, otherBarcodes):
+    """
+    Function to find where other barcodes go among sorted packed rows so that all of them are in alphabetical order.
+    An other barcode differs from every packed barcode at its first character c that is not A, C, G or T, so it goes after the
+    packed barcodes that are at most its first bases followed by the last base below c and then only T.
+    """
+    width = words.shape[1] * BASES_PER_WORD
+    bounds, boundLengths = [], []
+    for barcode in otherBarcodes:
+        first = int(np.flatnonzero(_BASE_CODES[np.frombuffer(barcode, dtype=np.uint8)] == NO_BASE)[0])
+        below = [base for base in BASES if base < barcode[first]]
+        if below:
+            bounds.append(barcode[:first] + bytes([below[-1]]) + b"T" * (width - first - 1))
+            boundLengths.append(np.iinfo(np.uint16).max)
+        else:
+            bounds.append(barcode[:first])
+            boundLengths.append(first)
+    boundWords = encode_barcodes(bounds)[0]
+    boundWords = np.pad(boundWords, ((0, 0), (0, words.shape[1] - boundWords.shape[1])))
+    boundKeys = _row_keys(boundWords, np.array(boundLengths, dtype=np.uint16))
+    return np.searchsorted(_row_keys(words, lengths), boundKeys, side="right")
+
+
+def unique_barcodes(encoded):
+    """
+    Function to drop the repeated barcodes of an encoded table by sorting the packed rows instead of the strings.
+    The barcodes come in alphabetical order, the order np.unique gives for the strings; the other barcodes are sorted
+    as text and put in between the packed ones.
+
+    Returns:
+    tuple: the encoded table of the unique barcodes
+    """
+    words, lengths, otherIndex, otherBarcodes = encoded
+    packedRows = np.ones(len(lengths), dtype=bool)
+    packedRows[otherIndex] = False
+    words, lengths = words[packedRows], lengths[packedRows]
+
+    # np.lexsort sorts on its last key first: the first word, then the next ones, then the length
+    order = np.lexsort((lengths,) + tuple(words[:, column] for column in reversed(range(words.shape[1]))))
+    words, lengths = words[order], lengths[order]
+    first = np.ones(len(lengths), dtype=bool)
+    first[1:] = (words[1:] != words[:-1]).any(axis=1) | (lengths[1:] != lengths[:-1])
+    words, lengths = words[first], lengths[first]
+
+    otherBarcodes = np.unique(otherBarcodes)
+    if not len(otherBarcodes):
+        return words, lengths, np.zeros(0, dtype=np.int64), otherBarcodes
+    positions = _other_positions(words, lengths, otherBarcodes)
+    words = np.insert(words, positions, 0, axis=0)
+    lengths = np.insert(lengths, positions, np.char.str_len(otherBarcodes).astype(np.uint16))
+    return words, lengths, positions + np.arange(len(otherBarcodes)), otherBarcodes
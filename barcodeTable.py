@@ -0,0 +1,117 @@
+'''
+Note about the script:
+Columnar binary table of the barcodes of one sample. Step 1 (parseFastqMain.py --tableFormat npz/both) writes it next to the
+gzipped tables and Step 2 (multibarcodeAnalyzer.py) loads it instead of parsing the _readCountsOnly text file line by line.
+
+The table is a NumPy .npz file with one array per column, in the same barcode order as the text tables:
+	1. packed - the barcodes over A, C, G and T, 2 bits per base (4 bases per byte, first base in the top bits), i.e. the bytes of the
+	   uint64 words of barcodeEncoding.py
+	2. lengths - the number of bases of each barcode
+	3. reads / umis - the number of reads and of unique UMIs of each barcode
+	4. otherIndex / otherBarcodes - the rows of barcodes with any other character (e.g. N), kept as plain text
+
+Command to export the count tables as text: python3 <path to barcodeTable.py> <path to table.npz> <output prefix> [-liberal]
+It writes <output prefix>_counts.gz, <output prefix>_UMICountsOnly.gz and <output prefix>_readCountsOnly.gz in the Step 1 format
+(with _liberal before .gz for tables from checkVector before).
+-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------'''
+
+import gzip
+from argparse import ArgumentParser
+import numpy as np
+from barcodeEncoding import encode_barcodes, decode_barcodes, word_count
+
+
+def pack_barcodes(barcodes):
+    """
+    Pack barcode strings 2 bits per base with barcodeEncoding.encode_barcodes and store the words as bytes.
+    Barcodes with a character other than A, C, G or T are left out of the packed array (their row is all zeros)
+    and returned as text with their row numbers.
+
+    Args:
+    barcodes (list): Barcode strings
+
+    Returns:
+    tuple: (packed uint8 array of shape (n, bytes per barcode), lengths, row numbers of the other barcodes, the other barcodes as bytes)
+    """
+    words, lengths, otherIndex, otherBarcodes = encode_barcodes(barcodes)
+    # The big-endian bytes of the words hold 4 bases each, first base in the top bits; only the bytes the longest barcode needs are kept
+    packedWidth = (int(lengths.max()) + 3) // 4 if len(lengths) else 0
+    packed = words.astype(">u8").view(np.uint8).reshape(len(lengths), words.shape[1] * 8)[:, :packedWidth]
+    return np.ascontiguousarray(packed), lengths, otherIndex, otherBarcodes
+
+
+def packed_to_encoded(packed, lengths, otherIndex, otherBarcodes):
+    """
+    Turn the arrays made by pack_barcodes into an encoded table of barcodeEncoding (uint64 words) without decoding the barcodes.
+    """
+    count, packedWidth = packed.shape
+    wordsPerBarcode = word_count(packedWidth * 4)
+    padded = np.zeros((count, wordsPerBarcode * 8), dtype=np.uint8)
+    padded[:, :packedWidth] = packed
+    return padded.view(">u8").astype(np.uint64), lengths, otherIndex, otherBarcodes
+
+
+def unpack_barcodes(packed, lengths, otherIndex, otherBarcodes):
+    """
+    Turn the arrays made by pack_barcodes back into the barcode strings, in their original order.
+
+    Returns:
+    numpy.ndarray: the barcodes as a str array
+    """
+    return decode_barcodes(packed_to_encoded(packed, lengths, otherIndex, otherBarcodes))
+
+
+def save_barcode_table(fileName, barcodes, reads, umis):
+    """
+    Write the barcodes of a sample with their read and UMI counts to a compressed .npz table.
+
+    Args:
+    fileName (str): Path of the .npz file
+    barcodes (list): Barcode strings, in the order of the text tables
+    reads (list): Number of reads of each barcode
+    umis (list): Number of unique UMIs of each barcode
+    """
+    packed, lengths, otherIndex, otherBarcodes = pack_barcodes(barcodes)
+    with open(fileName, "wb") as tableFile:
+        np.savez_compressed(tableFile, packed=packed, lengths=lengths, reads=np.asarray(reads, dtype=np.int64), umis=np.asarray(umis, dtype=np.int64), otherIndex=otherIndex, otherBarcodes=otherBarcodes)
+
+
+def load_barcode_table(fileName, decode=True):
+    """
+    Read a table written by save_barcode_table.
+
+    Args:
+    fileName (str): Path of the .npz file
+    decode (bool): If False, leave the barcodes packed and return them as 'encoded' (see barcodeEncoding.py) instead of 'barcodes'
+
+    Returns:
+    dict: 'barcodes' (str array) or 'encoded', 'reads' and 'umis' (int64 arrays)
+    """
+    with np.load(fileName) as table:
+        encoded = packed_to_encoded(table["packed"], table["lengths"], table["otherIndex"], table["otherBarcodes"])
+        if decode:
+            return {"barcodes": decode_barcodes(encoded), "reads": table["reads"], "umis": table["umis"]}
+        return {"encoded": encoded, "reads": table["reads"], "umis": table["umis"]}
+
+
+def export_tsv(table, outFilePrefix, suffix="", compresslevel=6):
+    """
+    Write the count tables of a loaded barcode table in the Step 1 text format:
+    <prefix>_counts<suffix>.gz (barcode, reads, UMIs), <prefix>_UMICountsOnly<suffix>.gz and <prefix>_readCountsOnly<suffix>.gz.
+    """
+    columns = {"_counts": (table["reads"], table["umis"]), "_UMICountsOnly": (table["umis"],), "_readCountsOnly": (table["reads"],)}
+    for name, counts in columns.items():
+        with gzip.open(outFilePrefix + name + suffix + ".gz", "wt", compresslevel=compresslevel) as out_file:
+            for row in zip(table["barcodes"], *counts):
+                out_file.write("\t".join(map(str, row)) + "\n")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("tablePath", help = "Specify the path to the .npz barcode table written by Step 1")
+    parser.add_argument("outFilePrefix", help = "Specify the prefix of the text tables to write, usually the sample name")
+    parser.add_argument("-liberal", help = "If specified, name the tables like checkVector before does (e.g. <prefix>_counts_liberal.gz)", action = 'store_true')
+    args = parser.parse_args()
+
+    export_tsv(load_barcode_table(args.tablePath), args.outFilePrefix, "_liberal" if args.liberal else "")
+    print("Exported {} to {}_*.gz".format(args.tablePath, args.outFilePrefix))
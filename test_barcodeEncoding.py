@@ -0,0 +1,64 @@
+import random
+import numpy as np
+from barcodeEncoding import encode_barcodes, decode_barcodes, take_rows, truncate_prefix, hash_barcodes, barcodes_equal, \
+    popcount, hamming_distance, unique_barcodes
+
+
+def random_barcodes(count, seed, alphabet="ACGT", lengths=(30, 64, 90, 100)):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(alphabet) for _ in range(rng.choice(lengths))) for _ in range(count)]
+
+
+def test_encode_decode_round_trip_with_other_characters():
+    barcodes = random_barcodes(300, 1) + random_barcodes(50, 2, "ACGTN") + ["A", "T" * 32, "G" * 33, "NNNN"]
+    encoded = encode_barcodes(barcodes)
+    assert encoded[0].shape == (len(barcodes), 4)
+    assert list(decode_barcodes(encoded)) == barcodes
+    rows = np.array([5, 320, 0, 351])
+    assert list(decode_barcodes(encoded, rows)) == [barcodes[row] for row in rows]
+    assert list(decode_barcodes(take_rows(encoded, rows))) == [barcodes[row] for row in rows]
+
+
+def test_truncate_prefix_matches_slicing():
+    barcodes = random_barcodes(200, 3) + random_barcodes(50, 4, "ACGTN") + ["ACGTNACGT", "AC"]
+    encoded = encode_barcodes(barcodes)
+    for length in (1, 30, 32, 33, 40, 50, 64, 65, 90, 120):
+        assert list(decode_barcodes(truncate_prefix(encoded, length))) == [barcode[:length] for barcode in barcodes]
+    # A prefix that ends before the N of a barcode is packed like the others
+    assert len(truncate_prefix(encode_barcodes(["ACGTNACGT"]), 4)[2]) == 0
+
+
+def test_hash_and_equality_across_tables():
+    barcodes = random_barcodes(200, 5) + random_barcodes(20, 6, "ACGTN")
+    first = encode_barcodes(barcodes)
+    # The same barcodes in a wider table (a longer barcode added) hash and compare the same
+    second = take_rows(encode_barcodes(barcodes + ["A" * 150]), np.arange(len(barcodes)))
+    assert (hash_barcodes(first) == hash_barcodes(second)).all()
+    assert barcodes_equal(first, second).all()
+
+    # Barcodes that only differ in the last base, in length or in an N are told apart
+    changed = [barcode[:-1] + ("A" if barcode[-1] != "A" else "C") for barcode in barcodes]
+    assert not barcodes_equal(first, encode_barcodes(changed)).any()
+    assert not barcodes_equal(encode_barcodes(["ACGT", "ACGTN"]), encode_barcodes(["ACGTA", "ACGTA"])).any()
+    assert len(np.unique(hash_barcodes(first))) == len(set(barcodes))
+
+
+def test_popcount():
+    words = np.array([0, 1, 0xFF, 0x5555555555555555, 0xFFFFFFFFFFFFFFFF], dtype=np.uint64)
+    assert list(popcount(words)) == [0, 1, 8, 32, 64]
+
+
+def test_hamming_distance_matches_counting_positions():
+    first = random_barcodes(200, 7, lengths=(30, 40, 90)) + ["ACGTN", "AC"]
+    second = random_barcodes(200, 8, lengths=(30, 40, 90)) + ["ACGTA", "ACGT"]
+    # Some pairs only a few bases apart
+    second[:50] = [barcode[:10] + "T" + barcode[11:] for barcode in first[:50]]
+    expected = [sum(a != b for a, b in zip(x, y)) + abs(len(x) - len(y)) for x, y in zip(first, second)]
+    assert list(hamming_distance(encode_barcodes(first), encode_barcodes(second))) == expected
+
+
+def test_unique_barcodes_in_the_order_of_np_unique():
+    barcodes = random_barcodes(300, 9, lengths=(5, 40, 90)) + random_barcodes(60, 10, "ACGTN", (5, 40)) + ["ACGTa", "AC.T"]
+    barcodes += barcodes[:100]
+    encoded = unique_barcodes(encode_barcodes(barcodes))
+    assert list(decode_barcodes(encoded)) == list(np.unique(barcodes))